@@ -0,0 +1,46 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+from typing import Any, Coroutine, TypeVar
+
+T = TypeVar("T")
+
+
+class AsyncRunner:
+    def __init__(self, max_concurrency: int):
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "AsyncRunner":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(
+            self._run(coroutine, contextvars.copy_context()), self._loop
+        )
+
+    async def _run(
+        self, coroutine: Coroutine[Any, Any, T], context: contextvars.Context
+    ) -> T:
+        async with self._semaphore:
+            # The coroutine runs in the submitter's context, so context variables
+            # such as the current trace span carry over to the loop thread.
+            return await context.run(asyncio.ensure_future, coroutine)
+
+    def close(self) -> None:
+        async def cancel_pending_tasks():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_pending_tasks(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from checkpoint import CheckpointJournal, set_checkpoint_journal
+from dotenv import load_dotenv
+from main import (
+    add_build_arguments,
+    build_app,
+    build_session,
+    configure_build,
+    prepare_workspace,
+)
+from tracing import SPAN_COUNTER_NAMES, span
+from util import (
+    BATCH_MAX_CONCURRENT_BUILDS,
+    BATCH_SUMMARY_FILE_NAME,
+    CHECKPOINT_JOURNAL_FILE_NAME,
+    WORKSPACE_DIR,
+    WorkspaceNameFilter,
+    get_doc_dir,
+    get_doc_file_path,
+    map_concurrently,
+    set_workspace_dir,
+)
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s [%(workspace)s]: %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S",
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(WorkspaceNameFilter())
+
+    arg_parser = argparse.ArgumentParser(
+        description="Build an app for each specification file in a directory."
+    )
+    arg_parser.add_argument(
+        "--spec-dir",
+        type=str,
+        required=True,
+        help="Path to a directory of files containing the specifications "
+        "of the apps to build.",
+    )
+    arg_parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=os.path.join(WORKSPACE_DIR, "batch"),
+        help="Each app is built in a workspace under this directory, which also "
+        "holds the shared LLM cache and the result summary.",
+    )
+    arg_parser.add_argument(
+        "--max-concurrent-builds",
+        type=int,
+        default=BATCH_MAX_CONCURRENT_BUILDS,
+        help="Number of apps built at the same time.",
+    )
+    add_build_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    spec_file_paths = list_spec_files(args.spec_dir)
+    if not spec_file_paths:
+        sys.exit(f"No specification files in {args.spec_dir}.")
+
+    output_dir = os.path.abspath(args.output_dir)
+    set_workspace_dir(output_dir)
+    os.makedirs(get_doc_dir(), exist_ok=True)
+    configure_build(args)
+    with build_session(args):
+        results = map_concurrently(
+            lambda spec_file_path: run_build(spec_file_path, output_dir, args),
+            spec_file_paths,
+            max_workers=args.max_concurrent_builds,
+        )
+
+    summary_file_path = os.path.join(output_dir, BATCH_SUMMARY_FILE_NAME)
+    with open(summary_file_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(format_results(results))
+    logging.info(f"Wrote the result summary to {summary_file_path}.")
+    if any(result["status"] != "succeeded" for result in results):
+        sys.exit(1)
+
+
+def list_spec_files(spec_dir: str) -> list[str]:
+    return sorted(
+        os.path.join(spec_dir, file_name)
+        for file_name in os.listdir(spec_dir)
+        if not file_name.startswith(".")
+        and os.path.isfile(os.path.join(spec_dir, file_name))
+    )
+
+
+def run_build(spec_file_path: str, output_dir: str, args: argparse.Namespace) -> dict:
+    # Runs in its own context, so the workspace and journal set here are only
+    # seen by this build.
+    name = os.path.basename(spec_file_path)
+    workspace_dir = os.path.join(output_dir, "builds", name)
+    set_workspace_dir(workspace_dir)
+    result = {"spec": spec_file_path, "workspace_dir": workspace_dir}
+    started_at = time.perf_counter()
+    try:
+        prepare_workspace(args.reuse)
+        set_checkpoint_journal(
+            CheckpointJournal(get_doc_file_path(CHECKPOINT_JOURNAL_FILE_NAME))
+        )
+        with span("batch_build", spec=name) as build_span:
+            try:
+                # Unattended builds cannot ask which fix to apply, so they always
+                # test the suggested fixes and keep the best one.
+                build_app(
+                    os.path.abspath(spec_file_path),
+                    args.index_mode,
+                    args.retriever,
+                    args.warm_test_worker,
+                    args.test_coverage,
+                    auto_fix=True,
+                )
+            finally:
+                result.update(build_span.counters)
+        result["status"] = "succeeded"
+    except Exception as e:
+        logging.exception(f"Building {name} failed.")
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        set_checkpoint_journal(None)
+        result["seconds"] = time.perf_counter() - started_at
+    return result
+
+
+def format_results(results: list[dict]) -> str:
+    header = ["spec", "status", "seconds"] + SPAN_COUNTER_NAMES
+    lines = [header] + [
+        [
+            os.path.basename(result["spec"]),
+            result["status"],
+            f"{result['seconds']:.1f}",
+        ]
+        + [str(result.get(counter_name, 0)) for counter_name in SPAN_COUNTER_NAMES]
+        for result in results
+    ]
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if i < 2 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(line, widths))
+        )
+        for line in lines
+    )
+
+
+if __name__ == "__main__":
+    main()
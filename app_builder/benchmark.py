@@ -0,0 +1,320 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from util import (
+    BENCHMARK_BASELINE_FILE_NAME,
+    BENCHMARK_FILE_COUNTS,
+    BENCHMARK_REGRESSION_THRESHOLD,
+    EDIT_FORMAT_SEARCH_REPLACE,
+    EDIT_FORMAT_WHOLE,
+    SCRIPT_DIR,
+)
+
+COMPARED_METRIC_NAMES = [
+    "build_seconds",
+    "modify_seconds",
+    "test_execution_seconds",
+    "index_build_seconds",
+    "peak_rss_mb",
+]
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S",
+    )
+
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark building and modifying synthetic apps offline "
+        "with a scripted fake model and fake embeddings."
+    )
+    arg_parser.add_argument(
+        "--file-counts",
+        type=int,
+        nargs="+",
+        default=BENCHMARK_FILE_COUNTS,
+        help="Number of files of each synthetic app.",
+    )
+    arg_parser.add_argument(
+        "--edit-format",
+        choices=[EDIT_FORMAT_WHOLE, EDIT_FORMAT_SEARCH_REPLACE],
+        default=EDIT_FORMAT_WHOLE,
+    )
+    arg_parser.add_argument(
+        "--model-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake model waits before each response.",
+    )
+    arg_parser.add_argument(
+        "--baseline",
+        type=str,
+        default=os.path.join(SCRIPT_DIR, BENCHMARK_BASELINE_FILE_NAME),
+        help="Path to the stored results to compare against. Timings depend on the "
+        "machine, so only results recorded on this machine are compared.",
+    )
+    arg_parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the new baseline.",
+    )
+    arg_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=BENCHMARK_REGRESSION_THRESHOLD,
+        help="Report a regression when a metric exceeds the baseline by this ratio.",
+    )
+    arg_parser.add_argument("--run-file-count", type=int, help=argparse.SUPPRESS)
+    arg_parser.add_argument("--result-file", type=str, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_file_count is not None:
+        result = run_benchmark(
+            args.run_file_count, args.edit_format, args.model_latency
+        )
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return
+
+    results = [
+        run_benchmark_process(file_count, args.edit_format, args.model_latency)
+        for file_count in args.file_counts
+    ]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline_results = json.load(f)
+        machine = get_machine_description()
+        baseline = {
+            result["file_count"]: result
+            for result in baseline_results
+            if result.get("machine") == machine
+        }
+        if baseline_results and not baseline:
+            logging.warning(
+                f"Ignoring {args.baseline} because it was recorded on another "
+                "machine. Record a baseline on this machine with --update-baseline."
+            )
+    print(format_results(results, baseline))
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    for regression in regressions:
+        logging.error(f"Regression: {regression}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logging.warning(f"Stored the results as the baseline in {args.baseline}.")
+    elif regressions:
+        sys.exit(1)
+
+
+def run_benchmark_process(
+    file_count: int, edit_format: str, model_latency_seconds: float
+) -> dict:
+    # Each app is built in a fresh process so that peak RSS is per app size.
+    workspace_dir = tempfile.mkdtemp(prefix="app_builder_benchmark_")
+    result_file_path = os.path.join(workspace_dir, "result.json")
+    try:
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(SCRIPT_DIR, "benchmark.py"),
+                "--run-file-count",
+                str(file_count),
+                "--result-file",
+                result_file_path,
+                "--edit-format",
+                edit_format,
+                "--model-latency",
+                str(model_latency_seconds),
+            ],
+            env={**os.environ, "APP_BUILDER_WORKSPACE_DIR": workspace_dir},
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        with open(result_file_path) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+def run_benchmark(
+    file_count: int, edit_format: str, model_latency_seconds: float
+) -> dict:
+    from cache import ModelCache
+    from edit_blocks import set_edit_format
+    from fake_models import (
+        HashingEmbeddings,
+        ScriptedChatModel,
+        get_change_request_text,
+        get_specifications_text,
+    )
+    from main import build_app, modify_app, prepare_workspace
+    from model_scheduler import ModelScheduler
+    from prompt_registry import load_prompt_registry
+    from tracing import Tracer, set_tracer
+    from util import (
+        LLM_CACHE_FILE_NAME,
+        LLM_CACHE_MAX_AGE_SECONDS,
+        LLM_CACHE_MAX_BYTES,
+        LLM_CACHE_MAX_ENTRIES,
+        MAX_CONCURRENT_MODEL_CALLS,
+        MODEL_MAX_RETRIES,
+        WORKSPACE_DIR,
+        get_cache_file_path,
+        get_doc_file_path,
+        set_embedding_model,
+        set_model_cache,
+        set_model_scheduler,
+    )
+
+    load_prompt_registry()
+    set_edit_format(edit_format)
+    prepare_workspace(reuse=False)
+    spec_file_path = os.path.join(WORKSPACE_DIR, "spec.txt")
+    with open(spec_file_path, "w") as f:
+        f.write(get_specifications_text(file_count))
+    change_request_file_path = os.path.join(WORKSPACE_DIR, "change_request.txt")
+    with open(change_request_file_path, "w") as f:
+        f.write(get_change_request_text())
+
+    chat_model = ScriptedChatModel(
+        file_count=file_count, latency_seconds=model_latency_seconds
+    )
+    set_embedding_model(HashingEmbeddings())
+    model_cache = ModelCache(
+        get_cache_file_path(LLM_CACHE_FILE_NAME),
+        max_entries=LLM_CACHE_MAX_ENTRIES,
+        max_bytes=LLM_CACHE_MAX_BYTES,
+        max_age_seconds=LLM_CACHE_MAX_AGE_SECONDS,
+    )
+    set_model_cache(model_cache)
+    # The fake model has no rate limits; only the concurrency limit applies.
+    model_scheduler = ModelScheduler(
+        requests_per_minute=1e9,
+        tokens_per_minute=1e9,
+        max_concurrent_requests=MAX_CONCURRENT_MODEL_CALLS,
+        max_retries=MODEL_MAX_RETRIES,
+    )
+    set_model_scheduler(model_scheduler)
+
+    phases = [
+        (
+            "build",
+            lambda: build_app(spec_file_path, auto_fix=True, chat_model=chat_model),
+        ),
+        (
+            "modify",
+            lambda: modify_app(
+                spec_file_path, change_request_file_path, chat_model=chat_model
+            ),
+        ),
+    ]
+    result = {
+        "file_count": file_count,
+        "machine": get_machine_description(),
+        "stages": {},
+    }
+    try:
+        for phase_name, run_phase in phases:
+            with open(get_doc_file_path(f"trace_{phase_name}.jsonl"), "w") as f:
+                tracer = Tracer(f)
+                set_tracer(tracer)
+                started_at = time.perf_counter()
+                run_phase()
+                result[f"{phase_name}_seconds"] = time.perf_counter() - started_at
+                set_tracer(None)
+            result["stages"][phase_name] = {
+                stage_name: metrics["wall_seconds"]
+                for stage_name, metrics in tracer.stage_metrics.items()
+            }
+    finally:
+        set_model_scheduler(None)
+        model_scheduler.close()
+        set_model_cache(None)
+        model_cache.close()
+        set_embedding_model(None)
+
+    build_stages = result["stages"]["build"]
+    result["test_execution_seconds"] = build_stages.get("execute_all_tests", 0.0)
+    result["index_build_seconds"] = build_stages.get(
+        "create_source_code_vector_db", 0.0
+    )
+    # ru_maxrss is in kilobytes on Linux.
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["peak_test_rss_mb"] = (
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    )
+    return result
+
+
+def get_machine_description() -> str:
+    cpu_name = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            cpu_name = next(
+                (
+                    line.split(":", 1)[1].strip()
+                    for line in f
+                    if line.startswith("model name")
+                ),
+                cpu_name,
+            )
+    return (
+        f"{cpu_name or platform.machine()}, {os.cpu_count()} CPUs, "
+        f"Python {platform.python_version()}"
+    )
+
+
+def format_results(results: list[dict], baseline: dict[int, dict]) -> str:
+    header = ["files"] + COMPARED_METRIC_NAMES + ["peak_test_rss_mb"]
+    lines = [header]
+    for result in results:
+        baseline_result = baseline.get(result["file_count"], {})
+        line = [str(result["file_count"])]
+        for name in header[1:]:
+            cell = f"{result[name]:.1f}"
+            if name in baseline_result:
+                change = result[name] / max(baseline_result[name], 1e-9) - 1
+                cell += f" ({change:+.0%})"
+            line.append(cell)
+        lines.append(line)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(cell.rjust(width) for cell, width in zip(line, widths))
+        for line in lines
+    )
+
+
+def find_regressions(
+    results: list[dict], baseline: dict[int, dict], threshold: float
+) -> list[str]:
+    regressions = []
+    for result in results:
+        baseline_result = baseline.get(result["file_count"])
+        if baseline_result is None:
+            continue
+        for name in COMPARED_METRIC_NAMES:
+            if result[name] > baseline_result[name] * threshold:
+                regressions.append(
+                    f"{name} for {result['file_count']} files is "
+                    f"{result[name]:.1f} against a baseline of "
+                    f"{baseline_result[name]:.1f}."
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
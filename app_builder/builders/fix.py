@@ -1,105 +1,302 @@
+import asyncio
+import contextvars
+import difflib
 import logging
+import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
 
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import load_prompt
-from langchain.vectorstores import FAISS
+from async_runner import AsyncRunner
+from builders.test import execute_all_tests, get_available_cpu_count
+from checkpoint import record_file_changes
+from edit_blocks import apply_model_edits, get_edit_format
+from failure_clusters import cluster_failures
+from langchain.schema import BaseRetriever, Document
 from parsers.strict_pydantic_output_parser import StrictPydanticOutputParser
+from prompt_assembly import (
+    count_tokens,
+    format_prompt,
+    get_relevant_public_interface_document,
+    truncate_to_token_count,
+)
+from prompt_registry import get_prompt_template
 from schema import (
     PublicInterfaceDocument,
     SourceCodeFix,
     SourceCodeFixOption,
     SourceCodeFixOptionSet,
 )
+from symbol_index import get_symbol_index, get_traceback_documents
+from test_log import TEST_LOG_SOURCE_CODE_FIX, get_test_log
+from tracing import traced
 from util import (
+    ACCEPTANCE_TEST_PREFIX,
+    EDIT_FORMAT_SEARCH_REPLACE,
+    FIX_CONTEXT_TOKEN_BUDGET,
+    MAX_CONCURRENT_MODEL_CALLS,
     RAW_ALL_TEST_ID,
-    TEST_LOG_FILE_NAME,
-    execute_model,
-    get_doc_file_path,
-    get_prompt_file_path,
+    UNIT_TEST_PREFIX,
+    ChatModel,
+    execute_model_async,
     get_src_file_path,
 )
+from worktree import create_worktree, remove_worktree, write_worktree_file
 
 
+@traced
 def fix_test_errors(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
     public_interface_document: PublicInterfaceDocument,
-    source_code_vector_db: FAISS,
+    source_code_retriever: BaseRetriever,
     test_failures: dict[str, str],
+    auto_fix: bool = False,
 ) -> list[str]:
     logging.info("Fixing test errors.")
+    failures = [
+        (test_id, f"{test_id.split('.')[0]}.py", error_message)
+        for test_id, error_message in test_failures.items()
+        if test_id != RAW_ALL_TEST_ID
+    ]
+    # Failures with the same signature share one suggestion and one fix.
+    clusters = cluster_failures(failures)
+    logging.info(
+        f"Grouped {len(failures)} test failures into {len(clusters)} clusters."
+    )
     fixed_file_names = []
 
-    for test_id, error_message in test_failures.items():
-        if test_id == RAW_ALL_TEST_ID:
-            continue
-        test_file_name = f"{test_id.split('.')[0]}.py"
-        option_collection = suggest_source_code_fixes(
-            model,
-            source_code_vector_db,
-            public_interface_document,
-            test_file_name,
-            error_message,
-            test_failures[RAW_ALL_TEST_ID],
-        )
+    with AsyncRunner(MAX_CONCURRENT_MODEL_CALLS) as runner:
+        suggestion_futures = [
+            runner.submit(
+                suggest_source_code_fixes(
+                    model,
+                    source_code_retriever,
+                    public_interface_document,
+                    cluster.test_file_names[0],
+                    cluster.error_messages[0],
+                    test_failures[RAW_ALL_TEST_ID],
+                )
+            )
+            for cluster in clusters
+        ]
+
+        # Fixes are generated in the background while the next options are
+        # reviewed. Only one fix per file is generated against the current code;
+        # later fixes for the same file wait until the earlier batch is applied.
+        fix_futures = {}
+        deferred_fixes = []
+
+        def schedule_fix(fix_plan: tuple[SourceCodeFixOption, str, str]) -> None:
+            option, test_file_name, error_message = fix_plan
+            if option.file_name in fix_futures:
+                deferred_fixes.append(fix_plan)
+                return
+            fix_futures[option.file_name] = runner.submit(
+                gen_source_code_fix_from_plan(
+                    model,
+                    option,
+                    option.file_name,
+                    test_file_name,
+                    error_message,
+                    specifications_text,
+                    public_interface_document,
+                )
+            )
+
+        for cluster, suggestion_future in zip(clusters, suggestion_futures):
+            test_id = cluster.test_ids[0]
+            test_file_name = cluster.test_file_names[0]
+            error_message = cluster.error_messages[0]
+            if len(cluster.test_ids) > 1:
+                logging.info(
+                    f"Fixing {test_id} also covers {len(cluster.test_ids) - 1} "
+                    f"failures with the same signature: {cluster.signature}."
+                )
+            if auto_fix:
+                source_code_fix = select_source_code_fix_speculatively(
+                    runner,
+                    model,
+                    suggestion_future.result(),
+                    test_id,
+                    cluster.test_file_names,
+                    error_message,
+                    specifications_text,
+                    public_interface_document,
+                )
+                if source_code_fix is not None:
+                    apply_source_code_fix(source_code_fix)
+                    fixed_file_names.append(source_code_fix.file_name)
+                continue
+
+            option = select_source_code_fix_option(
+                test_id, error_message, suggestion_future.result()
+            )
+            schedule_fix((option, test_file_name, error_message))
+
+        while fix_futures:
+            source_code_fixes = [future.result() for future in fix_futures.values()]
+            for source_code_fix in source_code_fixes:
+                apply_source_code_fix(source_code_fix)
+                fixed_file_names.append(source_code_fix.file_name)
+
+            fix_plans = deferred_fixes
+            fix_futures = {}
+            deferred_fixes = []
+            for fix_plan in fix_plans:
+                schedule_fix(fix_plan)
+
+    return fixed_file_names
 
-        print(f"We are now trying to fix for acceptance test {test_id}.")
-        print(f"Error message:\n{error_message}\n")
-        for i, option in enumerate(option_collection.options):
-            print(f"Fix {i + 1} - {option.file_name}:")
-            print(option.observation)
-            print(option.how_to_fix)
-            print()
-        print(f"Fix {len(option_collection.options) + 1} - Specify a fix manually.")
 
+def select_source_code_fix_option(
+    test_id: str, error_message: str, option_collection: SourceCodeFixOptionSet
+) -> SourceCodeFixOption:
+    print(f"We are now trying to fix for acceptance test {test_id}.")
+    print(f"Error message:\n{error_message}\n")
+    for i, option in enumerate(option_collection.options):
+        print(f"Fix {i + 1} - {option.file_name}:")
+        print(option.observation)
+        print(option.how_to_fix)
+        print()
+    print(f"Fix {len(option_collection.options) + 1} - Specify a fix manually.")
+
+    selected_fix_idx = input(
+        "Which fix do you want to apply? (Enter a number): "
+    ).strip()
+    while (
+        not selected_fix_idx.isdigit()
+        or int(selected_fix_idx) > len(option_collection.options) + 1
+    ):
         selected_fix_idx = input(
-            "Which fix do you want to apply? (Enter a number): "
-        ).strip()
-        while (
-            not selected_fix_idx.isdigit()
-            or int(selected_fix_idx) > len(option_collection.options) + 1
-        ):
-            selected_fix_idx = input(
-                f"Invalid input. Please enter a number between 1 and "
-                f"{len(option_collection.options) + 1}: "
+            f"Invalid input. Please enter a number between 1 and "
+            f"{len(option_collection.options) + 1}: "
+        )
+
+    if int(selected_fix_idx) == len(option_collection.options) + 1:
+        print("Please specify a fix manually.")
+        print("File name:")
+        file_name = input()
+        print("Observation:")
+        observation = input()
+        print("How to fix:")
+        how_to_fix = input()
+        return SourceCodeFixOption(
+            file_name=file_name,
+            observation=observation,
+            how_to_fix=how_to_fix,
+        )
+    return option_collection.options[int(selected_fix_idx) - 1]
+
+
+@traced
+def select_source_code_fix_speculatively(
+    runner: AsyncRunner,
+    model: ChatModel,
+    option_collection: SourceCodeFixOptionSet,
+    test_id: str,
+    test_file_names: list[str],
+    error_message: str,
+    specifications_text: str,
+    public_interface_document: PublicInterfaceDocument,
+) -> Optional[SourceCodeFix]:
+    options = option_collection.options
+    logging.info(f"Evaluating {len(options)} fixes for {test_id}.")
+
+    fix_futures = {
+        runner.submit(
+            gen_source_code_fix_from_plan(
+                model,
+                option,
+                option.file_name,
+                test_file_names[0],
+                error_message,
+                specifications_text,
+                public_interface_document,
             )
+        ): i
+        for i, option in enumerate(options)
+    }
+    max_workers = max(1, get_available_cpu_count() // max(1, len(options)))
+    # Every fix runs the tests affected by any of the fixes, so that their
+    # failure counts can be compared.
+    changed_file_names = sorted(
+        {option.file_name for option in options} | set(test_file_names)
+    )
 
-        if int(selected_fix_idx) == len(option_collection.options) + 1:
-            print("Please specify a fix manually.")
-            print("File name:")
-            file_name = input()
-            print("Observation:")
-            observation = input()
-            print("How to fix:")
-            how_to_fix = input()
-            option = SourceCodeFixOption(
-                file_name=file_name,
-                observation=observation,
-                how_to_fix=how_to_fix,
+    # Each fix is tested in its own worktree as soon as it has been generated.
+    evaluation_futures = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(options))) as executor:
+        for fix_future in as_completed(fix_futures):
+            i = fix_futures[fix_future]
+            try:
+                source_code_fix = fix_future.result()
+            except Exception as e:
+                logging.warning(f"Could not generate fix {i + 1} for {test_id}: {e}")
+                continue
+            # Evaluations are traced as part of the enclosing span.
+            evaluation_future = executor.submit(
+                contextvars.copy_context().run,
+                count_failures_with_fix,
+                source_code_fix,
+                changed_file_names,
+                str(i + 1),
+                max_workers,
             )
-        else:
-            option = option_collection.options[int(selected_fix_idx) - 1]
-
-        source_code_fix = gen_source_code_fix_from_plan(
-            model,
-            option,
-            option.file_name,
-            test_file_name,
-            error_message,
-            specifications_text,
-            public_interface_document,
+            evaluation_futures[evaluation_future] = (i, source_code_fix)
+
+    results = []
+    for evaluation_future, (i, source_code_fix) in evaluation_futures.items():
+        failure_count = evaluation_future.result()
+        logging.info(
+            f"Fix {i + 1} - {source_code_fix.file_name}: "
+            f"{failure_count} failing tests."
         )
+        results.append((failure_count, i, source_code_fix))
 
-        apply_source_code_fix(source_code_fix)
-        fixed_file_names.append(source_code_fix.file_name)
+    if not results:
+        return None
+    failure_count, i, source_code_fix = min(results, key=lambda result: result[:2])
+    logging.info(f"Selected fix {i + 1} for {test_id}.")
+    return source_code_fix
 
-    return fixed_file_names
+
+@traced
+def count_failures_with_fix(
+    source_code_fix: SourceCodeFix,
+    changed_file_names: list[str],
+    worktree_name: str,
+    max_workers: int,
+) -> int:
+    worktree_dir = create_worktree(worktree_name)
+    try:
+        write_worktree_file(
+            worktree_dir, source_code_fix.file_name, source_code_fix.code
+        )
+        failure_count = 0
+        for test_pattern in [
+            f"{UNIT_TEST_PREFIX}*.py",
+            f"{ACCEPTANCE_TEST_PREFIX}*.py",
+        ]:
+            # Every failure is counted, not only the first of each test file.
+            test_failures = execute_all_tests(
+                test_pattern,
+                max_workers=max_workers,
+                changed_file_names=changed_file_names,
+                src_dir=worktree_dir,
+                failfast=False,
+            )
+            failure_count += len(test_failures.keys() - {RAW_ALL_TEST_ID})
+        return failure_count
+    finally:
+        remove_worktree(worktree_dir)
 
 
-def suggest_source_code_fixes(
-    model: ChatOpenAI,
-    source_code_vector_db: FAISS,
+@traced
+async def suggest_source_code_fixes(
+    model: ChatModel,
+    source_code_retriever: BaseRetriever,
     public_interface_document: PublicInterfaceDocument,
     test_file_name: str,
     error_message: str,
@@ -107,11 +304,12 @@ def suggest_source_code_fixes(
 ) -> SourceCodeFixOptionSet:
     logging.info(f"Generating source code fix for {test_file_name}.")
 
-    source_code_docs = source_code_vector_db.similarity_search(error_message, k=3)
+    source_code_docs = await asyncio.to_thread(
+        select_fix_context_documents, source_code_retriever, error_message
+    )
     source_code_dataset = "\n".join(
         [
-            f"{os.path.basename(doc.metadata['source'])}\n"
-            f"```\n{doc.page_content}\n```\n"
+            f"{get_source_code_document_title(doc)}\n```\n{doc.page_content}\n```\n"
             for doc in source_code_docs
         ]
     )
@@ -119,7 +317,9 @@ def suggest_source_code_fixes(
     test_code = open(get_src_file_path(test_file_name)).read()
 
     output_parser = StrictPydanticOutputParser(pydantic_object=SourceCodeFixOptionSet)
-    prompt = load_prompt(get_prompt_file_path("suggest_test_fixes.yaml")).format(
+    prompt = format_prompt(
+        "suggest_test_fixes.yaml",
+        ["public_interface_document", "source_code_dataset", "error_message"],
         error_message=raw_all_test_log,
         test_file=test_file_name,
         test_code=test_code,
@@ -127,13 +327,90 @@ def suggest_source_code_fixes(
         source_code_dataset=source_code_dataset,
         format_instructions=output_parser.get_format_instructions(),
     )
-    output = execute_model(model, prompt)
+    output = await execute_model_async(model, prompt)
     source_code_fix = output_parser.parse(output)
     return source_code_fix
 
 
-def gen_source_code_fix_from_plan(
-    model: ChatOpenAI,
+def select_fix_context_documents(
+    source_code_retriever: BaseRetriever, error_message: str
+) -> list[Document]:
+    # The code around the traceback goes first; retrieved code fills the rest
+    # of the budget.
+    selected_docs = []
+    token_count = 0
+    traceback_docs = get_traceback_documents(error_message)
+    for doc in traceback_docs:
+        doc = fit_document(doc, FIX_CONTEXT_TOKEN_BUDGET - token_count)
+        if doc is not None:
+            selected_docs.append(doc)
+            token_count += count_tokens(doc.page_content)
+    traceback_doc_count = len(selected_docs)
+
+    if token_count < FIX_CONTEXT_TOKEN_BUDGET:
+        for doc in source_code_retriever.get_relevant_documents(error_message):
+            if any(overlap_documents(doc, selected) for selected in selected_docs):
+                continue
+            doc = fit_document(doc, FIX_CONTEXT_TOKEN_BUDGET - token_count)
+            if doc is not None:
+                selected_docs.append(doc)
+                token_count += count_tokens(doc.page_content)
+
+    logging.info(
+        f"Selected {traceback_doc_count} of {len(traceback_docs)} traceback symbols "
+        f"and {len(selected_docs) - traceback_doc_count} retrieved documents "
+        f"({token_count} tokens)."
+    )
+    return selected_docs
+
+
+def fit_document(doc: Document, token_budget: int) -> Optional[Document]:
+    # A document over the budget is cut to the whole lines that fit, so a large
+    # file still shows its beginning.
+    if count_tokens(doc.page_content) <= token_budget:
+        return doc
+    content = truncate_to_token_count(doc.page_content, max(token_budget, 0))
+    content = content[: content.rfind("\n") + 1]
+    if content.strip() == "":
+        return None
+    start_line, _ = get_document_line_range(doc)
+    return Document(
+        page_content=content,
+        metadata={**doc.metadata, "end_line": start_line + content.count("\n") - 1},
+    )
+
+
+def overlap_documents(doc: Document, other_doc: Document) -> bool:
+    if os.path.abspath(doc.metadata["source"]) != os.path.abspath(
+        other_doc.metadata["source"]
+    ):
+        return False
+    start_line, end_line = get_document_line_range(doc)
+    other_start_line, other_end_line = get_document_line_range(other_doc)
+    return start_line <= other_end_line and other_start_line <= end_line
+
+
+def get_document_line_range(doc: Document) -> tuple[float, float]:
+    # Documents without a line range cover the whole file.
+    return doc.metadata.get("start_line", 1), doc.metadata.get("end_line", math.inf)
+
+
+def get_source_code_document_title(doc: Document) -> str:
+    file_name = os.path.basename(doc.metadata["source"])
+    if "qualified_name" not in doc.metadata:
+        if "end_line" not in doc.metadata:
+            return file_name
+        start_line, end_line = get_document_line_range(doc)
+        return f"{file_name} (lines {start_line}-{end_line})"
+    return (
+        f"{file_name} ({doc.metadata['qualified_name']}, "
+        f"lines {doc.metadata['start_line']}-{doc.metadata['end_line']})"
+    )
+
+
+@traced
+async def gen_source_code_fix_from_plan(
+    model: ChatModel,
     source_code_fix_option: SourceCodeFixOption,
     fixed_file_name: str,
     test_file_name: str,
@@ -147,35 +424,70 @@ def gen_source_code_fix_from_plan(
     test_code = open(get_src_file_path(test_file_name)).read()
 
     plan = f"{source_code_fix_option.observation}\n{source_code_fix_option.how_to_fix}"
-    output_parser = StrictPydanticOutputParser(pydantic_object=SourceCodeFix)
-    prompt = load_prompt(get_prompt_file_path("fix_test_errors.yaml")).format(
+    relevant_public_interface_document = get_relevant_public_interface_document(
+        public_interface_document, [fixed_file_name, test_file_name]
+    )
+    prompt_sections = dict(
         plan=plan,
         fixed_file=fixed_file_name,
         fixed_code=fixed_code,
         test_file=test_file_name,
         test_code=test_code,
         error_message=error_message,
-        public_interface_document=public_interface_document.json(),
+        public_interface_document=relevant_public_interface_document.json(),
         specifications=specifications_text,
+    )
+    if get_edit_format() == EDIT_FORMAT_SEARCH_REPLACE:
+        prompt = format_prompt(
+            "fix_test_errors.yaml",
+            ["public_interface_document", "specifications"],
+            format_instructions=get_prompt_template("edit_block_format.yaml").format(),
+            **prompt_sections,
+        )
+        edited_code = apply_model_edits(
+            fixed_code, await execute_model_async(model, prompt)
+        )
+        if edited_code is not None and edited_code != fixed_code:
+            return SourceCodeFix(
+                description=plan, file_name=fixed_file_name, code=edited_code
+            )
+
+    output_parser = StrictPydanticOutputParser(pydantic_object=SourceCodeFix)
+    prompt = format_prompt(
+        "fix_test_errors.yaml",
+        ["public_interface_document", "specifications"],
         format_instructions=output_parser.get_format_instructions(),
+        **prompt_sections,
     )
-    output = execute_model(model, prompt)
+    output = await execute_model_async(model, prompt)
     source_code_fix = output_parser.parse(output)
     return source_code_fix
 
 
+@traced
 def apply_source_code_fix(source_code_fix: SourceCodeFix) -> None:
-    with open(get_src_file_path(source_code_fix.file_name), "w") as f:
+    file_path = get_src_file_path(source_code_fix.file_name)
+    source_code = open(file_path).read() if os.path.exists(file_path) else ""
+    with open(file_path, "w") as f:
         f.write(source_code_fix.code)
+    get_symbol_index().update_file(source_code_fix.file_name)
+    record_file_changes([file_path])
 
-    with open(get_doc_file_path(TEST_LOG_FILE_NAME), "a") as f:
-        f.writelines(
-            [
-                f"\nFixed {source_code_fix.file_name}.\n",
-                f"\n```\n{source_code_fix.code}\n```\n",
-                "".join(["*" for _ in range(80)]),
-                "\n",
-            ]
-        )
+    # Only the diff is logged; the fixed file is in the workspace.
+    diff = difflib.unified_diff(
+        source_code.splitlines(), source_code_fix.code.splitlines(), lineterm=""
+    )
+    fixed_at = time.time()
+    get_test_log().write_record(
+        {
+            "kind": TEST_LOG_SOURCE_CODE_FIX,
+            "file_name": source_code_fix.file_name,
+            "fixed_at": fixed_at,
+            "diff": "\n".join(diff),
+        },
+        kind=TEST_LOG_SOURCE_CODE_FIX,
+        file_name=source_code_fix.file_name,
+        recorded_at=fixed_at,
+    )
 
     logging.info(f"Fixed {source_code_fix.file_name}.")
@@ -1,49 +1,69 @@
 import logging
 import os
 
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import load_prompt
+from checkpoint import (
+    complete_stage,
+    get_completed_stage,
+    hash_stage_inputs,
+    record_file_changes,
+)
+from class_diagram import extract_class_diagram
 from parsers.strict_pydantic_output_parser import StrictPydanticOutputParser
+from prompt_registry import get_prompt_template
 from schema import File, PublicInterfaceDocument
+from tracing import traced
 from util import (
     PUBLIC_INTERFACE_DOCUMENT_NAME,
+    ChatModel,
     execute_model,
     get_acceptance_test_file_name,
     get_doc_file_path,
-    get_prompt_file_path,
     get_src_file_path,
+    map_concurrently,
 )
 
+llm_class_diagram_fallback = False
+
+
+def set_llm_class_diagram_fallback(enabled: bool) -> None:
+    global llm_class_diagram_fallback
+    llm_class_diagram_fallback = enabled
 
+
+@traced
 def generate_public_interface_document(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
 ) -> PublicInterfaceDocument:
     doc_file_path = get_doc_file_path(PUBLIC_INTERFACE_DOCUMENT_NAME)
-    if os.path.exists(doc_file_path):
+    input_hash = hash_stage_inputs(specifications_text)
+    if (
+        get_completed_stage("public_interface_document", input_hash, [doc_file_path])
+        is not None
+    ):
         logging.info(f"Reusing {doc_file_path}.")
         return PublicInterfaceDocument.parse_file(doc_file_path)
 
     logging.info("Generating public interface document.")
 
     output_parser = StrictPydanticOutputParser(pydantic_object=PublicInterfaceDocument)
-    prompt = load_prompt(
-        get_prompt_file_path("gen_public_interface_document.yaml")
-    ).format(
+    prompt = get_prompt_template("gen_public_interface_document.yaml").format(
         specifications=specifications_text,
         format_instructions=output_parser.get_format_instructions(),
     )
     output = execute_model(model, prompt)
     public_interface_document = output_parser.parse(output)
 
-    with open(get_doc_file_path(PUBLIC_INTERFACE_DOCUMENT_NAME), "w") as f:
+    with open(doc_file_path, "w") as f:
         f.write(public_interface_document.json())
+    complete_stage("public_interface_document", input_hash, [doc_file_path])
 
     return public_interface_document
 
 
+@traced
 def update_public_interface_document(
-    model: ChatOpenAI,
+    model: ChatModel,
     public_interface_document: PublicInterfaceDocument,
     file_names: list[str] = None,
     force: bool = False,
@@ -66,30 +86,45 @@ def update_public_interface_document(
         ]
     )
 
-    for file in files:
-        logging.info(f"Updating public interface document for {file.name}.")
-
-        with open(get_src_file_path(file.name)) as f:
-            source_code = f.read()
-
-        output_parser = StrictPydanticOutputParser(pydantic_object=File)
-        prompt = load_prompt(
-            get_prompt_file_path("update_public_interface_document.yaml")
-        ).format(
-            public_interface_document=file.json(),
-            file=file.name,
-            source_code=source_code,
-            format_instructions=output_parser.get_format_instructions(),
-        )
-        output = execute_model(model, prompt)
-        updated_file = output_parser.parse(output)
-
+    updated_files = map_concurrently(
+        lambda file: update_file_interface(model, file), files
+    )
+    for updated_file in updated_files:
         public_interface_document.files = [
             updated_file if f.name == updated_file.name else f
             for f in public_interface_document.files
         ]
 
-    with open(get_doc_file_path(PUBLIC_INTERFACE_DOCUMENT_NAME), "w") as f:
+    doc_file_path = get_doc_file_path(PUBLIC_INTERFACE_DOCUMENT_NAME)
+    with open(doc_file_path, "w") as f:
         f.write(public_interface_document.json())
+    record_file_changes([doc_file_path])
 
     return public_interface_document
+
+
+def update_file_interface(model: ChatModel, file: File) -> File:
+    with open(get_src_file_path(file.name)) as f:
+        source_code = f.read()
+
+    class_diagram = extract_class_diagram(source_code)
+    if class_diagram is not None:
+        logging.info(f"Extracted the class diagram of {file.name}.")
+        return file.model_copy(update={"class_diagram": class_diagram})
+    if not llm_class_diagram_fallback:
+        logging.warning(
+            f"Keeping the class diagram of {file.name} because it could not be parsed."
+        )
+        return file
+
+    logging.info(f"Updating public interface document for {file.name}.")
+
+    output_parser = StrictPydanticOutputParser(pydantic_object=File)
+    prompt = get_prompt_template("update_public_interface_document.yaml").format(
+        public_interface_document=file.json(),
+        file=file.name,
+        source_code=source_code,
+        format_instructions=output_parser.get_format_instructions(),
+    )
+    output = execute_model(model, prompt)
+    return output_parser.parse(output)
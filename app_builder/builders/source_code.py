@@ -1,32 +1,82 @@
 import difflib
+import hashlib
+import json
 import logging
 import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
-from langchain.chat_models import ChatOpenAI
-from langchain.document_loaders import DirectoryLoader, TextLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.prompts import load_prompt
-from langchain.vectorstores import FAISS
-from parsers.code_output_parser import CodeOutputParser
-from schema import PublicInterfaceDocument
+from checkpoint import (
+    complete_stage,
+    get_completed_stage,
+    get_stage_output_hash,
+    hash_stage_inputs,
+    record_file_changes,
+)
+from edit_blocks import apply_model_edits, get_edit_format
+from langchain.schema import BaseRetriever, Document, OutputParserException
+from parsers.code_output_parser import CodeOutputParser, IncrementalCodeOutputParser
+from parsers.strict_pydantic_output_parser import StrictPydanticOutputParser
+from prompt_assembly import format_prompt, get_relevant_public_interface_document
+from prompt_registry import get_prompt_template
+from retrieval.chunking import split_python_source
+from schema import AffectedFileSet, PublicInterfaceDocument
+from symbol_index import get_symbol_index
+from tracing import traced
 from util import (
     ACCEPTANCE_TEST_PREFIX,
-    SRC_DIR,
+    EDIT_FORMAT_SEARCH_REPLACE,
+    EMBEDDING_CACHE_DIR_NAME,
+    INDEX_MODE_AST,
+    INDEX_MODE_FILE,
+    MAX_LOADED_SOURCE_CODE_INDEXES,
+    RETRIEVER_BM25,
+    RETRIEVER_DENSE,
+    SOURCE_CODE_INDEX_DIR_NAME,
+    SOURCE_CODE_SEARCH_K,
     UNIT_TEST_PREFIX,
+    ChatModel,
     execute_model,
-    get_prompt_file_path,
+    execute_model_streaming,
+    get_cache_file_path,
+    get_doc_file_path,
+    get_embedding_model,
+    get_src_dir,
     get_src_file_path,
     get_unit_test_file_name,
 )
 
+if TYPE_CHECKING:
+    from langchain.vectorstores import FAISS
+
+# Vector databases stay loaded between builds, e.g. of a long-running service.
+loaded_indexes: OrderedDict[tuple[str, str], tuple["FAISS", dict]] = OrderedDict()
+loaded_indexes_lock = threading.Lock()
 
+
+@traced
 def generate_source_code(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
     public_interface_document: PublicInterfaceDocument,
 ) -> None:
     for file in public_interface_document.files:
-        if os.path.exists(get_src_file_path(file.name)):
+        stage = f"source_code:{file.name}"
+        input_hash = hash_stage_inputs(
+            specifications_text,
+            file.name,
+            get_stage_output_hash(
+                "public_interface_document",
+                f"unit_test:{get_unit_test_file_name(file.name)}",
+            ),
+        )
+        if (
+            get_completed_stage(stage, input_hash, [get_src_file_path(file.name)])
+            is not None
+        ):
             logging.info(f"Reusing {file.name}.")
             continue
 
@@ -39,43 +89,249 @@ def generate_source_code(
             test_code = open(get_src_file_path(test_file_name)).read()
 
         output_parser = CodeOutputParser()
-        prompt = load_prompt(get_prompt_file_path("gen_source_code.yaml")).format(
+        prompt = format_prompt(
+            "gen_source_code.yaml",
+            ["public_interface_document", "specifications"],
             specifications=specifications_text,
             public_interface_document=public_interface_document.json(),
             test_code=test_code,
             format_instructions=output_parser.get_format_instructions(),
             file=file.name,
         )
-        output = execute_model(model, prompt)
-        source_code = output_parser.parse(output)
+        stream_code_output(model, prompt, file.name)
+        complete_stage(stage, input_hash, [get_src_file_path(file.name)])
 
-        with open(get_src_file_path(file.name), "w") as f:
-            f.write(source_code)
 
+def stream_code_output(
+    model: ChatModel, prompt: str, file_name: Optional[str] = None
+) -> str:
+    output_parser = IncrementalCodeOutputParser()
+    if file_name is None:
+        execute_model_streaming(model, prompt, output_parser.feed)
+        return output_parser.finish()
 
-def create_source_code_vector_db() -> FAISS:
-    logging.info("Creating source code vector database.")
+    # Code is written to a partial file as it arrives and moved into place once
+    # the code block is complete.
+    file_path = get_src_file_path(file_name)
+    partial_file_path = f"{file_path}.partial"
+    try:
+        with open(partial_file_path, "w", buffering=1) as f:
+            output_parser.on_code = f.write
+            execute_model_streaming(model, prompt, output_parser.feed)
+            code = output_parser.finish()
+            if code == "":
+                f.truncate(0)
+        os.replace(partial_file_path, file_path)
+        get_symbol_index().update_file(file_name)
+    except BaseException:
+        if os.path.exists(partial_file_path):
+            os.remove(partial_file_path)
+        raise
+    return code
 
-    loader = DirectoryLoader(
-        SRC_DIR,
-        glob="**/*.py",
-        show_progress=True,
-        use_multithreading=True,
-        loader_cls=TextLoader,
+
+@traced
+def create_source_code_vector_db(
+    index_mode: str = INDEX_MODE_FILE,
+) -> Optional["FAISS"]:
+    from langchain.embeddings import CacheBackedEmbeddings
+    from langchain.storage import LocalFileStore
+    from langchain.vectorstores import FAISS
+
+    logging.info(f"Creating source code vector database ({index_mode} mode).")
+
+    underlying_embeddings = get_embedding_model()
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        underlying_embeddings,
+        LocalFileStore(get_cache_file_path(EMBEDDING_CACHE_DIR_NAME)),
+        namespace=underlying_embeddings.model,
     )
-    docs = loader.load()
+
+    index_dir = get_doc_file_path(SOURCE_CODE_INDEX_DIR_NAME)
+    manifest_path = os.path.join(index_dir, "manifest.json")
+    loaded_index_key = (index_dir, underlying_embeddings.model)
+    db, manifest = None, {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            with loaded_indexes_lock:
+                loaded_db, loaded_manifest = loaded_indexes.get(
+                    loaded_index_key, (None, None)
+                )
+            # The loaded index is reused unless the index on disk has changed.
+            if loaded_manifest == manifest:
+                db = loaded_db
+            else:
+                db = FAISS.load_local(index_dir, embeddings)
+            if manifest.pop("index_mode", None) != index_mode:
+                db, manifest = None, {}
+        except Exception:
+            logging.warning("Discarding unreadable source code vector database.")
+            db, manifest = None, {}
+
+    file_hashes = {
+        file_name: hash_source_file(file_name) for file_name in list_source_files()
+    }
+    stale_file_names = [
+        file_name
+        for file_name, entry in manifest.items()
+        if file_hashes.get(file_name) != entry["hash"]
+    ]
+    changed_file_names = [
+        file_name
+        for file_name, file_hash in file_hashes.items()
+        if file_name not in manifest or manifest[file_name]["hash"] != file_hash
+    ]
+    logging.info(
+        f"Re-indexing {len(changed_file_names)} of {len(file_hashes)} source files "
+        f"({len(stale_file_names)} stale)."
+    )
+
+    stale_ids = [id for name in stale_file_names for id in manifest.pop(name)["ids"]]
+    if db is not None and stale_ids:
+        db.delete(stale_ids)
+
+    docs, ids = [], []
+    for file_name in changed_file_names:
+        file_docs = load_source_code_documents(file_name, index_mode)
+        file_ids = [f"{file_name}#{i}" for i in range(len(file_docs))]
+        manifest[file_name] = {"hash": file_hashes[file_name], "ids": file_ids}
+        docs.extend(file_docs)
+        ids.extend(file_ids)
+
+    if db is None and not docs:
+        # FAISS cannot create an index without documents.
+        logging.info("No source files to index.")
+        return None
+    if db is None:
+        db = FAISS.from_documents(docs, embeddings, ids=ids)
+    elif docs:
+        db.add_documents(docs, ids=ids)
+
+    if docs or stale_ids or not os.path.exists(manifest_path):
+        shutil.rmtree(index_dir, ignore_errors=True)
+        db.save_local(index_dir)
+        with open(manifest_path, "w") as f:
+            json.dump({"index_mode": index_mode, **manifest}, f)
+
+    with loaded_indexes_lock:
+        loaded_indexes[loaded_index_key] = (db, {"index_mode": index_mode, **manifest})
+        loaded_indexes.move_to_end(loaded_index_key)
+        while len(loaded_indexes) > MAX_LOADED_SOURCE_CODE_INDEXES:
+            loaded_indexes.popitem(last=False)
+    return db
+
+
+@traced
+def create_source_code_retriever(
+    retriever_type: str = RETRIEVER_DENSE,
+    index_mode: str = INDEX_MODE_FILE,
+) -> BaseRetriever:
+    k = SOURCE_CODE_SEARCH_K[index_mode]
+    if retriever_type == RETRIEVER_DENSE:
+        return create_dense_retriever(index_mode, k)
+
+    from retrieval.bm25 import BM25Index, SourceCodeBM25Retriever
+    from retrieval.hybrid import SourceCodeEnsembleRetriever
+
+    logging.info(f"Creating source code BM25 index ({index_mode} mode).")
     docs = [
         doc
-        for doc in docs
-        if UNIT_TEST_PREFIX not in doc.metadata["source"]
-        and ACCEPTANCE_TEST_PREFIX not in doc.metadata["source"]
+        for file_name in list_source_files()
+        for doc in load_source_code_documents(file_name, index_mode)
     ]
-    db = FAISS.from_documents(docs, OpenAIEmbeddings())
-    return db
+    bm25_retriever = SourceCodeBM25Retriever(index=BM25Index(docs), k=k)
+    if retriever_type == RETRIEVER_BM25:
+        return bm25_retriever
+
+    try:
+        dense_retriever = create_dense_retriever(index_mode, k)
+    except Exception as e:
+        logging.warning(f"Falling back to BM25 because embeddings failed: {e}")
+        return bm25_retriever
+    return SourceCodeEnsembleRetriever(
+        retrievers=[bm25_retriever, dense_retriever], weights=[0.5, 0.5], k=k
+    )
+
 
+def create_dense_retriever(index_mode: str, k: int) -> BaseRetriever:
+    db = create_source_code_vector_db(index_mode)
+    if db is None:
+        from retrieval.bm25 import BM25Index, SourceCodeBM25Retriever
 
+        # Without source files, nothing is retrieved.
+        return SourceCodeBM25Retriever(index=BM25Index([]), k=k)
+    return db.as_retriever(search_kwargs={"k": k})
+
+
+def list_source_files() -> list[str]:
+    src_dir = get_src_dir()
+    return sorted(
+        str(path.relative_to(src_dir))
+        for path in Path(src_dir).glob("**/*.py")
+        if not path.name.startswith(UNIT_TEST_PREFIX)
+        and not path.name.startswith(ACCEPTANCE_TEST_PREFIX)
+    )
+
+
+def hash_source_file(file_name: str) -> str:
+    with open(get_src_file_path(file_name), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_source_code_documents(file_name: str, index_mode: str) -> list[Document]:
+    file_path = get_src_file_path(file_name)
+    with open(file_path) as f:
+        source_code = f.read()
+    if index_mode == INDEX_MODE_AST:
+        return split_python_source(file_path, source_code)
+    return [Document(page_content=source_code, metadata={"source": file_path})]
+
+
+@traced
+def select_files_to_modify(
+    model: ChatModel,
+    specifications_text: str,
+    change_request: str,
+    public_interface_document: PublicInterfaceDocument,
+) -> list[str]:
+    logging.info("Selecting files to modify.")
+
+    file_names = [file.name for file in public_interface_document.files]
+    output_parser = StrictPydanticOutputParser(pydantic_object=AffectedFileSet)
+    prompt = format_prompt(
+        "select_files_to_modify.yaml",
+        ["public_interface_document", "specifications"],
+        specifications=specifications_text,
+        change_request=change_request,
+        public_interface_document=public_interface_document.json(),
+        format_instructions=output_parser.get_format_instructions(),
+    )
+    try:
+        affected_file_set = output_parser.parse(execute_model(model, prompt))
+    except OutputParserException as e:
+        logging.warning(f"Modifying all files because the selection failed: {e}")
+        return file_names
+
+    unknown_file_names = set(affected_file_set.file_names) - set(file_names)
+    if unknown_file_names:
+        logging.warning(f"Ignoring unknown files: {sorted(unknown_file_names)}")
+    selected_file_names = [
+        file_name
+        for file_name in file_names
+        if file_name in affected_file_set.file_names
+    ]
+    logging.info(
+        f"Selected {len(selected_file_names)} of {len(file_names)} files to modify: "
+        f"{selected_file_names}"
+    )
+    return selected_file_names
+
+
+@traced
 def modify_source_code(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
     change_request: str,
     file_name: str,
@@ -86,24 +342,43 @@ def modify_source_code(
     with open(get_src_file_path(file_name), "r") as f:
         source_code = f.read()
 
-    output_parser = CodeOutputParser()
-    prompt = load_prompt(get_prompt_file_path("modify_source_code.yaml")).format(
+    relevant_public_interface_document = get_relevant_public_interface_document(
+        public_interface_document, [file_name]
+    )
+    prompt_sections = dict(
         specifications=specifications_text,
         change_request=change_request,
-        public_interface_document=public_interface_document.json(),
-        format_instructions=output_parser.get_format_instructions(),
+        public_interface_document=relevant_public_interface_document.json(),
         file=file_name,
         source_code=source_code,
     )
-    output = execute_model(model, prompt)
-    fixed_source_code = output_parser.parse(output)
+    fixed_source_code = None
+    if get_edit_format() == EDIT_FORMAT_SEARCH_REPLACE:
+        prompt = format_prompt(
+            "modify_source_code.yaml",
+            ["public_interface_document", "specifications"],
+            format_instructions=get_prompt_template("edit_block_format.yaml").format(),
+            **prompt_sections,
+        )
+        fixed_source_code = apply_model_edits(source_code, execute_model(model, prompt))
+    if fixed_source_code is None:
+        output_parser = CodeOutputParser()
+        prompt = format_prompt(
+            "modify_source_code.yaml",
+            ["public_interface_document", "specifications"],
+            format_instructions=output_parser.get_format_instructions(),
+            **prompt_sections,
+        )
+        fixed_source_code = stream_code_output(model, prompt)
 
-    if fixed_source_code.strip() == "":
+    if fixed_source_code.strip() == "" or fixed_source_code == source_code:
         logging.info(f"No changes to source code for {file_name}.")
         return False
     else:
         with open(get_src_file_path(file_name), "w") as f:
             f.write(fixed_source_code)
+        get_symbol_index().update_file(file_name)
+        record_file_changes([get_src_file_path(file_name)])
         logging.info(f"Modified source code for {file_name}.")
 
         diff = difflib.unified_diff(
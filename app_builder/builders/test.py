@@ -1,30 +1,62 @@
+import contextvars
 import difflib
-import json
+import fnmatch
 import logging
 import os
-import signal
 import subprocess
-import time
+from typing import Optional
 
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import load_prompt
+from builders.source_code import stream_code_output
+from checkpoint import (
+    complete_stage,
+    get_completed_stage,
+    get_stage_output_hash,
+    hash_stage_inputs,
+    record_file_changes,
+)
+from edit_blocks import apply_model_edits, get_edit_format
 from parsers.code_output_parser import CodeOutputParser
 from parsers.strict_pydantic_output_parser import StrictPydanticOutputParser
+from prompt_assembly import format_prompt, get_relevant_public_interface_document
+from prompt_registry import get_prompt_template
 from schema import PublicInterfaceDocument, TestScenarioSet
+from test_events import (
+    TEST_ERRORED,
+    TEST_FAILED,
+    TestEvent,
+    TestEventHandler,
+    collect_test_failures,
+    run_test_processes,
+)
+from test_impact import select_affected_test_files
+from test_worker import TestWorker
+from tracing import traced
 from util import (
     ACCEPTANCE_TEST_SCENARIOS_FILE_NAME,
+    EDIT_FORMAT_SEARCH_REPLACE,
     SCRIPT_DIR,
+    TEST_OUTPUT_MAX_CHARS,
+    TEST_TIMEOUT_SECONDS,
+    ChatModel,
     execute_model,
     get_acceptance_test_file_name,
     get_doc_file_path,
-    get_prompt_file_path,
+    get_src_dir,
     get_src_file_path,
     get_unit_test_file_name,
+    get_workspace_dir,
 )
 
+# Each batch build has its own workspace, so each has its own test worker.
+test_worker: contextvars.ContextVar[Optional[TestWorker]] = contextvars.ContextVar(
+    "test_worker", default=None
+)
+max_test_output_chars = TEST_OUTPUT_MAX_CHARS
 
+
+@traced
 def generate_unit_tests(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
     public_interface_document: PublicInterfaceDocument,
 ) -> None:
@@ -36,41 +68,54 @@ def generate_unit_tests(
     ]
     for file in tested_files:
         test_file_name = get_unit_test_file_name(file.name)
-        if os.path.exists(get_src_file_path(test_file_name)):
+        stage = f"unit_test:{test_file_name}"
+        input_hash = hash_stage_inputs(
+            specifications_text,
+            file.name,
+            get_stage_output_hash("public_interface_document"),
+        )
+        if (
+            get_completed_stage(stage, input_hash, [get_src_file_path(test_file_name)])
+            is not None
+        ):
             logging.info(f"Reusing {test_file_name}.")
             continue
 
         logging.info(f"Generating {test_file_name}.")
 
         output_parser = CodeOutputParser()
-        prompt = load_prompt(get_prompt_file_path("gen_unit_test.yaml")).format(
+        prompt = format_prompt(
+            "gen_unit_test.yaml",
+            ["public_interface_document", "specifications"],
             specifications=specifications_text,
             public_interface_document=public_interface_document.json(),
             file=file.name,
             format_instructions=output_parser.get_format_instructions(),
         )
-        output = execute_model(model, prompt)
-        test_code = output_parser.parse(output)
-
-        with open(get_src_file_path(test_file_name), "w") as f:
-            f.write(test_code)
+        stream_code_output(model, prompt, test_file_name)
+        complete_stage(stage, input_hash, [get_src_file_path(test_file_name)])
 
 
+@traced
 def generate_acceptance_test_scenarios(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
 ) -> TestScenarioSet:
     test_scenarios_file_path = get_doc_file_path(ACCEPTANCE_TEST_SCENARIOS_FILE_NAME)
-    if os.path.exists(test_scenarios_file_path):
+    input_hash = hash_stage_inputs(specifications_text)
+    if (
+        get_completed_stage(
+            "acceptance_test_scenarios", input_hash, [test_scenarios_file_path]
+        )
+        is not None
+    ):
         logging.info(f"Reusing {test_scenarios_file_path}.")
         return TestScenarioSet.parse_file(test_scenarios_file_path)
 
     logging.info("Generating acceptance test scenarios.")
 
     output_parser = StrictPydanticOutputParser(pydantic_object=TestScenarioSet)
-    prompt = load_prompt(
-        get_prompt_file_path("gen_acceptance_test_scenarios.yaml")
-    ).format(
+    prompt = get_prompt_template("gen_acceptance_test_scenarios.yaml").format(
         specifications=specifications_text,
         format_instructions=output_parser.get_format_instructions(),
     )
@@ -79,12 +124,14 @@ def generate_acceptance_test_scenarios(
 
     with open(test_scenarios_file_path, "w") as f:
         f.write(test_scenario_collection.json())
+    complete_stage("acceptance_test_scenarios", input_hash, [test_scenarios_file_path])
 
     return test_scenario_collection
 
 
+@traced
 def generate_acceptance_tests(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
     test_scenario_collection: TestScenarioSet,
     public_interface_document: PublicInterfaceDocument,
@@ -103,49 +150,151 @@ def generate_acceptance_tests(
         test_file_name = get_acceptance_test_file_name(
             test_index, entry_point_file.name
         )
-        if os.path.exists(get_src_file_path(test_file_name)):
+        stage = f"acceptance_test:{test_file_name}"
+        input_hash = hash_stage_inputs(
+            specifications_text,
+            test_scenario.json(),
+            get_stage_output_hash(
+                "public_interface_document", f"source_code:{entry_point_file.name}"
+            ),
+        )
+        if (
+            get_completed_stage(stage, input_hash, [get_src_file_path(test_file_name)])
+            is not None
+        ):
             logging.info(f"Reusing {test_file_name}.")
-            return
+            continue
 
         logging.info(f"Generating {test_file_name}.")
 
         output_parser = CodeOutputParser()
-        prompt = load_prompt(get_prompt_file_path("gen_acceptance_test.yaml")).format(
+        prompt = format_prompt(
+            "gen_acceptance_test.yaml",
+            ["public_interface_document", "specifications"],
             specifications=specifications_text,
             test_scenario=test_scenario.json(),
             public_interface_document=public_interface_document.json(),
             entry_point_source_code=entry_point_source_code,
             format_instructions=output_parser.get_format_instructions(),
         )
-        output = execute_model(model, prompt)
-        test_code = output_parser.parse(output)
+        stream_code_output(model, prompt, test_file_name)
+        complete_stage(stage, input_hash, [get_src_file_path(test_file_name)])
 
-        with open(get_src_file_path(test_file_name), "w") as f:
-            f.write(test_code)
 
+@traced
+def execute_all_tests(
+    file_pattern: str,
+    max_workers: int = None,
+    changed_file_names: list[str] = None,
+    collect_coverage: bool = False,
+    on_test_event: TestEventHandler = None,
+    src_dir: Optional[str] = None,
+    failfast: bool = True,
+) -> dict[str, str]:
+    if src_dir is None:
+        src_dir = get_src_dir()
+    test_file_names = list_test_files(file_pattern, src_dir)
+    if changed_file_names is None:
+        logging.info(f"Executing all tests ({file_pattern}).")
+    else:
+        all_test_file_count = len(test_file_names)
+        test_file_names = select_affected_test_files(
+            test_file_names, changed_file_names, src_dir
+        )
+        logging.info(
+            f"Executing {len(test_file_names)} of {all_test_file_count} test files "
+            f"({file_pattern}) affected by {', '.join(changed_file_names)}."
+        )
+    if max_workers is None:
+        max_workers = get_available_cpu_count()
 
-def execute_all_tests(file_pattern: str) -> dict[str, str]:
-    logging.info(f"Executing all tests ({file_pattern}).")
+    events_by_file = {test_file_name: [] for test_file_name in test_file_names}
 
-    test_script = os.path.join(SCRIPT_DIR, "test.py")
-    try:
-        test_proc = subprocess.Popen(
-            ["python", test_script, file_pattern], text=True, stdout=subprocess.PIPE
+    def handle_test_event(test_file_name: str, event: TestEvent) -> None:
+        events_by_file[test_file_name].append(event)
+        if event["event"] in (TEST_FAILED, TEST_ERRORED):
+            logging.info(f"{event['test_id']} {event['event']}.")
+        if on_test_event is not None:
+            on_test_event(test_file_name, event)
+
+    # The warm worker has modules from the workspace preloaded, so other source
+    # directories always run in fresh interpreters.
+    worker = test_worker.get()
+    if worker is not None and src_dir == worker.src_dir:
+        worker.run_test_files(
+            test_file_names,
+            TEST_TIMEOUT_SECONDS,
+            max_workers,
+            collect_coverage,
+            max_test_output_chars,
+            failfast,
+            handle_test_event,
+        )
+    else:
+        run_test_processes(
+            test_file_names,
+            lambda test_file_name: start_test_process(
+                test_file_name, collect_coverage, src_dir, failfast
+            ),
+            TEST_TIMEOUT_SECONDS,
+            max_workers,
+            handle_test_event,
         )
-        test_proc.wait(timeout=10)
-        test_failures = json.loads(test_proc.stdout.read())
-    except subprocess.TimeoutExpired:
-        test_proc.send_signal(signal.SIGINT)
-        time.sleep(1)
-        test_failures = json.loads(test_proc.stdout.read())
-        test_proc.kill()
-        test_proc.wait()
 
-    return test_failures
+    return collect_test_failures(test_file_names, events_by_file)
+
 
+def set_test_worker(worker: Optional[TestWorker]) -> None:
+    test_worker.set(worker)
 
+
+def set_max_test_output_chars(max_chars: int) -> None:
+    global max_test_output_chars
+    max_test_output_chars = max_chars
+
+
+def start_test_process(
+    test_file_name: str, collect_coverage: bool, src_dir: str, failfast: bool = True
+) -> tuple[subprocess.Popen, int]:
+    read_fd, write_fd = os.pipe()
+    test_script = os.path.join(SCRIPT_DIR, "test.py")
+    test_proc = subprocess.Popen(
+        [
+            "python",
+            test_script,
+            test_file_name,
+            "--event-fd",
+            str(write_fd),
+            "--src-dir",
+            src_dir,
+            "--max-output-chars",
+            str(max_test_output_chars),
+        ]
+        + (["--coverage"] if collect_coverage else [])
+        + ([] if failfast else ["--no-failfast"]),
+        env={**os.environ, "APP_BUILDER_WORKSPACE_DIR": get_workspace_dir()},
+        stdout=subprocess.DEVNULL,
+        pass_fds=(write_fd,),
+    )
+    os.close(write_fd)
+    return test_proc, read_fd
+
+
+def list_test_files(file_pattern: str, src_dir: Optional[str] = None) -> list[str]:
+    if src_dir is None:
+        src_dir = get_src_dir()
+    return sorted(fnmatch.filter(os.listdir(src_dir), file_pattern))
+
+
+def get_available_cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@traced
 def modify_unit_test(
-    model: ChatOpenAI,
+    model: ChatModel,
     specifications_text: str,
     change_request: str,
     source_file_name: str,
@@ -159,26 +308,44 @@ def modify_unit_test(
     with open(get_src_file_path(test_file_name)) as test_file:
         test_code = test_file.read()
 
-    output_parser = CodeOutputParser()
-    prompt = load_prompt(get_prompt_file_path("modify_unit_test.yaml")).format(
+    relevant_public_interface_document = get_relevant_public_interface_document(
+        public_interface_document, [source_file_name, test_file_name]
+    )
+    prompt_sections = dict(
         specifications=specifications_text,
         change_request=change_request,
-        public_interface_document=public_interface_document.json(),
+        public_interface_document=relevant_public_interface_document.json(),
         source_file=source_file_name,
         test_file=test_file_name,
         source_code=source_code,
         test_code=test_code,
-        format_instructions=output_parser.get_format_instructions(),
     )
-    output = execute_model(model, prompt)
-    fixed_test_code = output_parser.parse(output)
+    fixed_test_code = None
+    if get_edit_format() == EDIT_FORMAT_SEARCH_REPLACE:
+        prompt = format_prompt(
+            "modify_unit_test.yaml",
+            ["public_interface_document", "specifications"],
+            format_instructions=get_prompt_template("edit_block_format.yaml").format(),
+            **prompt_sections,
+        )
+        fixed_test_code = apply_model_edits(test_code, execute_model(model, prompt))
+    if fixed_test_code is None:
+        output_parser = CodeOutputParser()
+        prompt = format_prompt(
+            "modify_unit_test.yaml",
+            ["public_interface_document", "specifications"],
+            format_instructions=output_parser.get_format_instructions(),
+            **prompt_sections,
+        )
+        fixed_test_code = stream_code_output(model, prompt)
 
-    if fixed_test_code.strip() == "":
+    if fixed_test_code.strip() == "" or fixed_test_code == test_code:
         logging.info(f"No changes to {test_file_name}.")
         return False
     else:
         with open(get_src_file_path(test_file_name), "w") as f:
             f.write(fixed_test_code)
+        record_file_changes([get_src_file_path(test_file_name)])
         logging.info(f"Modified {test_file_name}.")
 
         diff = difflib.unified_diff(
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class ModelCache:
+    def __init__(
+        self,
+        path: str,
+        max_entries: int,
+        max_bytes: int,
+        max_age_seconds: float,
+        bypass: bool = False,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        # When bypassed, cached responses are ignored but fresh ones are still stored.
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "model_name TEXT NOT NULL, "
+                "temperature REAL NOT NULL, "
+                "prompt_hash TEXT NOT NULL, "
+                "response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL, "
+                "PRIMARY KEY (model_name, temperature, prompt_hash))"
+            )
+        self.evict()
+
+    def get(self, model_name: str, temperature: float, prompt: str) -> Optional[str]:
+        if self.bypass:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT response FROM responses "
+                "WHERE model_name = ? AND temperature = ? AND prompt_hash = ? "
+                "AND created_at >= ?",
+                (
+                    model_name,
+                    temperature,
+                    hash_prompt(prompt),
+                    now - self.max_age_seconds,
+                ),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed_at = ? "
+                "WHERE model_name = ? AND temperature = ? AND prompt_hash = ?",
+                (now, model_name, temperature, hash_prompt(prompt)),
+            )
+        self.hits += 1
+        return row[0]
+
+    def put(
+        self, model_name: str, temperature: float, prompt: str, response: str
+    ) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    model_name,
+                    temperature,
+                    hash_prompt(prompt),
+                    response,
+                    len(response.encode()),
+                    now,
+                    now,
+                ),
+            )
+        self.evict()
+
+    def evict(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (time.time() - self.max_age_seconds,),
+            )
+
+            count, total_size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                return
+
+            # Drop the least recently used responses until both limits are met.
+            rows = self._connection.execute(
+                "SELECT model_name, temperature, prompt_hash, size FROM responses "
+                "ORDER BY accessed_at ASC"
+            ).fetchall()
+            for model_name, temperature, prompt_hash, size in rows:
+                if count <= self.max_entries and total_size <= self.max_bytes:
+                    break
+                self._connection.execute(
+                    "DELETE FROM responses "
+                    "WHERE model_name = ? AND temperature = ? AND prompt_hash = ?",
+                    (model_name, temperature, prompt_hash),
+                )
+                count -= 1
+                total_size -= size
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def hash_prompt(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()
@@ -0,0 +1,167 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from typing import Optional
+
+
+class CheckpointJournal:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.stages = {}
+        # The last recorded hash of each file, which includes changes made to
+        # the file after the stage that created it.
+        self.file_hashes = {}
+        self._lock = threading.Lock()
+        if os.path.exists(file_path):
+            with open(file_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last entry may be cut short by a crash.
+                        logging.warning(f"Ignoring a corrupt entry in {file_path}.")
+                        continue
+                    if "stage" in entry:
+                        self.stages[entry["stage"]] = entry
+                        self.file_hashes.update(entry["outputs"].get("files", {}))
+                    else:
+                        self.file_hashes.update(entry["files"])
+
+    def get_completed_stage(
+        self, stage: str, input_hash: str, file_paths: list[str] = ()
+    ) -> Optional[dict]:
+        entry = self.stages.get(stage)
+        if entry is None:
+            # Outputs reused from a workspace without a journal are adopted.
+            if not file_paths or not all(map(os.path.exists, file_paths)):
+                return None
+            outputs = {"files": {path: hash_file(path) for path in file_paths}}
+            self.complete_stage(stage, input_hash, outputs)
+            return outputs
+        if entry["input_hash"] != input_hash:
+            logging.info(f"Redoing {stage} because its inputs changed.")
+            return None
+        missing_file_paths = [
+            file_path
+            for file_path in entry["outputs"].get("files", {})
+            if not os.path.exists(file_path)
+        ]
+        if missing_file_paths:
+            logging.info(f"Redoing {stage} because {missing_file_paths} are missing.")
+            return None
+        file_hashes = {
+            file_path: hash_file(file_path)
+            for file_path in entry["outputs"].get("files", {})
+        }
+        changed_file_paths = [
+            file_path
+            for file_path, file_hash in file_hashes.items()
+            if file_hash != self.file_hashes.get(file_path)
+        ]
+        if changed_file_paths:
+            # Files edited by hand are kept. The stage is completed again, so the
+            # stages depending on it are redone.
+            logging.info(f"Keeping the changes to {changed_file_paths}.")
+            self.complete_stage(
+                stage, input_hash, {**entry["outputs"], "files": file_hashes}
+            )
+        return self.stages[stage]["outputs"]
+
+    def get_stage_output_hash(self, stages: tuple[str, ...]) -> str:
+        # Each completion has its own id, so depending stages are redone when a
+        # dependency is redone, even if it produced the same files again.
+        with self._lock:
+            entries = [self.stages.get(stage) for stage in stages]
+        return hash_stage_inputs(
+            *[
+                (
+                    ""
+                    if entry is None
+                    else json.dumps(
+                        [entry.get("completion_id"), entry["outputs"].get("files", {})]
+                    )
+                )
+                for entry in entries
+            ]
+        )
+
+    def complete_stage(self, stage: str, input_hash: str, outputs: dict) -> None:
+        entry = {
+            "stage": stage,
+            "completion_id": uuid.uuid4().hex,
+            "input_hash": input_hash,
+            "outputs": outputs,
+        }
+        with self._lock:
+            self._append(entry)
+            self.stages[stage] = entry
+            self.file_hashes.update(outputs.get("files", {}))
+
+    def record_files(self, file_hashes: dict[str, str]) -> None:
+        with self._lock:
+            self._append({"files": file_hashes})
+            self.file_hashes.update(file_hashes)
+
+    def _append(self, entry: dict) -> None:
+        with open(self.file_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# Each batch build has its own workspace, so each has its own journal.
+checkpoint_journal: contextvars.ContextVar[Optional[CheckpointJournal]] = (
+    contextvars.ContextVar("checkpoint_journal", default=None)
+)
+
+
+def set_checkpoint_journal(journal: Optional[CheckpointJournal]) -> None:
+    checkpoint_journal.set(journal)
+
+
+def get_completed_stage(
+    stage: str, input_hash: str, file_paths: list[str] = ()
+) -> Optional[dict]:
+    journal = checkpoint_journal.get()
+    if journal is None:
+        return None
+    return journal.get_completed_stage(stage, input_hash, file_paths)
+
+
+def complete_stage(
+    stage: str, input_hash: str, file_paths: list[str] = (), **outputs
+) -> None:
+    journal = checkpoint_journal.get()
+    if journal is None:
+        return
+    outputs["files"] = {file_path: hash_file(file_path) for file_path in file_paths}
+    journal.complete_stage(stage, input_hash, outputs)
+
+
+def record_file_changes(file_paths: list[str]) -> None:
+    # Files changed outside of a stage are recorded, so that the stages that
+    # created them are not redone.
+    journal = checkpoint_journal.get()
+    if journal is None:
+        return
+    journal.record_files({file_path: hash_file(file_path) for file_path in file_paths})
+
+
+def get_stage_output_hash(*stages: str) -> str:
+    journal = checkpoint_journal.get()
+    if journal is None:
+        return ""
+    return journal.get_stage_output_hash(stages)
+
+
+def hash_stage_inputs(*inputs: str) -> str:
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def hash_file(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -0,0 +1,210 @@
+import ast
+from typing import Optional
+
+ENUM_BASE_NAMES = {"Enum", "IntEnum", "StrEnum", "Flag", "IntFlag"}
+
+
+def extract_class_diagram(source_code: str) -> Optional[str]:
+    try:
+        tree = ast.parse(source_code)
+    except SyntaxError:
+        return None
+
+    class_nodes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    if not class_nodes:
+        return ""
+
+    lines = ["@startuml"]
+    relations = []
+    for class_node in class_nodes:
+        lines.extend(format_class(class_node))
+        for base_name in get_base_names(class_node):
+            if base_name not in ENUM_BASE_NAMES | {"ABC", "object"}:
+                relations.append(f"{base_name} <|-- {class_node.name}")
+    lines.extend(relations)
+    lines.append("@enduml")
+    return "\n".join(lines)
+
+
+def format_class(class_node: ast.ClassDef) -> list[str]:
+    base_names = set(get_base_names(class_node))
+    if base_names & ENUM_BASE_NAMES:
+        members = [
+            target.id
+            for node in class_node.body
+            # Annotations without a value do not define members.
+            if isinstance(node, ast.Assign)
+            or (isinstance(node, ast.AnnAssign) and node.value is not None)
+            for target, _ in get_assignments(node)
+            if isinstance(target, ast.Name)
+        ]
+        return [f"enum {class_node.name} {{"] + [f"  {m}" for m in members] + ["}"]
+
+    method_nodes = [
+        node
+        for node in class_node.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+    ]
+    is_abstract = "ABC" in base_names or any(
+        "abstractmethod" in get_decorator_names(node) for node in method_nodes
+    )
+    lines = [f"{'abstract class' if is_abstract else 'class'} {class_node.name} {{"]
+    for name, annotation in get_attributes(class_node, method_nodes).items():
+        attribute = f"{get_visibility(name)}{name}"
+        lines.append(f"  {attribute}: {annotation}" if annotation else f"  {attribute}")
+    for node in method_nodes:
+        lines.append(f"  {format_method(node)}")
+    lines.append("}")
+    return lines
+
+
+def get_base_names(class_node: ast.ClassDef) -> list[str]:
+    return [ast.unparse(base).split(".")[-1] for base in class_node.bases]
+
+
+def get_attributes(
+    class_node: ast.ClassDef, method_nodes: list[ast.FunctionDef]
+) -> dict[str, Optional[str]]:
+    attributes = {}
+    for node in class_node.body:
+        if isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            attributes[node.target.id] = format_annotation(node.annotation)
+        elif isinstance(node, ast.Assign):
+            for target, _ in get_assignments(node):
+                if isinstance(target, ast.Name):
+                    attributes.setdefault(target.id, None)
+
+    for method_node in method_nodes:
+        parameter_annotations = {
+            arg.arg: format_annotation(arg.annotation)
+            for arg in method_node.args.posonlyargs
+            + method_node.args.args
+            + method_node.args.kwonlyargs
+            if arg.annotation is not None
+        }
+        for node in ast.walk(method_node):
+            if isinstance(node, ast.AnnAssign) and is_self_attribute(node.target):
+                attributes[node.target.attr] = format_annotation(node.annotation)
+            elif isinstance(node, ast.Assign):
+                for target, value in get_assignments(node):
+                    if not is_self_attribute(target):
+                        continue
+                    # self.x = x takes the annotation of the parameter x.
+                    annotation = (
+                        parameter_annotations.get(value.id)
+                        if isinstance(value, ast.Name)
+                        else None
+                    )
+                    if attributes.get(target.attr) is None:
+                        attributes[target.attr] = annotation
+    return attributes
+
+
+def get_assignments(
+    node: ast.Assign | ast.AnnAssign,
+) -> list[tuple[ast.expr, Optional[ast.expr]]]:
+    targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+    return [
+        assignment
+        for target in targets
+        for assignment in unpack_assignment(target, node.value)
+    ]
+
+
+def unpack_assignment(
+    target: ast.expr, value: Optional[ast.expr]
+) -> list[tuple[ast.expr, Optional[ast.expr]]]:
+    # a, b = x, y assigns element by element.
+    if isinstance(target, ast.Starred):
+        return unpack_assignment(target.value, None)
+    if not isinstance(target, (ast.Tuple, ast.List)):
+        return [(target, value)]
+    values = [None] * len(target.elts)
+    if isinstance(value, (ast.Tuple, ast.List)) and len(value.elts) == len(values):
+        values = value.elts
+    return [
+        assignment
+        for element, element_value in zip(target.elts, values)
+        for assignment in unpack_assignment(element, element_value)
+    ]
+
+
+def is_self_attribute(node: ast.expr) -> bool:
+    return (
+        isinstance(node, ast.Attribute)
+        and isinstance(node.value, ast.Name)
+        and node.value.id == "self"
+    )
+
+
+def format_method(node: ast.FunctionDef) -> str:
+    decorator_names = get_decorator_names(node)
+    modifiers = ""
+    if "staticmethod" in decorator_names or "classmethod" in decorator_names:
+        modifiers += "{static} "
+    if "abstractmethod" in decorator_names:
+        modifiers += "{abstract} "
+
+    parameters = format_parameters(node.args)
+    # self and cls are left out.
+    if "staticmethod" not in decorator_names and (
+        node.args.posonlyargs or node.args.args
+    ):
+        parameters = parameters[1:]
+        # A / left without positional-only parameters is dropped as well.
+        if parameters[:1] == ["/"]:
+            parameters = parameters[1:]
+    signature = (
+        f"{get_visibility(node.name)}{modifiers}{node.name}({', '.join(parameters)})"
+    )
+    if node.returns is not None:
+        signature += f": {format_annotation(node.returns)}"
+    return signature
+
+
+def format_parameters(args: ast.arguments) -> list[str]:
+    positional_args = args.posonlyargs + args.args
+    defaults = [None] * (len(positional_args) - len(args.defaults)) + args.defaults
+    parameters = [
+        format_parameter(arg, default)
+        for arg, default in zip(positional_args, defaults)
+    ]
+    if args.posonlyargs:
+        parameters.insert(len(args.posonlyargs), "/")
+    if args.vararg is not None:
+        parameters.append(format_parameter(args.vararg, None, "*"))
+    elif args.kwonlyargs:
+        parameters.append("*")
+    parameters.extend(
+        format_parameter(arg, default)
+        for arg, default in zip(args.kwonlyargs, args.kw_defaults)
+    )
+    if args.kwarg is not None:
+        parameters.append(format_parameter(args.kwarg, None, "**"))
+    return parameters
+
+
+def format_parameter(
+    arg: ast.arg, default: Optional[ast.expr], prefix: str = ""
+) -> str:
+    parameter = f"{prefix}{arg.arg}"
+    if arg.annotation is not None:
+        parameter += f": {format_annotation(arg.annotation)}"
+    if default is not None:
+        parameter += f" = {ast.unparse(default)}"
+    return parameter
+
+
+def format_annotation(node: ast.expr) -> str:
+    # Forward references are written without their quotes.
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return ast.unparse(node)
+
+
+def get_decorator_names(node: ast.FunctionDef) -> set[str]:
+    return {ast.unparse(decorator).split(".")[-1] for decorator in node.decorator_list}
+
+
+def get_visibility(name: str) -> str:
+    return "-" if name.startswith("_") and not name.endswith("__") else "+"
@@ -0,0 +1,113 @@
+import difflib
+import logging
+import re
+from typing import Optional
+
+from util import EDIT_FORMAT_WHOLE
+
+EDIT_BLOCK_PATTERN = re.compile(
+    r"^<{5,9} SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} REPLACE[^\n]*$",
+    re.MULTILINE | re.DOTALL,
+)
+FUZZY_MATCH_THRESHOLD = 0.9
+
+edit_format = EDIT_FORMAT_WHOLE
+
+
+class EditBlockError(ValueError):
+    pass
+
+
+def set_edit_format(format: str) -> None:
+    global edit_format
+    edit_format = format
+
+
+def get_edit_format() -> str:
+    return edit_format
+
+
+def apply_model_edits(source_code: str, output: str) -> Optional[str]:
+    edit_blocks = EDIT_BLOCK_PATTERN.findall(output)
+    if not edit_blocks and ("SEARCH" in output or "REPLACE" in output):
+        logging.warning("Could not parse the search/replace blocks.")
+        return None
+    try:
+        for search, replace in edit_blocks:
+            source_code = apply_edit_block(source_code, search, replace)
+    except EditBlockError as e:
+        logging.warning(f"Could not apply search/replace block: {e}")
+        return None
+    return source_code
+
+
+def apply_edit_block(source_code: str, search: str, replace: str) -> str:
+    if not search.strip():
+        if source_code and not source_code.endswith("\n"):
+            source_code += "\n"
+        return source_code + replace
+
+    if source_code.count(search) == 1:
+        return source_code.replace(search, replace)
+
+    lines = source_code.splitlines(keepends=True)
+    search_lines = search.splitlines(keepends=True)
+    replace_lines = replace.splitlines(keepends=True)
+    start = find_matching_lines(lines, search_lines)
+    if start is None:
+        raise EditBlockError(f"No unique match for:\n{search}")
+
+    # The model often gets the indentation of the whole block wrong; shift the
+    # replacement by the same amount as the matched lines.
+    file_indent = get_indent(lines[start : start + len(search_lines)])
+    search_indent = get_indent(search_lines)
+    if file_indent != search_indent:
+        replace_lines = [
+            (
+                file_indent + line[len(search_indent) :]
+                if line.startswith(search_indent) and line.strip()
+                else line
+            )
+            for line in replace_lines
+        ]
+    if replace_lines and not replace_lines[-1].endswith("\n"):
+        replace_lines[-1] += "\n"
+    return "".join(lines[:start] + replace_lines + lines[start + len(search_lines) :])
+
+
+def find_matching_lines(lines: list[str], search_lines: list[str]) -> Optional[int]:
+    window_starts = range(len(lines) - len(search_lines) + 1)
+    stripped_search_lines = [line.strip() for line in search_lines]
+    starts = [
+        start
+        for start in window_starts
+        if [line.strip() for line in lines[start : start + len(search_lines)]]
+        == stripped_search_lines
+    ]
+    if len(starts) == 1:
+        return starts[0]
+    if starts:
+        return None
+
+    search_text = "\n".join(stripped_search_lines)
+    ratios = []
+    for start in window_starts:
+        window_text = "\n".join(
+            line.strip() for line in lines[start : start + len(search_lines)]
+        )
+        matcher = difflib.SequenceMatcher(None, search_text, window_text)
+        if matcher.real_quick_ratio() >= FUZZY_MATCH_THRESHOLD:
+            ratios.append((matcher.ratio(), start))
+    ratios.sort(reverse=True)
+    if not ratios or ratios[0][0] < FUZZY_MATCH_THRESHOLD:
+        return None
+    if len(ratios) > 1 and ratios[1][0] == ratios[0][0]:
+        return None
+    return ratios[0][1]
+
+
+def get_indent(lines: list[str]) -> str:
+    for line in lines:
+        if line.strip():
+            return line[: len(line) - len(line.lstrip())]
+    return ""
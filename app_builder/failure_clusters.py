@@ -0,0 +1,73 @@
+import os
+import re
+from dataclasses import dataclass, field
+
+from util import get_src_dir
+
+FRAME_PATTERN = re.compile(r'^\s*File "(.+)", line (\d+)(?:, in (.+))?$')
+MESSAGE_VARIABLE_PATTERNS = [
+    (re.compile(r"0x[0-9a-fA-F]+"), "<addr>"),
+    (re.compile(r"'[^']*'|\"[^\"]*\""), "<str>"),
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])"), "<num>"),
+]
+MAX_MESSAGE_TEMPLATE_LENGTH = 200
+
+FailureSignature = tuple[str, str, str]
+
+
+@dataclass
+class FailureCluster:
+    signature: FailureSignature
+    test_ids: list[str] = field(default_factory=list)
+    test_file_names: list[str] = field(default_factory=list)
+    error_messages: list[str] = field(default_factory=list)
+
+
+def cluster_failures(failures: list[tuple[str, str, str]]) -> list[FailureCluster]:
+    clusters = {}
+    for test_id, test_file_name, error_message in failures:
+        signature = get_failure_signature(error_message)
+        cluster = clusters.setdefault(signature, FailureCluster(signature))
+        cluster.test_ids.append(test_id)
+        if test_file_name not in cluster.test_file_names:
+            cluster.test_file_names.append(test_file_name)
+        cluster.error_messages.append(error_message)
+    return list(clusters.values())
+
+
+def get_failure_signature(error_message: str) -> FailureSignature:
+    # Failures caused by the same bug raise the same exception from the same
+    # workspace function, with messages that differ only in their values.
+    lines = error_message.splitlines()
+    src_dir = get_src_dir()
+    innermost_frame = ""
+    last_frame_index = -1
+    for i, line in enumerate(lines):
+        match = FRAME_PATTERN.match(line)
+        if match is None:
+            continue
+        last_frame_index = i
+        file_path, _, function_name = match.groups()
+        if os.path.dirname(file_path) == src_dir:
+            innermost_frame = f"{os.path.basename(file_path)}:{function_name or ''}"
+
+    exception_line = next(
+        (
+            line
+            for line in lines[last_frame_index + 1 :]
+            if line.strip() and not line[0].isspace()
+        ),
+        lines[0] if lines else "",
+    )
+    exception_type, _, message = exception_line.partition(":")
+    return (
+        exception_type.strip(),
+        innermost_frame,
+        get_message_template(message.strip()),
+    )
+
+
+def get_message_template(message: str) -> str:
+    for pattern, placeholder in MESSAGE_VARIABLE_PATTERNS:
+        message = pattern.sub(placeholder, message)
+    return message[:MAX_MESSAGE_TEMPLATE_LENGTH]
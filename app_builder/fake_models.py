@@ -0,0 +1,416 @@
+import asyncio
+import hashlib
+import json
+import math
+import re
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk, ChatResult
+
+ENTRY_POINT_FILE_NAME = "main.py"
+SCENARIO_COUNT = 2
+PADDING_FUNCTION_COUNT = 8
+# This module is generated with a bug so that the fix loop runs once.
+BUGGY_MODULE_INDEX = 1
+CHANGED_MODULE_INTERVAL = 5
+
+
+class ScriptedChatModel(BaseChatModel):
+    file_count: int
+    latency_seconds: float = 0.0
+    chunk_size: int = 64
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency_seconds)
+        content = self.respond(messages[-1].content)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))]
+        )
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency_seconds)
+        content = self.respond(messages[-1].content)
+        for i in range(0, len(content), self.chunk_size):
+            chunk = content[i : i + self.chunk_size]
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency_seconds)
+        content = self.respond(messages[-1].content)
+        for i in range(0, len(content), self.chunk_size):
+            chunk = content[i : i + self.chunk_size]
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+    def respond(self, prompt: str) -> str:
+        edit_blocks = "search/replace blocks" in prompt
+        if "Create a document of public interfaces" in prompt:
+            return get_public_interface_document_json(self.file_count)
+        if match := re.search(
+            r"Create a file to test all the features of (\S+)\.", prompt
+        ):
+            return format_code_block(get_unit_test_code(get_module_index(match[1])))
+        if match := re.search(r"Create (\S+) and write the whole contents", prompt):
+            return format_code_block(get_source_code(match[1], self.file_count))
+        if match := re.search(r"reflect the source code of (\S+)\.", prompt):
+            return json.dumps(get_file_json(match[1]))
+        if "Create acceptance test scenarios" in prompt:
+            return json.dumps(get_test_scenarios_json())
+        if "Create an acceptance test" in prompt:
+            scenario_index = int(re.search(r"Scenario (\d+)", prompt)[1])
+            return format_code_block(
+                get_acceptance_test_code(scenario_index, self.file_count)
+            )
+        if "Suggest possible options to fix the error." in prompt:
+            test_file_name = re.search(r"Test code \((\S+)\):", prompt)[1]
+            return json.dumps(get_fix_options_json(test_file_name))
+        if "Instrcution to fix the error" in prompt:
+            file_name = re.search(r"Source code to fix \((\S+)\):", prompt)[1]
+            offset = int(re.search(r"Return value \+ (\d+)", prompt)[1])
+            return get_fix_output(file_name, offset, edit_blocks)
+        if "List the files that have to be modified" in prompt:
+            return json.dumps(get_affected_files_json(self.file_count))
+        if match := re.search(r"Modify (\S+) based on the changes made to", prompt):
+            return get_modified_unit_test_output(match[1], edit_blocks)
+        if match := re.search(r"Modify (\S+) based on the change request", prompt):
+            return get_modified_source_code_output(match[1], edit_blocks)
+        raise ValueError(f"Unexpected prompt: {prompt[:200]}")
+
+
+class HashingEmbeddings(Embeddings):
+    model = "hashing"
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dimensions] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+
+def get_module_file_name(index: int) -> str:
+    return f"module_{index}.py"
+
+
+def get_module_index(file_name: str) -> int:
+    return int(re.search(r"module_(\d+)\.py", file_name)[1])
+
+
+def format_code_block(code: str) -> str:
+    return f"```python\n{code}```\n"
+
+
+def get_specifications_text(file_count: int) -> str:
+    module_lines = [
+        f"- module_{i} provides compute_{i}(value), which returns value + {i}, "
+        f"and a Counter{i} class."
+        for i in range(1, file_count)
+    ]
+    return "\n".join(
+        [
+            f"A synthetic app with {file_count} files.",
+            "",
+            "## Modules",
+            *module_lines,
+            "",
+            "## Entry point",
+            "main.py reads an integer value and prints the sum of all compute "
+            'functions applied to it as "Total: <sum>".',
+        ]
+    )
+
+
+def get_change_request_text() -> str:
+    return (
+        f"Add a describe() function to every module whose number is divisible by "
+        f"{CHANGED_MODULE_INTERVAL}. It returns the module name."
+    )
+
+
+def get_file_json(file_name: str) -> dict:
+    if file_name == ENTRY_POINT_FILE_NAME:
+        return {"name": file_name, "class_diagram": ""}
+    index = get_module_index(file_name)
+    return {
+        "name": file_name,
+        "class_diagram": (
+            f"@startuml\nclass Counter{index} {{\n  +count: int\n"
+            f"  +increment(step: int): int\n  +reset()\n}}\n@enduml"
+        ),
+    }
+
+
+def get_public_interface_document_json(file_count: int) -> str:
+    file_names = [ENTRY_POINT_FILE_NAME] + [
+        get_module_file_name(i) for i in range(1, file_count)
+    ]
+    return json.dumps(
+        {
+            "entry_point_file_name": ENTRY_POINT_FILE_NAME,
+            "files": [get_file_json(file_name) for file_name in file_names],
+            "sequence_diagram": "@startuml\nUser -> main: value\n"
+            "main -> User: total\n@enduml",
+        }
+    )
+
+
+def get_source_code(file_name: str, file_count: int) -> str:
+    if file_name == ENTRY_POINT_FILE_NAME:
+        return get_entry_point_code(file_count)
+    index = get_module_index(file_name)
+    return get_module_code(index, 0 if index == BUGGY_MODULE_INDEX else index)
+
+
+def get_module_code(index: int, offset: int) -> str:
+    lines = []
+    if index > 1:
+        lines += [f"from module_{index - 1} import compute_{index - 1}", "", ""]
+    lines += [
+        f"def compute_{index}(value):",
+        f"\treturn value + {offset}",
+        "",
+        "",
+    ]
+    if index > 1:
+        lines += [
+            f"def chain_{index}(value):",
+            f"\treturn compute_{index - 1}(value) + {index}",
+            "",
+            "",
+        ]
+    lines += [
+        f"class Counter{index}:",
+        "\tdef __init__(self):",
+        "\t\tself.count = 0",
+        "",
+        "\tdef increment(self, step=1):",
+        "\t\tself.count += step",
+        "\t\treturn self.count",
+        "",
+        "\tdef reset(self):",
+        "\t\tself.count = 0",
+    ]
+    for j in range(PADDING_FUNCTION_COUNT):
+        lines += [
+            "",
+            "",
+            f"def helper_{index}_{j}(values):",
+            f"\treturn [value * {j + 1} for value in values if value % {j + 2}]",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def get_entry_point_code(file_count: int) -> str:
+    indices = range(1, file_count)
+    return (
+        "\n".join(
+            [f"from module_{i} import compute_{i}" for i in indices]
+            + [
+                "",
+                "",
+                "def main():",
+                '\tvalue = int(input("Value: "))',
+                "\ttotal = sum(",
+                "\t\t[" + ", ".join(f"compute_{i}(value)" for i in indices) + "]",
+                "\t)",
+                '\tprint(f"Total: {total}")',
+                "",
+                "",
+                'if __name__ == "__main__":',
+                "\tmain()",
+            ]
+        )
+        + "\n"
+    )
+
+
+def get_unit_test_code(index: int) -> str:
+    return (
+        "\n".join(
+            [
+                "import unittest",
+                "",
+                f"from module_{index} import Counter{index}, compute_{index}",
+                "",
+                "",
+                f"class TestModule{index}(unittest.TestCase):",
+                "\tdef test_compute(self):",
+                f"\t\tself.assertEqual(compute_{index}(1), {1 + index})",
+                "",
+                "\tdef test_counter(self):",
+                f"\t\tcounter = Counter{index}()",
+                "\t\tcounter.increment(2)",
+                "\t\tself.assertEqual(counter.count, 2)",
+                "",
+                "",
+                'if __name__ == "__main__":',
+                "\tunittest.main()",
+            ]
+        )
+        + "\n"
+    )
+
+
+def get_test_scenarios_json() -> dict:
+    return {
+        "scenarios": [
+            {
+                "name": f"Scenario {i}",
+                "scenario": f"The user enters {i + 1} and sees the total.",
+            }
+            for i in range(SCENARIO_COUNT)
+        ]
+    }
+
+
+def get_acceptance_test_code(scenario_index: int, file_count: int) -> str:
+    value = scenario_index + 1
+    total = sum(value + i for i in range(1, file_count))
+    return (
+        "\n".join(
+            [
+                "import io",
+                "import unittest",
+                "from unittest.mock import patch",
+                "",
+                "from main import main",
+                "",
+                "",
+                f"class TestScenario{scenario_index}(unittest.TestCase):",
+                "\tdef test_session(self):",
+                f'\t\twith patch("builtins.input", return_value="{value}"), patch(',
+                '\t\t\t"sys.stdout", new_callable=io.StringIO',
+                "\t\t) as stdout:",
+                "\t\t\tmain()",
+                f'\t\tself.assertIn("Total: {total}", stdout.getvalue())',
+                "",
+                "",
+                'if __name__ == "__main__":',
+                "\tunittest.main()",
+            ]
+        )
+        + "\n"
+    )
+
+
+def get_fix_options_json(test_file_name: str) -> dict:
+    file_name = get_module_file_name(get_module_index(test_file_name))
+    index = get_module_index(file_name)
+    # The second option is wrong, so that speculative fixing has to compare.
+    return {
+        "options": [
+            {
+                "file_name": file_name,
+                "observation": f"compute_{index} returns the wrong value.",
+                "how_to_fix": f"Return value + {index}.",
+            },
+            {
+                "file_name": file_name,
+                "observation": f"compute_{index} is off by one.",
+                "how_to_fix": f"Return value + {index + 1}.",
+            },
+        ]
+    }
+
+
+def get_fix_output(file_name: str, offset: int, edit_blocks: bool) -> str:
+    index = get_module_index(file_name)
+    if edit_blocks:
+        return format_edit_block(
+            f"def compute_{index}(value):\n\treturn value + 0\n",
+            f"def compute_{index}(value):\n\treturn value + {offset}\n",
+        )
+    return json.dumps(
+        {
+            "description": f"Return value + {offset}.",
+            "file_name": file_name,
+            "code": get_module_code(index, offset),
+        }
+    )
+
+
+def format_edit_block(search: str, replace: str) -> str:
+    return f"<<<<<<< SEARCH\n{search}=======\n{replace}>>>>>>> REPLACE\n"
+
+
+def is_changed_module(file_name: str) -> bool:
+    return (
+        file_name != ENTRY_POINT_FILE_NAME
+        and get_module_index(file_name) % CHANGED_MODULE_INTERVAL == 0
+    )
+
+
+def get_affected_files_json(file_count: int) -> dict:
+    file_names = [get_module_file_name(i) for i in range(1, file_count)]
+    return {
+        "file_names": [
+            file_name for file_name in file_names if is_changed_module(file_name)
+        ]
+    }
+
+
+def get_describe_function_code(index: int) -> str:
+    return f'\n\ndef describe():\n\treturn "module_{index}"\n'
+
+
+def get_modified_source_code_output(file_name: str, edit_blocks: bool) -> str:
+    if not is_changed_module(file_name):
+        return "" if edit_blocks else "```\n```\n"
+    index = get_module_index(file_name)
+    if edit_blocks:
+        return format_edit_block("", get_describe_function_code(index))
+    return format_code_block(
+        get_module_code(index, index) + get_describe_function_code(index)
+    )
+
+
+def get_modified_unit_test_output(test_file_name: str, edit_blocks: bool) -> str:
+    index = get_module_index(test_file_name)
+    if not is_changed_module(get_module_file_name(index)):
+        return "" if edit_blocks else "```\n```\n"
+    class_line = f"class TestModule{index}(unittest.TestCase):\n"
+    test_method = (
+        "\tdef test_describe(self):\n"
+        f"\t\tfrom module_{index} import describe\n\n"
+        f'\t\tself.assertEqual(describe(), "module_{index}")\n\n'
+    )
+    if edit_blocks:
+        return format_edit_block(class_line, class_line + test_method)
+    code = get_unit_test_code(index).replace(class_line, class_line + test_method)
+    return format_code_block(code)
@@ -0,0 +1,64 @@
+import ast
+import os
+from typing import Optional
+
+from util import get_src_dir
+
+
+def build_import_graph(src_dir: Optional[str] = None) -> dict[str, set[str]]:
+    if src_dir is None:
+        src_dir = get_src_dir()
+    file_names_by_module = {
+        file_name[:-3]: file_name
+        for file_name in os.listdir(src_dir)
+        if file_name.endswith(".py")
+    }
+
+    import_graph = {}
+    for module_name, file_name in file_names_by_module.items():
+        try:
+            with open(os.path.join(src_dir, file_name)) as f:
+                tree = ast.parse(f.read())
+        except (SyntaxError, UnicodeDecodeError):
+            import_graph[file_name] = set()
+            continue
+
+        imported_module_names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                imported_module_names.update(
+                    alias.name.split(".")[0] for alias in node.names
+                )
+            elif isinstance(node, ast.ImportFrom):
+                if node.level == 0 and node.module:
+                    imported_module_names.add(node.module.split(".")[0])
+                else:
+                    imported_module_names.update(alias.name for alias in node.names)
+
+        import_graph[file_name] = {
+            file_names_by_module[name]
+            for name in imported_module_names
+            if name in file_names_by_module and name != module_name
+        }
+    return import_graph
+
+
+def get_transitive_imports(
+    import_graph: dict[str, set[str]], file_name: str
+) -> set[str]:
+    imported_file_names = set()
+    pending_file_names = [file_name]
+    while pending_file_names:
+        for imported_file_name in import_graph.get(pending_file_names.pop(), set()):
+            if imported_file_name not in imported_file_names:
+                imported_file_names.add(imported_file_name)
+                pending_file_names.append(imported_file_name)
+    return imported_file_names
+
+
+def get_importers(import_graph: dict[str, set[str]], file_name: str) -> set[str]:
+    return {
+        importer
+        for importer, imported_file_names in import_graph.items()
+        if file_name in imported_file_names
+    }
@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_BUILD = "build"
+JOB_MODIFY = "modify"
+
+JOB_COLUMNS = [
+    "id",
+    "kind",
+    "workspace",
+    "status",
+    "error",
+    "created_at",
+    "started_at",
+    "finished_at",
+]
+
+
+class JobQueue:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._job_added = threading.Condition(self._lock)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "id TEXT NOT NULL UNIQUE, "
+                "kind TEXT NOT NULL, "
+                "workspace TEXT NOT NULL, "
+                "request TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "error TEXT, "
+                "created_at REAL NOT NULL, "
+                "started_at REAL, "
+                "finished_at REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "job_id TEXT NOT NULL, "
+                "event TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS events_by_job ON events (job_id, seq)"
+            )
+            # Jobs that were running when the service stopped are run again.
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?",
+                (JOB_QUEUED, JOB_RUNNING),
+            )
+
+    def submit(self, kind: str, workspace: Optional[str], request: dict) -> dict:
+        job_id = uuid.uuid4().hex
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO jobs (id, kind, workspace, request, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    kind,
+                    workspace or job_id,
+                    json.dumps(request),
+                    JOB_QUEUED,
+                    time.time(),
+                ),
+            )
+            self._job_added.notify()
+        return self.get_job(job_id)
+
+    def claim(self, timeout: float) -> Optional[tuple[dict, dict]]:
+        # Jobs of a workspace run one at a time, in the order they were submitted.
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                with self._connection:
+                    row = self._connection.execute(
+                        "SELECT id, request FROM jobs WHERE status = ? "
+                        "AND workspace NOT IN "
+                        "(SELECT workspace FROM jobs WHERE status = ?) "
+                        "ORDER BY seq LIMIT 1",
+                        (JOB_QUEUED, JOB_RUNNING),
+                    ).fetchone()
+                    if row is not None:
+                        self._connection.execute(
+                            "UPDATE jobs SET status = ?, started_at = ? WHERE id = ?",
+                            (JOB_RUNNING, time.time(), row[0]),
+                        )
+                        break
+                remaining_seconds = deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    return None
+                self._job_added.wait(remaining_seconds)
+        return self.get_job(row[0]), json.loads(row[1])
+
+    def finish(self, job_id: str, error: Optional[str] = None) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (
+                    JOB_FAILED if error is not None else JOB_SUCCEEDED,
+                    error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+            # A finished job may unblock the next job of its workspace.
+            self._job_added.notify_all()
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row is not None else None
+
+    def list_jobs(self) -> list[dict]:
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY seq"
+            ).fetchall()
+        return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+    def add_event(self, job_id: str, event: dict) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO events (job_id, event) VALUES (?, ?)",
+                (job_id, json.dumps({"time": time.time(), **event})),
+            )
+
+    def get_events(self, job_id: str, after_seq: int = 0) -> list[dict]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT seq, event FROM events WHERE job_id = ? AND seq > ? "
+                "ORDER BY seq",
+                (job_id, after_seq),
+            ).fetchall()
+        return [{"seq": seq, **json.loads(event)} for seq, event in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
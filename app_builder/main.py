@@ -1,17 +1,21 @@
 import argparse
+import contextlib
 import logging
 import shutil
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Optional
 
 from builders.fix import fix_test_errors
 from builders.interface import (
     generate_public_interface_document,
+    set_llm_class_diagram_fallback,
     update_public_interface_document,
 )
 from builders.source_code import (
-    create_source_code_vector_db,
+    create_source_code_retriever,
     generate_source_code,
     modify_source_code,
+    select_files_to_modify,
 )
 from builders.test import (
     execute_all_tests,
@@ -19,21 +23,67 @@ from builders.test import (
     generate_acceptance_tests,
     generate_unit_tests,
     modify_unit_test,
+    set_max_test_output_chars,
+    set_test_worker,
+)
+from cache import ModelCache
+from checkpoint import (
+    CheckpointJournal,
+    complete_stage,
+    get_completed_stage,
+    get_stage_output_hash,
+    hash_stage_inputs,
+    set_checkpoint_journal,
 )
 from dotenv import load_dotenv
-from langchain.chat_models import ChatOpenAI
-from schema import PublicInterfaceDocument
+from edit_blocks import set_edit_format
+from model_scheduler import ModelScheduler
+from prompt_assembly import set_prompt_token_budget
+from prompt_registry import load_prompt_registry
+from schema import PublicInterfaceDocument, TestScenarioSet
+from test_log import get_test_log
+from test_worker import TestWorker
+from tracing import Tracer, set_tracer, span, start_metrics_server, traced
 from util import (
     ACCEPTANCE_TEST_PREFIX,
-    DOC_DIR,
+    CHECKPOINT_JOURNAL_FILE_NAME,
+    EDIT_FORMAT_SEARCH_REPLACE,
+    EDIT_FORMAT_WHOLE,
+    INDEX_MODE_AST,
+    INDEX_MODE_FILE,
+    LLM_CACHE_FILE_NAME,
+    LLM_CACHE_MAX_AGE_SECONDS,
+    LLM_CACHE_MAX_BYTES,
+    LLM_CACHE_MAX_ENTRIES,
+    MAX_CONCURRENT_MODEL_CALLS,
+    MODEL_MAX_RETRIES,
+    MODEL_REQUESTS_PER_MINUTE,
+    MODEL_TOKENS_PER_MINUTE,
+    PROMPT_TOKEN_BUDGET,
     PUBLIC_INTERFACE_DOCUMENT_NAME,
     RAW_ALL_TEST_ID,
-    SRC_DIR,
-    TEST_LOG_FILE_NAME,
+    RETRIEVER_BM25,
+    RETRIEVER_DENSE,
+    RETRIEVER_HYBRID,
+    TEST_OUTPUT_MAX_CHARS,
+    TRACE_FILE_NAME,
     UNIT_TEST_PREFIX,
+    ChatModel,
+    get_acceptance_test_file_name,
+    get_cache_file_path,
+    get_doc_dir,
     get_doc_file_path,
+    get_src_dir,
+    get_src_file_path,
+    get_unit_test_file_name,
+    map_concurrently,
+    set_model_cache,
+    set_model_scheduler,
 )
 
+if TYPE_CHECKING:
+    from langchain.chat_models.base import BaseChatModel
+
 
 def main():
     load_dotenv()
@@ -50,40 +100,200 @@ def main():
         required=True,
         help="Path to a file containing the specifications of the app to build.",
     )
-    arg_parser.add_argument(
-        "--reuse",
-        action="store_true",
-        help="Reuse existing files.",
-    )
     arg_parser.add_argument(
         "--change-request",
         type=str,
         default=None,
         help="Path to a file containing the change request.",
     )
+    add_build_arguments(arg_parser)
     args = arg_parser.parse_args()
+    configure_build(args)
 
-    if args.change_request:
-        modify_app(args.spec, args.change_request)
-    else:
+    if not args.change_request:
         prepare_workspace(args.reuse)
-        build_app(args.spec)
+    set_checkpoint_journal(
+        CheckpointJournal(get_doc_file_path(CHECKPOINT_JOURNAL_FILE_NAME))
+    )
+    try:
+        with build_session(args):
+            if args.change_request:
+                modify_app(args.spec, args.change_request)
+            else:
+                build_app(
+                    args.spec,
+                    args.index_mode,
+                    args.retriever,
+                    args.warm_test_worker,
+                    args.test_coverage,
+                    args.auto_fix,
+                )
+    finally:
+        set_checkpoint_journal(None)
+
+
+def add_build_arguments(arg_parser: argparse.ArgumentParser) -> None:
+    arg_parser.add_argument(
+        "--reuse",
+        action="store_true",
+        help="Reuse existing files.",
+    )
+    arg_parser.add_argument(
+        "--no-llm-cache",
+        action="store_true",
+        help="Ignore cached LLM responses. Fresh responses are still cached.",
+    )
+    arg_parser.add_argument(
+        "--index-mode",
+        choices=[INDEX_MODE_FILE, INDEX_MODE_AST],
+        default=INDEX_MODE_FILE,
+        help="Index whole source files or their functions and classes.",
+    )
+    arg_parser.add_argument(
+        "--retriever",
+        choices=[RETRIEVER_DENSE, RETRIEVER_BM25, RETRIEVER_HYBRID],
+        default=RETRIEVER_DENSE,
+        help="How to retrieve source code for fix suggestions. "
+        "bm25 works offline; hybrid fuses bm25 with embeddings.",
+    )
+    arg_parser.add_argument(
+        "--warm-test-worker",
+        action="store_true",
+        help="Fork test runs from a long-lived worker instead of starting "
+        "a new interpreter for each test file.",
+    )
+    arg_parser.add_argument(
+        "--test-coverage",
+        action="store_true",
+        help="Record which source files each test file calls, to select "
+        "the tests affected by a fix more precisely.",
+    )
+    arg_parser.add_argument(
+        "--auto-fix",
+        action="store_true",
+        help="Instead of asking which fix to apply, test every suggested fix "
+        "in a separate copy of the source code and keep the best one.",
+    )
+    arg_parser.add_argument(
+        "--prompt-token-budget",
+        type=int,
+        default=PROMPT_TOKEN_BUDGET,
+        help="Trim the less relevant parts of prompts longer than this.",
+    )
+    arg_parser.add_argument(
+        "--edit-format",
+        choices=[EDIT_FORMAT_WHOLE, EDIT_FORMAT_SEARCH_REPLACE],
+        default=EDIT_FORMAT_WHOLE,
+        help="How the model returns modifications and fixes: whole files, or "
+        "search/replace blocks that fall back to whole files when they do not apply.",
+    )
+    arg_parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=MODEL_REQUESTS_PER_MINUTE,
+        help="Rate limit for model requests.",
+    )
+    arg_parser.add_argument(
+        "--tokens-per-minute",
+        type=float,
+        default=MODEL_TOKENS_PER_MINUTE,
+        help="Rate limit for prompt tokens sent to the model.",
+    )
+    arg_parser.add_argument(
+        "--llm-class-diagram-fallback",
+        action="store_true",
+        help="Ask the model for the class diagram of a file that cannot be parsed, "
+        "instead of keeping its previous class diagram.",
+    )
+    arg_parser.add_argument(
+        "--max-test-output-chars",
+        type=int,
+        default=TEST_OUTPUT_MAX_CHARS,
+        help="Keep only the last characters of what each test prints, "
+        "so a test printing in a loop cannot exhaust memory.",
+    )
+    arg_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve per-stage metrics in the Prometheus text format on this "
+        "local port while the app is built.",
+    )
+
+
+def configure_build(args: argparse.Namespace) -> None:
+    # Invalid prompt templates should fail before any model is called.
+    load_prompt_registry()
+    set_prompt_token_budget(args.prompt_token_budget)
+    set_edit_format(args.edit_format)
+    set_llm_class_diagram_fallback(args.llm_class_diagram_fallback)
+    set_max_test_output_chars(args.max_test_output_chars)
+
+
+@contextlib.contextmanager
+def build_session(args: argparse.Namespace) -> Iterator[None]:
+    # The model cache, scheduler and tracer are shared by all builds in a session.
+    model_cache = ModelCache(
+        get_cache_file_path(LLM_CACHE_FILE_NAME),
+        max_entries=LLM_CACHE_MAX_ENTRIES,
+        max_bytes=LLM_CACHE_MAX_BYTES,
+        max_age_seconds=LLM_CACHE_MAX_AGE_SECONDS,
+        bypass=args.no_llm_cache,
+    )
+    set_model_cache(model_cache)
+    model_scheduler = ModelScheduler(
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_concurrent_requests=MAX_CONCURRENT_MODEL_CALLS,
+        max_retries=MODEL_MAX_RETRIES,
+    )
+    set_model_scheduler(model_scheduler)
+    tracer = Tracer(open(get_doc_file_path(TRACE_FILE_NAME), "a"))
+    set_tracer(tracer)
+    metrics_server = (
+        start_metrics_server(args.metrics_port) if args.metrics_port else None
+    )
+
+    try:
+        yield
+    finally:
+        logging.info(
+            f"LLM cache: {model_cache.hits} hits, {model_cache.misses} misses."
+        )
+        logging.info(f"Model requests retried: {model_scheduler.retries}.")
+        set_model_scheduler(None)
+        model_scheduler.close()
+        set_model_cache(None)
+        model_cache.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        set_tracer(None)
+        tracer.trace_file.close()
+        print(tracer.format_summary())
 
 
 def prepare_workspace(reuse: bool) -> None:
-    directories = [SRC_DIR, DOC_DIR]
+    directories = [get_src_dir(), get_doc_dir()]
     for directory in directories:
         if not reuse and Path(directory).exists():
             shutil.rmtree(directory)
         path = Path(directory)
         path.mkdir(parents=True, exist_ok=True)
-    with open(get_doc_file_path(TEST_LOG_FILE_NAME), "w") as f:
-        f.write("")
+    get_test_log().clear()
 
 
-def build_app(spec_file_path: str) -> None:
-    gpt4_low_t = ChatOpenAI(model_name="gpt-4", temperature=0.2)
-    gpt4_high_t = ChatOpenAI(model_name="gpt-4", temperature=0.7)
+@traced
+def build_app(
+    spec_file_path: str,
+    index_mode: str = INDEX_MODE_FILE,
+    retriever_type: str = RETRIEVER_DENSE,
+    warm_test_worker: bool = False,
+    test_coverage: bool = False,
+    auto_fix: bool = False,
+    chat_model: Optional["BaseChatModel"] = None,
+) -> None:
+    gpt4_low_t = ChatModel("gpt-4", 0.2, chat_model)
+    gpt4_high_t = ChatModel("gpt-4", 0.7, chat_model)
 
     specifications_text = open(spec_file_path).read()
 
@@ -114,39 +324,126 @@ def build_app(spec_file_path: str) -> None:
         public_interface_document,
     )
 
-    while True:
-        source_code_vector_db = create_source_code_vector_db()
+    test_worker = TestWorker() if warm_test_worker else None
+    set_test_worker(test_worker)
 
-        for test_pattern in [
-            f"{UNIT_TEST_PREFIX}*.py",
-            f"{ACCEPTANCE_TEST_PREFIX}*.py",
-        ]:
-            test_failures = execute_all_tests(test_pattern)
+    # After a fix, only the affected tests run until they pass; then all tests
+    # run once more to confirm. Each iteration is journaled so that a resumed
+    # run continues after the last completed one, unless a file it started
+    # from has been generated again.
+    fix_loop_input_hash = hash_stage_inputs(
+        specifications_text,
+        get_stage_output_hash(
+            *get_generation_stages(public_interface_document, test_scenario_collection)
+        ),
+    )
+    changed_file_names = None
+    all_tests_passed = False
+    iteration = 0
+    while (
+        outputs := get_completed_stage(
+            f"fix_iteration:{iteration + 1}",
+            get_fix_iteration_input_hash(fix_loop_input_hash, iteration + 1),
+        )
+    ) is not None:
+        iteration += 1
+        changed_file_names = outputs["changed_file_names"]
+        all_tests_passed = outputs["all_tests_passed"]
+    if iteration > 0:
+        logging.info(f"Resuming the fix loop after iteration {iteration}.")
 
-            if test_failures.keys() != {RAW_ALL_TEST_ID}:
-                fixed_file_names = fix_test_errors(
-                    gpt4_low_t,
-                    specifications_text,
-                    public_interface_document,
-                    source_code_vector_db,
-                    test_failures,
-                )
-                public_interface_document = update_public_interface_document(
-                    gpt4_low_t,
-                    public_interface_document,
-                    file_names=fixed_file_names,
-                    force=True,
+    try:
+        while not all_tests_passed:
+            iteration += 1
+            with span("fix_iteration", iteration=iteration):
+                source_code_retriever = create_source_code_retriever(
+                    retriever_type, index_mode
                 )
-                break
-        else:
-            break
+
+                for test_pattern in [
+                    f"{UNIT_TEST_PREFIX}*.py",
+                    f"{ACCEPTANCE_TEST_PREFIX}*.py",
+                ]:
+                    test_failures = execute_all_tests(
+                        test_pattern,
+                        changed_file_names=changed_file_names,
+                        collect_coverage=test_coverage,
+                    )
+
+                    if test_failures.keys() != {RAW_ALL_TEST_ID}:
+                        fixed_file_names = fix_test_errors(
+                            gpt4_low_t,
+                            specifications_text,
+                            public_interface_document,
+                            source_code_retriever,
+                            test_failures,
+                            auto_fix,
+                        )
+                        if not fixed_file_names:
+                            raise RuntimeError("No fix could be applied.")
+                        public_interface_document = update_public_interface_document(
+                            gpt4_low_t,
+                            public_interface_document,
+                            file_names=fixed_file_names,
+                            force=True,
+                        )
+                        changed_file_names = fixed_file_names
+                        break
+                else:
+                    all_tests_passed = changed_file_names is None
+                    changed_file_names = None
+            complete_stage(
+                f"fix_iteration:{iteration}",
+                get_fix_iteration_input_hash(fix_loop_input_hash, iteration),
+                [
+                    get_src_file_path(file_name)
+                    for file_name in changed_file_names or []
+                ],
+                changed_file_names=changed_file_names,
+                all_tests_passed=all_tests_passed,
+            )
+    finally:
+        set_test_worker(None)
+        if test_worker is not None:
+            test_worker.close()
 
     logging.info("Done.")
 
 
-def modify_app(spec_file_path: str, change_request_file_path: str) -> None:
-    gpt4_low_t = ChatOpenAI(model_name="gpt-4", temperature=0.2)
-    gpt4_high_t = ChatOpenAI(model_name="gpt-4", temperature=0.7)
+def get_generation_stages(
+    public_interface_document: PublicInterfaceDocument,
+    test_scenario_collection: TestScenarioSet,
+) -> list[str]:
+    file_names = [file.name for file in public_interface_document.files]
+    return [
+        "public_interface_document",
+        "acceptance_test_scenarios",
+        *[f"unit_test:{get_unit_test_file_name(name)}" for name in file_names],
+        *[f"source_code:{name}" for name in file_names],
+        *[
+            "acceptance_test:"
+            + get_acceptance_test_file_name(
+                i, public_interface_document.entry_point_file_name
+            )
+            for i in range(len(test_scenario_collection.scenarios))
+        ],
+    ]
+
+
+def get_fix_iteration_input_hash(fix_loop_input_hash: str, iteration: int) -> str:
+    return hash_stage_inputs(
+        fix_loop_input_hash, get_stage_output_hash(f"fix_iteration:{iteration - 1}")
+    )
+
+
+@traced
+def modify_app(
+    spec_file_path: str,
+    change_request_file_path: str,
+    chat_model: Optional["BaseChatModel"] = None,
+) -> None:
+    gpt4_low_t = ChatModel("gpt-4", 0.2, chat_model)
+    gpt4_high_t = ChatModel("gpt-4", 0.7, chat_model)
 
     specifications_text = open(spec_file_path).read()
     change_request_text = open(change_request_file_path).read()
@@ -154,36 +451,53 @@ def modify_app(spec_file_path: str, change_request_file_path: str) -> None:
         get_doc_file_path(PUBLIC_INTERFACE_DOCUMENT_NAME)
     )
 
-    for file in public_interface_document.files:
-        modified = modify_source_code(
+    # Only the files affected by the change request are modified, and only the
+    # unit tests of modified files are updated.
+    file_names = select_files_to_modify(
+        gpt4_low_t,
+        specifications_text,
+        change_request_text,
+        public_interface_document,
+    )
+    modified = map_concurrently(
+        lambda file_name: modify_source_code(
             gpt4_high_t,
             specifications_text,
             change_request_text,
-            file.name,
+            file_name,
             public_interface_document,
-        )
+        ),
+        file_names,
+    )
+    modified_file_names = [
+        file_name for file_name, is_modified in zip(file_names, modified) if is_modified
+    ]
+    if not modified_file_names:
+        logging.info("Done.")
+        return
 
-        if modified:
-            public_interface_document = update_public_interface_document(
-                gpt4_low_t,
-                public_interface_document,
-                file_names=[file.name],
-                force=True,
-            )
+    public_interface_document = update_public_interface_document(
+        gpt4_low_t,
+        public_interface_document,
+        file_names=modified_file_names,
+        force=True,
+    )
 
     files_with_unit_tests = [
-        file
-        for file in public_interface_document.files
-        if file.name != public_interface_document.entry_point_file_name
+        file_name
+        for file_name in modified_file_names
+        if file_name != public_interface_document.entry_point_file_name
     ]
-    for file in files_with_unit_tests:
-        modify_unit_test(
+    map_concurrently(
+        lambda file_name: modify_unit_test(
             gpt4_high_t,
             specifications_text,
             change_request_text,
-            file.name,
+            file_name,
             public_interface_document,
-        )
+        ),
+        files_with_unit_tests,
+    )
 
     logging.info("Done.")
 
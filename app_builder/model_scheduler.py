@@ -0,0 +1,183 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+
+from async_runner import AsyncRunner
+from langchain.schema import HumanMessage
+from prompt_assembly import count_tokens
+from tracing import record_retry
+from util import ChatModel
+
+if TYPE_CHECKING:
+    from langchain.chat_models.base import BaseChatModel
+
+
+class TokenBucket:
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.tokens = capacity_per_minute
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        # Reservations may overdraw the bucket; the caller waits until the debt
+        # has been refilled, so concurrent callers queue up fairly.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated_at) * self.capacity / 60,
+            )
+            self.updated_at = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens * 60 / self.capacity)
+
+
+class ModelScheduler:
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        max_concurrent_requests: int,
+        max_retries: int,
+        initial_backoff_seconds: float = 1.0,
+        max_backoff_seconds: float = 60.0,
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.retries = 0
+        self._retries_lock = threading.Lock()
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._session = None
+        self._runner = AsyncRunner(max_concurrent_requests)
+
+    def get_client(self, model: ChatModel) -> "BaseChatModel":
+        with self._clients_lock:
+            if model not in self._clients:
+                # Retries are done here, with the rate limits in mind.
+                self._clients[model] = model.create_chat_model(max_retries=1)
+            return self._clients[model]
+
+    def submit(self, model: ChatModel, prompt: str) -> concurrent.futures.Future:
+        return self._runner.submit(self._execute(model, prompt))
+
+    def execute(self, model: ChatModel, prompt: str) -> str:
+        return self.submit(model, prompt).result()
+
+    async def execute_async(self, model: ChatModel, prompt: str) -> str:
+        return await asyncio.wrap_future(self.submit(model, prompt))
+
+    def use_session(self) -> None:
+        import openai
+
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession()
+        # Requests share one connection pool instead of opening a session each.
+        openai.aiosession.set(self._session)
+
+    async def _execute(self, model: ChatModel, prompt: str) -> str:
+        self.use_session()
+        client = self.get_client(model)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self.reserve_capacity(prompt))
+            try:
+                message = await client.apredict_messages([HumanMessage(content=prompt)])
+                return message.content
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                await asyncio.sleep(self.get_backoff_seconds(attempt, e))
+
+    def stream(self, model: ChatModel, prompt: str) -> Iterator[str]:
+        # Streams run on the event loop like other requests, so they count
+        # against the concurrency limit until the last chunk has arrived.
+        chunks = queue.Queue()
+        future = self._runner.submit(self._stream(model, prompt, chunks.put))
+        try:
+            while (chunk := chunks.get()) is not None:
+                yield chunk
+            future.result()
+        finally:
+            # Stops generating when the caller stops reading early.
+            future.cancel()
+
+    async def _stream(
+        self, model: ChatModel, prompt: str, on_chunk: Callable[[Optional[str]], None]
+    ) -> None:
+        try:
+            self.use_session()
+            client = self.get_client(model)
+            for attempt in range(self.max_retries + 1):
+                await asyncio.sleep(self.reserve_capacity(prompt))
+                received = False
+                try:
+                    async for chunk in client.astream([HumanMessage(content=prompt)]):
+                        received = True
+                        on_chunk(chunk.content)
+                    return
+                except Exception as e:
+                    # A partially consumed stream cannot be replayed.
+                    if (
+                        received
+                        or attempt == self.max_retries
+                        or not is_transient_error(e)
+                    ):
+                        raise
+                    await asyncio.sleep(self.get_backoff_seconds(attempt, e))
+        finally:
+            on_chunk(None)
+
+    def reserve_capacity(self, prompt: str) -> float:
+        return max(
+            self.request_bucket.reserve(1),
+            self.token_bucket.reserve(count_tokens(prompt)),
+        )
+
+    def get_backoff_seconds(self, attempt: int, error: Exception) -> float:
+        with self._retries_lock:
+            self.retries += 1
+        record_retry()
+        backoff_seconds = random.uniform(
+            0,
+            min(self.max_backoff_seconds, self.initial_backoff_seconds * 2**attempt),
+        )
+        logging.warning(
+            f"Retrying model request in {backoff_seconds:.1f} seconds "
+            f"after {type(error).__name__}: {error}"
+        )
+        return backoff_seconds
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._runner.submit(self._session.close()).result()
+        self._runner.close()
+
+
+def is_transient_error(error: Exception) -> bool:
+    import openai
+
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(
+        error,
+        (
+            openai.error.RateLimitError,
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            openai.error.ServiceUnavailableError,
+            openai.error.TryAgain,
+            asyncio.TimeoutError,
+            ConnectionError,
+        ),
+    )
@@ -1,8 +1,8 @@
 import re
+from typing import Callable, Optional
 
-from langchain.prompts import load_prompt
 from langchain.schema import BaseOutputParser
-from util import get_prompt_file_path
+from prompt_registry import get_prompt_template
 
 
 class CodeOutputParser(BaseOutputParser):
@@ -15,10 +15,42 @@ class CodeOutputParser(BaseOutputParser):
         return match.group(1) if match else ""
 
     def get_format_instructions(self) -> str:
-        return load_prompt(
-            get_prompt_file_path("code_output_parser_format.yaml")
-        ).format()
+        return get_prompt_template("code_output_parser_format.yaml").format()
 
     @property
     def _type(self) -> str:
         return "code"
+
+
+class IncrementalCodeOutputParser:
+    def __init__(self, on_code: Optional[Callable[[str], None]] = None):
+        self.on_code = on_code
+        self.code_lines = []
+        self.opened = False
+        self.closed = False
+        self.pending_text = ""
+
+    def feed(self, text: str) -> bool:
+        *lines, self.pending_text = (self.pending_text + text).split("\n")
+        for line in lines:
+            self.feed_line(line)
+            if self.closed:
+                break
+        return self.closed
+
+    def feed_line(self, line: str) -> None:
+        if not self.opened:
+            self.opened = re.fullmatch(r"\`\`\`\w*", line.strip()) is not None
+        elif line.strip() == "```":
+            self.closed = True
+        else:
+            self.code_lines.append(f"{line}\n")
+            if self.on_code is not None:
+                self.on_code(f"{line}\n")
+
+    def finish(self) -> str:
+        if not self.closed and self.pending_text:
+            self.feed_line(self.pending_text)
+            self.pending_text = ""
+        # Like CodeOutputParser.parse, an unterminated code block yields nothing.
+        return "".join(self.code_lines) if self.closed else ""
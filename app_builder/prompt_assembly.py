@@ -0,0 +1,122 @@
+import functools
+import logging
+from typing import Optional
+
+import tiktoken
+from import_graph import build_import_graph, get_importers
+from prompt_registry import get_prompt_template
+from schema import PublicInterfaceDocument
+from util import PROMPT_TOKEN_BUDGET
+
+# Used when the tokenizer cannot be loaded, e.g. offline on first use.
+APPROXIMATE_CHARS_PER_TOKEN = 4
+
+prompt_token_budget = PROMPT_TOKEN_BUDGET
+
+
+def set_prompt_token_budget(budget: int) -> None:
+    global prompt_token_budget
+    prompt_token_budget = budget
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"Approximating token counts because of {e!r}.")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // APPROXIMATE_CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_token_count(text: str, token_count: int) -> str:
+    encoding = get_encoding()
+    if encoding is None:
+        return text[: token_count * APPROXIMATE_CHARS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:token_count])
+
+
+def format_prompt(
+    prompt_file_name: str, trimmable_section_names: list[str], **sections: str
+) -> str:
+    prompt_template = get_prompt_template(prompt_file_name)
+    token_counts = {name: count_tokens(text) for name, text in sections.items()}
+    template_token_count = count_tokens(
+        prompt_template.format(**{name: "" for name in sections})
+    )
+    logging.debug(
+        f"{prompt_file_name}: {template_token_count} template tokens, "
+        + ", ".join(f"{name}: {count}" for name, count in token_counts.items())
+    )
+
+    excess_token_count = (
+        template_token_count + sum(token_counts.values()) - prompt_token_budget
+    )
+    if excess_token_count > 0:
+        kept_token_counts = get_kept_token_counts(
+            {name: token_counts[name] for name in trimmable_section_names},
+            sum(token_counts[name] for name in trimmable_section_names)
+            - excess_token_count,
+        )
+        for name, kept_token_count in kept_token_counts.items():
+            cut_token_count = token_counts[name] - kept_token_count
+            if cut_token_count == 0:
+                continue
+            sections[name] = (
+                f"{truncate_to_token_count(sections[name], kept_token_count)}\n"
+                f"[... {cut_token_count} tokens cut]"
+            )
+            excess_token_count -= cut_token_count
+            logging.info(
+                f"Cut {cut_token_count} of {token_counts[name]} tokens "
+                f"from {name} in {prompt_file_name}."
+            )
+    if excess_token_count > 0:
+        logging.warning(
+            f"{prompt_file_name} exceeds the prompt token budget "
+            f"by {excess_token_count} tokens."
+        )
+
+    return prompt_template.format(**sections)
+
+
+def get_kept_token_counts(
+    token_counts: dict[str, int], available_token_count: int
+) -> dict[str, int]:
+    # Sections share the available tokens evenly; a section shorter than its
+    # share is kept whole and leaves the rest to the longer ones.
+    kept_token_counts = {}
+    remaining_token_count = max(0, available_token_count)
+    sorted_names = sorted(token_counts, key=token_counts.get)
+    for i, name in enumerate(sorted_names):
+        share = remaining_token_count // (len(sorted_names) - i)
+        kept_token_counts[name] = min(token_counts[name], share)
+        remaining_token_count -= kept_token_counts[name]
+    return kept_token_counts
+
+
+def get_relevant_public_interface_document(
+    public_interface_document: PublicInterfaceDocument, file_names: list[str]
+) -> PublicInterfaceDocument:
+    import_graph = build_import_graph()
+    relevant_file_names = set(file_names)
+    for file_name in file_names:
+        relevant_file_names |= import_graph.get(file_name, set())
+        relevant_file_names |= get_importers(import_graph, file_name)
+
+    relevant_files = [
+        file
+        for file in public_interface_document.files
+        if file.name in relevant_file_names
+    ]
+    logging.info(
+        f"Including {len(relevant_files)} of {len(public_interface_document.files)} "
+        f"files of the public interface document."
+    )
+    return public_interface_document.model_copy(update={"files": relevant_files})
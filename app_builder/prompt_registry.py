@@ -0,0 +1,70 @@
+import logging
+import os
+import pickle
+import string
+from typing import Optional
+
+from langchain.prompts import PromptTemplate, load_prompt
+from util import (
+    PROMPT_DIR,
+    PROMPT_REGISTRY_CACHE_FILE_NAME,
+    get_cache_file_path,
+    get_prompt_file_path,
+)
+
+prompt_templates: Optional[dict[str, PromptTemplate]] = None
+
+
+def load_prompt_registry() -> None:
+    global prompt_templates
+    prompt_templates = load_prompt_templates()
+
+
+def get_prompt_template(file_name: str) -> PromptTemplate:
+    if prompt_templates is None:
+        load_prompt_registry()
+    return prompt_templates[file_name]
+
+
+def load_prompt_templates() -> dict[str, PromptTemplate]:
+    file_stats = {}
+    for file_name in sorted(os.listdir(PROMPT_DIR)):
+        if file_name.endswith(".yaml"):
+            stat = os.stat(get_prompt_file_path(file_name))
+            file_stats[file_name] = (stat.st_mtime_ns, stat.st_size)
+
+    cache_file_path = get_cache_file_path(PROMPT_REGISTRY_CACHE_FILE_NAME)
+    try:
+        with open(cache_file_path, "rb") as f:
+            cached_file_stats, templates = pickle.load(f)
+        if cached_file_stats == file_stats:
+            return templates
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Discarding unreadable prompt template cache: {e!r}")
+
+    templates = {}
+    for file_name in file_stats:
+        template = load_prompt(get_prompt_file_path(file_name))
+        validate_prompt_template(file_name, template)
+        templates[file_name] = template
+
+    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+    with open(f"{cache_file_path}.tmp", "wb") as f:
+        pickle.dump((file_stats, templates), f)
+    os.replace(f"{cache_file_path}.tmp", cache_file_path)
+    return templates
+
+
+def validate_prompt_template(file_name: str, template: PromptTemplate) -> None:
+    used_variables = {
+        field_name
+        for _, field_name, _, _ in string.Formatter().parse(template.template)
+        if field_name is not None
+    }
+    if used_variables != set(template.input_variables):
+        raise ValueError(
+            f"{file_name} declares input variables "
+            f"{sorted(template.input_variables)} but uses {sorted(used_variables)}."
+        )
@@ -0,0 +1,75 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+IDENTIFIER_REGEX = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+IDENTIFIER_PART_REGEX = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+def tokenize_source(text: str) -> list[str]:
+    tokens = []
+    for identifier in IDENTIFIER_REGEX.findall(text):
+        tokens.append(identifier.lower())
+        parts = IDENTIFIER_PART_REGEX.findall(identifier)
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, documents: list[Document], k1: float = 1.5, b: float = 0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[int, int]] = defaultdict(dict)
+        self.document_lengths = []
+        for doc_index, doc in enumerate(documents):
+            term_counts = Counter(tokenize_source(doc.page_content))
+            for term, count in term_counts.items():
+                self.postings[term][doc_index] = count
+            self.document_lengths.append(sum(term_counts.values()))
+        self.average_document_length = (
+            sum(self.document_lengths) / len(documents) if documents else 0.0
+        )
+
+    def search(self, query: str, k: int) -> list[tuple[Document, float]]:
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(tokenize_source(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (len(self.documents) - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for doc_index, term_frequency in postings.items():
+                length_ratio = (
+                    self.document_lengths[doc_index] / self.average_document_length
+                )
+                scores[doc_index] += (
+                    idf
+                    * term_frequency
+                    * (self.k1 + 1)
+                    / (term_frequency + self.k1 * (1 - self.b + self.b * length_ratio))
+                )
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[doc_index], score) for doc_index, score in ranked]
+
+
+class SourceCodeBM25Retriever(BaseRetriever):
+    index: BM25Index
+    k: int = 3
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+    ) -> list[Document]:
+        return [doc for doc, _ in self.index.search(query, self.k)]
@@ -0,0 +1,91 @@
+import ast
+import os
+
+from langchain.schema import Document
+
+MODULE_CHUNK_NAME = "<module>"
+
+
+def split_python_source(file_path: str, source_code: str) -> list[Document]:
+    try:
+        tree = ast.parse(source_code)
+    except SyntaxError:
+        return [create_chunk(file_path, source_code, MODULE_CHUNK_NAME, 1, None)]
+
+    lines = source_code.splitlines(keepends=True)
+    chunk_ranges = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            chunk_ranges.append((node.name, [get_line_range(node)]))
+        elif isinstance(node, ast.ClassDef):
+            method_nodes = [
+                child
+                for child in node.body
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))
+            ]
+            method_ranges = [get_line_range(child) for child in method_nodes]
+            chunk_ranges.append(
+                (node.name, subtract_ranges(get_line_range(node), method_ranges))
+            )
+            for child, method_range in zip(method_nodes, method_ranges):
+                chunk_ranges.append((f"{node.name}.{child.name}", [method_range]))
+
+    covered_ranges = [r for _, ranges in chunk_ranges for r in ranges]
+    module_ranges = subtract_ranges((1, len(lines)), covered_ranges)
+    chunk_ranges.insert(0, (MODULE_CHUNK_NAME, module_ranges))
+
+    chunks = []
+    for qualified_name, ranges in chunk_ranges:
+        ranges = [(start, end) for start, end in ranges if start <= end]
+        content = "".join(
+            "".join(lines[start - 1 : end]) for start, end in ranges
+        ).strip("\n")
+        if not content.strip():
+            continue
+        chunks.append(
+            create_chunk(
+                file_path, content, qualified_name, ranges[0][0], ranges[-1][1]
+            )
+        )
+    return chunks
+
+
+def create_chunk(
+    file_path: str,
+    content: str,
+    qualified_name: str,
+    start_line: int,
+    end_line: int,
+) -> Document:
+    if end_line is None:
+        end_line = len(content.splitlines())
+    return Document(
+        page_content=content,
+        metadata={
+            "source": file_path,
+            "file_name": os.path.basename(file_path),
+            "qualified_name": qualified_name,
+            "start_line": start_line,
+            "end_line": end_line,
+        },
+    )
+
+
+def get_line_range(node: ast.AST) -> tuple[int, int]:
+    decorators = getattr(node, "decorator_list", [])
+    start_line = min([node.lineno] + [decorator.lineno for decorator in decorators])
+    return start_line, node.end_lineno
+
+
+def subtract_ranges(
+    line_range: tuple[int, int], excluded_ranges: list[tuple[int, int]]
+) -> list[tuple[int, int]]:
+    ranges = []
+    start, end = line_range
+    for excluded_start, excluded_end in sorted(excluded_ranges):
+        if excluded_start > start:
+            ranges.append((start, min(end, excluded_start - 1)))
+        start = max(start, excluded_end + 1)
+    if start <= end:
+        ranges.append((start, end))
+    return ranges
@@ -0,0 +1,15 @@
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.retrievers import EnsembleRetriever
+from langchain.schema import Document
+
+
+class SourceCodeEnsembleRetriever(EnsembleRetriever):
+    k: int = 3
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+    ) -> list[Document]:
+        return super()._get_relevant_documents(query, run_manager=run_manager)[: self.k]
@@ -48,3 +48,9 @@ class TestScenario(BaseModel):
 
 class TestScenarioSet(BaseModel):
     scenarios: list[TestScenario]
+
+
+class AffectedFileSet(BaseModel):
+    file_names: list[str] = Field(
+        description="Names of the files to modify, as in the public interface document"
+    )
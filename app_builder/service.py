@@ -0,0 +1,422 @@
+import argparse
+import contextvars
+import json
+import logging
+import os
+import re
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import parse_qs, urlparse
+
+import tracing
+from checkpoint import CheckpointJournal, set_checkpoint_journal
+from dotenv import load_dotenv
+from job_queue import (
+    JOB_BUILD,
+    JOB_FAILED,
+    JOB_MODIFY,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    JobQueue,
+)
+from main import (
+    add_build_arguments,
+    build_app,
+    build_session,
+    configure_build,
+    modify_app,
+    prepare_workspace,
+)
+from tracing import span
+from util import (
+    CHECKPOINT_JOURNAL_FILE_NAME,
+    JOB_QUEUE_FILE_NAME,
+    SERVICE_EVENT_POLL_SECONDS,
+    SERVICE_MAX_CONCURRENT_JOBS,
+    SERVICE_PORT,
+    WORKSPACE_DIR,
+    WorkspaceNameFilter,
+    get_doc_dir,
+    get_doc_file_path,
+    get_src_dir,
+    get_workspace_dir,
+    set_embedding_model,
+    set_workspace_dir,
+)
+
+if TYPE_CHECKING:
+    from langchain.chat_models.base import BaseChatModel
+
+WORKSPACE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+SPEC_FILE_NAME = "spec.txt"
+CHANGE_REQUEST_FILE_NAME = "change_request.txt"
+
+current_job_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_job_id", default=None
+)
+
+
+class JobEventHandler(logging.Handler):
+    def __init__(self, job_queue: JobQueue):
+        super().__init__()
+        self.job_queue = job_queue
+
+    def emit(self, record: logging.LogRecord) -> None:
+        job_id = current_job_id.get()
+        if job_id is not None:
+            self.job_queue.add_event(
+                job_id,
+                {
+                    "type": "log",
+                    "level": record.levelname,
+                    "message": record.getMessage(),
+                },
+            )
+
+
+class JobWorker(threading.Thread):
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        workspace_root: str,
+        args: argparse.Namespace,
+        chat_model: Optional["BaseChatModel"],
+    ):
+        super().__init__(daemon=True)
+        self.job_queue = job_queue
+        self.workspace_root = workspace_root
+        self.args = args
+        self.chat_model = chat_model
+        self.stopping = threading.Event()
+        # Set when the service stops without waiting for the running job.
+        self.interrupted = threading.Event()
+        # Jobs run in a copy of the service's context, with its workspace.
+        self.context = contextvars.copy_context()
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            claimed_job = self.job_queue.claim(timeout=1.0)
+            if claimed_job is not None:
+                self.context.copy().run(self.run_job, *claimed_job)
+
+    def run_job(self, job: dict, request: dict) -> None:
+        current_job_id.set(job["id"])
+        set_workspace_dir(get_job_workspace_dir(self.workspace_root, job))
+        self.job_queue.add_event(job["id"], {"type": "status", "status": JOB_RUNNING})
+        logging.info(f"Running {job['kind']} job {job['id']}.")
+        error = None
+        try:
+            if job["kind"] == JOB_BUILD:
+                prepare_workspace(request.get("reuse", False))
+            set_checkpoint_journal(
+                CheckpointJournal(get_doc_file_path(CHECKPOINT_JOURNAL_FILE_NAME))
+            )
+            spec_file_path = os.path.join(get_workspace_dir(), SPEC_FILE_NAME)
+            if "spec" in request:
+                with open(spec_file_path, "w") as f:
+                    f.write(request["spec"])
+            elif not os.path.exists(spec_file_path):
+                raise FileNotFoundError(
+                    f"Workspace {job['workspace']} has no specifications."
+                )
+            with span("job", kind=job["kind"], job_id=job["id"]):
+                if job["kind"] == JOB_BUILD:
+                    # No one is at a terminal to choose a fix, so jobs always
+                    # test the suggested fixes and keep the best one.
+                    build_app(
+                        spec_file_path,
+                        self.args.index_mode,
+                        self.args.retriever,
+                        self.args.warm_test_worker,
+                        self.args.test_coverage,
+                        auto_fix=True,
+                        chat_model=self.chat_model,
+                    )
+                else:
+                    change_request_file_path = os.path.join(
+                        get_workspace_dir(), CHANGE_REQUEST_FILE_NAME
+                    )
+                    with open(change_request_file_path, "w") as f:
+                        f.write(request["change_request"])
+                    modify_app(
+                        spec_file_path,
+                        change_request_file_path,
+                        chat_model=self.chat_model,
+                    )
+        except Exception as e:
+            logging.exception(f"Job {job['id']} failed.")
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            set_checkpoint_journal(None)
+        if self.interrupted.is_set():
+            # The job is left running, so the next start runs it again.
+            logging.info(f"Job {job['id']} was interrupted.")
+            return
+        self.job_queue.finish(job["id"], error)
+        self.job_queue.add_event(
+            job["id"],
+            {
+                "type": "status",
+                "status": JOB_FAILED if error is not None else JOB_SUCCEEDED,
+                **({"error": error} if error is not None else {}),
+            },
+        )
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s [%(workspace)s]: %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S",
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(WorkspaceNameFilter())
+
+    arg_parser = argparse.ArgumentParser(
+        description="Serve a local HTTP API that queues build and modify jobs."
+    )
+    arg_parser.add_argument(
+        "--port",
+        type=int,
+        default=SERVICE_PORT,
+        help="Local port of the HTTP API.",
+    )
+    arg_parser.add_argument(
+        "--workspace-root",
+        type=str,
+        default=os.path.join(WORKSPACE_DIR, "service"),
+        help="Each job runs in a named workspace under this directory, which also "
+        "holds the job queue and the shared LLM cache.",
+    )
+    arg_parser.add_argument(
+        "--max-concurrent-jobs",
+        type=int,
+        default=SERVICE_MAX_CONCURRENT_JOBS,
+        help="Number of jobs run at the same time.",
+    )
+    arg_parser.add_argument(
+        "--fake-model",
+        type=int,
+        default=None,
+        metavar="FILE_COUNT",
+        help="Answer with a scripted offline model that builds a synthetic app "
+        "of this many files, and use offline embeddings. For testing.",
+    )
+    add_build_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    workspace_root = os.path.abspath(args.workspace_root)
+    set_workspace_dir(workspace_root)
+    os.makedirs(get_doc_dir(), exist_ok=True)
+    configure_build(args)
+
+    chat_model = None
+    if args.fake_model is not None:
+        from fake_models import HashingEmbeddings, ScriptedChatModel
+
+        chat_model = ScriptedChatModel(file_count=args.fake_model)
+        set_embedding_model(HashingEmbeddings())
+
+    job_queue = JobQueue(os.path.join(workspace_root, JOB_QUEUE_FILE_NAME))
+    job_event_handler = JobEventHandler(job_queue)
+    logging.getLogger().addHandler(job_event_handler)
+    try:
+        # Prompt templates, model clients and loaded indexes stay warm between
+        # jobs because the session lasts as long as the service.
+        with build_session(args):
+            tracing.tracer.span_listeners.append(
+                lambda record: add_stage_event(job_queue, record)
+            )
+            workers = [
+                JobWorker(job_queue, workspace_root, args, chat_model)
+                for _ in range(args.max_concurrent_jobs)
+            ]
+            for worker in workers:
+                worker.start()
+            server = ThreadingHTTPServer(
+                ("127.0.0.1", args.port),
+                create_request_handler(job_queue, workspace_root),
+            )
+            logging.info(f"Serving on http://127.0.0.1:{server.server_port}.")
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                for worker in workers:
+                    worker.stopping.set()
+                logging.info(
+                    "Stopping after the running jobs finish; interrupt again to stop "
+                    "now."
+                )
+                try:
+                    for worker in workers:
+                        worker.join()
+                except KeyboardInterrupt:
+                    # Running jobs are interrupted and run again on the next start.
+                    for worker in workers:
+                        worker.interrupted.set()
+    finally:
+        logging.getLogger().removeHandler(job_event_handler)
+        job_queue.close()
+
+
+def add_stage_event(job_queue: JobQueue, record: dict) -> None:
+    job_id = current_job_id.get()
+    if job_id is not None:
+        job_queue.add_event(
+            job_id,
+            {
+                "type": "stage",
+                "name": record["name"],
+                "wall_seconds": record["wall_seconds"],
+                **({"error": record["error"]} if "error" in record else {}),
+            },
+        )
+
+
+def get_job_workspace_dir(workspace_root: str, job: dict) -> str:
+    return os.path.join(workspace_root, "workspaces", job["workspace"])
+
+
+def create_request_handler(job_queue: JobQueue, workspace_root: str) -> type:
+    class JobRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if urlparse(self.path).path != "/jobs":
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                )
+                kind, workspace = validate_job_request(request)
+            except (ValueError, TypeError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            job = job_queue.submit(kind, workspace, request)
+            logging.info(f"Queued {kind} job {job['id']}.")
+            self.send_json(202, job)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            if parts == ["jobs"]:
+                self.send_json(200, {"jobs": job_queue.list_jobs()})
+                return
+            if parts == ["metrics"] and tracing.tracer is not None:
+                self.send_body(
+                    200,
+                    tracing.tracer.format_prometheus_metrics().encode(),
+                    "text/plain; version=0.0.4",
+                )
+                return
+            job = job_queue.get_job(parts[1]) if parts[:1] == ["jobs"] else None
+            if job is None or len(parts) < 2:
+                self.send_error(404)
+            elif len(parts) == 2:
+                self.send_json(200, job)
+            elif parts[2:] == ["events"]:
+                query = parse_qs(url.query)
+                self.stream_events(
+                    job["id"],
+                    int(query.get("after", ["0"])[0]),
+                    query.get("follow", ["1"])[0] != "0",
+                )
+            elif parts[2] == "artifacts":
+                self.send_artifact(job, "/".join(parts[3:]))
+            else:
+                self.send_error(404)
+
+        def stream_events(self, job_id: str, after_seq: int, follow: bool) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            # Events are sent as they are added until the job has finished.
+            while True:
+                is_finished = job_queue.get_job(job_id)["status"] in (
+                    JOB_SUCCEEDED,
+                    JOB_FAILED,
+                )
+                events = job_queue.get_events(job_id, after_seq)
+                try:
+                    for event in events:
+                        self.wfile.write((json.dumps(event) + "\n").encode())
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                if events:
+                    after_seq = events[-1]["seq"]
+                if is_finished or not follow:
+                    return
+                time.sleep(SERVICE_EVENT_POLL_SECONDS)
+
+        def send_artifact(self, job: dict, relative_path: str) -> None:
+            workspace_dir = get_job_workspace_dir(workspace_root, job)
+            if relative_path == "":
+                self.send_json(200, {"files": list_artifacts(workspace_dir)})
+                return
+            file_path = os.path.realpath(os.path.join(workspace_dir, relative_path))
+            if os.path.commonpath(
+                [file_path, os.path.realpath(workspace_dir)]
+            ) != os.path.realpath(workspace_dir) or not os.path.isfile(file_path):
+                self.send_error(404)
+                return
+            with open(file_path, "rb") as f:
+                self.send_body(200, f.read(), "application/octet-stream")
+
+        def send_json(self, status: int, body: dict) -> None:
+            self.send_body(status, json.dumps(body).encode(), "application/json")
+
+        def send_body(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return JobRequestHandler
+
+
+def validate_job_request(request: dict) -> tuple[str, Optional[str]]:
+    kind = request.get("kind")
+    workspace = request.get("workspace")
+    if kind not in (JOB_BUILD, JOB_MODIFY):
+        raise ValueError(f"kind must be {JOB_BUILD} or {JOB_MODIFY}.")
+    if workspace is not None and not WORKSPACE_NAME_PATTERN.match(str(workspace)):
+        raise ValueError(f"Invalid workspace name: {workspace}")
+    if kind == JOB_BUILD and not isinstance(request.get("spec"), str):
+        raise ValueError("A build job needs spec.")
+    if not isinstance(request.get("spec", ""), str):
+        raise ValueError("spec must be a string.")
+    if kind == JOB_MODIFY and (
+        workspace is None or not isinstance(request.get("change_request"), str)
+    ):
+        raise ValueError("A modify job needs workspace and change_request.")
+    return kind, workspace
+
+
+def list_artifacts(workspace_dir: str) -> list[str]:
+    # Source files and documents, without the caches used while building.
+    context = contextvars.copy_context()
+    context.run(set_workspace_dir, workspace_dir)
+    return sorted(
+        os.path.relpath(os.path.join(directory, file_name), workspace_dir)
+        for root_dir in [context.run(get_src_dir), context.run(get_doc_dir)]
+        if os.path.isdir(root_dir)
+        for directory, dir_names, file_names in os.walk(root_dir)
+        if "__pycache__" not in directory.split(os.sep)
+        for file_name in file_names
+    )
+
+
+if __name__ == "__main__":
+    main()
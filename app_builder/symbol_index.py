@@ -0,0 +1,227 @@
+import ast
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from failure_clusters import FRAME_PATTERN
+from langchain.schema import Document
+from retrieval.chunking import create_chunk, get_line_range
+from util import (
+    ACCEPTANCE_TEST_PREFIX,
+    MAX_LOADED_SOURCE_CODE_INDEXES,
+    UNIT_TEST_PREFIX,
+    get_src_dir,
+)
+
+# Symbol indexes stay loaded between builds, like the source code indexes.
+loaded_symbol_indexes: OrderedDict[str, "SymbolIndex"] = OrderedDict()
+loaded_symbol_indexes_lock = threading.Lock()
+
+
+@dataclass
+class Symbol:
+    qualified_name: str
+    file_name: str
+    start_line: int
+    end_line: int
+    called_names: set[str] = field(default_factory=set)
+    callees: list[str] = field(default_factory=list)
+    callers: list[str] = field(default_factory=list)
+
+
+class SymbolIndex:
+    def __init__(self, src_dir: str):
+        self.src_dir = src_dir
+        self._lock = threading.Lock()
+        self._file_stats = {}
+        self._symbols_by_file = {}
+        self._symbols = {}
+        self._linked = True
+
+    def refresh(self) -> None:
+        # Only files that changed since they were last parsed are parsed again.
+        file_names = {
+            str(path.relative_to(self.src_dir))
+            for path in Path(self.src_dir).glob("**/*.py")
+        }
+        with self._lock:
+            for file_name in self._symbols_by_file.keys() - file_names:
+                self._remove_file(file_name)
+            for file_name in file_names:
+                if self._file_stats.get(file_name) != self._stat_file(file_name):
+                    self._parse_file(file_name)
+
+    def update_file(self, file_name: str) -> None:
+        with self._lock:
+            if os.path.exists(os.path.join(self.src_dir, file_name)):
+                self._parse_file(file_name)
+            else:
+                self._remove_file(file_name)
+
+    def get_symbol(self, qualified_name: str) -> Optional[Symbol]:
+        with self._lock:
+            self._link()
+            return self._symbols.get(qualified_name)
+
+    def find_enclosing_symbol(self, file_name: str, line: int) -> Optional[Symbol]:
+        with self._lock:
+            self._link()
+            enclosing_symbols = [
+                symbol
+                for symbol in self._symbols_by_file.get(file_name, [])
+                if symbol.start_line <= line <= symbol.end_line
+            ]
+        if not enclosing_symbols:
+            return None
+        return min(
+            enclosing_symbols, key=lambda symbol: symbol.end_line - symbol.start_line
+        )
+
+    def _stat_file(self, file_name: str) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(os.path.join(self.src_dir, file_name))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _parse_file(self, file_name: str) -> None:
+        file_stat = self._stat_file(file_name)
+        try:
+            with open(os.path.join(self.src_dir, file_name)) as f:
+                tree = ast.parse(f.read())
+        except (OSError, SyntaxError, UnicodeDecodeError):
+            tree = None
+        self._remove_file(file_name)
+        self._file_stats[file_name] = file_stat
+        symbols = [] if tree is None else list(collect_symbols(tree, file_name))
+        self._symbols_by_file[file_name] = symbols
+        for symbol in symbols:
+            self._symbols[symbol.qualified_name] = symbol
+        self._linked = False
+
+    def _remove_file(self, file_name: str) -> None:
+        self._file_stats.pop(file_name, None)
+        for symbol in self._symbols_by_file.pop(file_name, []):
+            self._symbols.pop(symbol.qualified_name, None)
+        self._linked = False
+
+    def _link(self) -> None:
+        # Calls are resolved by name, preferring definitions in the same file.
+        if self._linked:
+            return
+        symbols_by_name = {}
+        for symbol in self._symbols.values():
+            symbols_by_name.setdefault(
+                symbol.qualified_name.rsplit(".", 1)[-1], []
+            ).append(symbol)
+        for symbol in self._symbols.values():
+            symbol.callers = []
+        for symbol in self._symbols.values():
+            symbol.callees = []
+            for name in sorted(symbol.called_names):
+                candidates = symbols_by_name.get(name, [])
+                local_candidates = [
+                    candidate
+                    for candidate in candidates
+                    if candidate.file_name == symbol.file_name
+                ]
+                for callee in local_candidates or candidates:
+                    # Calling a class runs its constructor.
+                    callee = (
+                        self._symbols.get(f"{callee.qualified_name}.__init__") or callee
+                    )
+                    if callee is symbol or callee.qualified_name in symbol.callees:
+                        continue
+                    symbol.callees.append(callee.qualified_name)
+                    callee.callers.append(symbol.qualified_name)
+        self._linked = True
+
+
+def collect_symbols(node: ast.AST, file_name: str, prefix: Optional[str] = None):
+    prefix = prefix or get_module_name(file_name)
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            qualified_name = f"{prefix}.{child.name}"
+            start_line, end_line = get_line_range(child)
+            called_names = set()
+            if not isinstance(child, ast.ClassDef):
+                for call in ast.walk(child):
+                    if not isinstance(call, ast.Call):
+                        continue
+                    if isinstance(call.func, ast.Name):
+                        called_names.add(call.func.id)
+                    elif isinstance(call.func, ast.Attribute):
+                        called_names.add(call.func.attr)
+            yield Symbol(qualified_name, file_name, start_line, end_line, called_names)
+            yield from collect_symbols(child, file_name, qualified_name)
+
+
+def get_module_name(file_name: str) -> str:
+    return file_name[:-3].replace(os.sep, ".")
+
+
+def get_symbol_index(src_dir: Optional[str] = None) -> SymbolIndex:
+    src_dir = os.path.abspath(src_dir or get_src_dir())
+    with loaded_symbol_indexes_lock:
+        symbol_index = loaded_symbol_indexes.get(src_dir)
+        if symbol_index is None:
+            symbol_index = SymbolIndex(src_dir)
+            loaded_symbol_indexes[src_dir] = symbol_index
+        loaded_symbol_indexes.move_to_end(src_dir)
+        while len(loaded_symbol_indexes) > MAX_LOADED_SOURCE_CODE_INDEXES:
+            loaded_symbol_indexes.popitem(last=False)
+    return symbol_index
+
+
+def get_traceback_documents(error_message: str) -> list[Document]:
+    # The functions of the traceback frames come first, innermost frame first,
+    # followed by the functions they call.
+    symbol_index = get_symbol_index()
+    symbol_index.refresh()
+    frame_symbols = []
+    for line in reversed(error_message.splitlines()):
+        match = FRAME_PATTERN.match(line)
+        if match is None:
+            continue
+        file_path, line_number, _ = match.groups()
+        file_name = os.path.relpath(os.path.abspath(file_path), symbol_index.src_dir)
+        if file_name.startswith(os.pardir):
+            continue
+        symbol = symbol_index.find_enclosing_symbol(file_name, int(line_number))
+        if symbol is not None and symbol not in frame_symbols:
+            frame_symbols.append(symbol)
+
+    symbols = list(frame_symbols)
+    for frame_symbol in frame_symbols:
+        for qualified_name in frame_symbol.callees:
+            callee = symbol_index.get_symbol(qualified_name)
+            if callee is not None and callee not in symbols:
+                symbols.append(callee)
+    return [
+        load_symbol_document(symbol_index.src_dir, symbol)
+        for symbol in symbols
+        # Test code is already part of the prompts.
+        if not is_test_file_name(os.path.basename(symbol.file_name))
+    ]
+
+
+def load_symbol_document(src_dir: str, symbol: Symbol) -> Document:
+    file_path = os.path.join(src_dir, symbol.file_name)
+    with open(file_path) as f:
+        lines = f.readlines()
+    return create_chunk(
+        file_path,
+        "".join(lines[symbol.start_line - 1 : symbol.end_line]).strip("\n"),
+        symbol.qualified_name[len(get_module_name(symbol.file_name)) + 1 :],
+        symbol.start_line,
+        symbol.end_line,
+    )
+
+
+def is_test_file_name(file_name: str) -> bool:
+    return file_name.startswith(UNIT_TEST_PREFIX) or file_name.startswith(
+        ACCEPTANCE_TEST_PREFIX
+    )
@@ -1,65 +1,37 @@
 import argparse
-import io
-import json
-import re
+import os
 import sys
-import traceback
-import unittest
-
-from util import (
-    ACCEPTANCE_TEST_PREFIX,
-    RAW_ALL_TEST_ID,
-    SRC_DIR,
-    TEST_LOG_FILE_NAME,
-    UNIT_TEST_PREFIX,
-    get_doc_file_path,
-)
-
-
-def save_test_results(text: str):
-    with open(get_doc_file_path(TEST_LOG_FILE_NAME), "a") as f:
-        f.write(text)
 
+from test_runner import run_tests
+from util import TEST_OUTPUT_MAX_CHARS, get_src_dir
 
 parser = argparse.ArgumentParser()
 parser.add_argument("pattern", type=str)
+parser.add_argument("--coverage", action="store_true")
+parser.add_argument("--event-fd", type=int, default=None)
+parser.add_argument("--src-dir", type=str, default=get_src_dir())
+parser.add_argument("--max-output-chars", type=int, default=TEST_OUTPUT_MAX_CHARS)
+parser.add_argument("--no-failfast", action="store_true")
 args = parser.parse_args()
 
 sys.dont_write_bytecode = True
 
-buffer = io.StringIO()
-sys.stdout = buffer
-
-loader = unittest.TestLoader()
-suite = loader.discover(start_dir=SRC_DIR, pattern=args.pattern)
-runner = unittest.TextTestRunner(stream=sys.stdout, verbosity=2, failfast=True)
-
-test_failures = {}
-try:
-    # TODO: consider failfast=False
-    result = runner.run(suite)
-    for test, error in result.failures + result.errors:
-        test_id = test.id()
-        test_failures[test_id] = error
-    test_failures[RAW_ALL_TEST_ID] = buffer.getvalue()
-
-    save_test_results(buffer.getvalue())
-except BaseException:
-    test_id_regex = re.compile(
-        f"\\(({UNIT_TEST_PREFIX}\\w*(\\.\\w+)+|"
-        f"{ACCEPTANCE_TEST_PREFIX}\\w*(\\.\\w+)+)\\)"
+if args.event_fd is None:
+    run_tests(
+        args.pattern,
+        sys.__stdout__,
+        args.coverage,
+        args.src_dir,
+        args.max_output_chars,
+        not args.no_failfast,
     )
-    buffer.seek(0)
-    stacktrace = traceback.format_exc()
-    for line in buffer:
-        match = re.search(test_id_regex, line)
-        if match:
-            test_id = match.group(1)
-            test_failures[test_id] = stacktrace
-            break
-    test_failures[RAW_ALL_TEST_ID] = f"{buffer.getvalue()}\n\n{stacktrace}"
-
-    save_test_results(stacktrace)
-finally:
-    sys.stdout = sys.__stdout__
-    print(json.dumps(test_failures))
+else:
+    with os.fdopen(args.event_fd, "w") as event_stream:
+        run_tests(
+            args.pattern,
+            event_stream,
+            args.coverage,
+            args.src_dir,
+            args.max_output_chars,
+            not args.no_failfast,
+        )
@@ -0,0 +1,164 @@
+import json
+import os
+import selectors
+import signal
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Protocol
+
+from util import RAW_ALL_TEST_ID
+
+TEST_STARTED = "started"
+TEST_PASSED = "passed"
+TEST_FAILED = "failed"
+TEST_ERRORED = "errored"
+TEST_SKIPPED = "skipped"
+TESTS_FINISHED = "finished"
+
+TestEvent = dict[str, Any]
+TestEventHandler = Callable[[str, TestEvent], None]
+
+
+class TestProcess(Protocol):
+    pid: int
+
+    def wait(self) -> Any: ...
+
+
+@dataclass
+class RunningTestFile:
+    test_file_name: str
+    process: TestProcess
+    deadline: float
+    interrupted: bool = False
+    finished: bool = False
+    started_test_ids: list[str] = field(default_factory=list)
+    pending_bytes: bytes = b""
+
+
+def run_test_processes(
+    test_file_names: list[str],
+    start_test_process: Callable[[str], tuple[TestProcess, int]],
+    timeout: float,
+    max_workers: int,
+    on_event: TestEventHandler,
+) -> None:
+    pending_file_names = list(test_file_names)
+    running_files = {}
+    selector = selectors.DefaultSelector()
+
+    def handle_line(running_file: RunningTestFile, line: bytes) -> None:
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            # Partial lines are expected when a test process is killed mid-write.
+            return
+        if event["event"] == TEST_STARTED:
+            running_file.started_test_ids.append(event["test_id"])
+        elif event["event"] == TESTS_FINISHED:
+            running_file.finished = True
+        elif event.get("test_id") in running_file.started_test_ids:
+            running_file.started_test_ids.remove(event["test_id"])
+        on_event(running_file.test_file_name, event)
+
+    while pending_file_names or running_files:
+        while pending_file_names and len(running_files) < max_workers:
+            test_file_name = pending_file_names.pop(0)
+            process, read_fd = start_test_process(test_file_name)
+            running_files[read_fd] = RunningTestFile(
+                test_file_name, process, time.monotonic() + timeout
+            )
+            selector.register(read_fd, selectors.EVENT_READ)
+
+        next_deadline = min(f.deadline for f in running_files.values())
+        for key, _ in selector.select(max(0, next_deadline - time.monotonic())):
+            running_file = running_files[key.fd]
+            chunk = os.read(key.fd, 65536)
+            if chunk:
+                *lines, running_file.pending_bytes = (
+                    running_file.pending_bytes + chunk
+                ).split(b"\n")
+                for line in lines:
+                    handle_line(running_file, line)
+                continue
+
+            handle_line(running_file, running_file.pending_bytes)
+            selector.unregister(key.fd)
+            os.close(key.fd)
+            running_file.process.wait()
+            del running_files[key.fd]
+            if not running_file.finished:
+                report_unfinished_test_file(running_file, timeout, on_event)
+
+        now = time.monotonic()
+        for running_file in running_files.values():
+            if running_file.deadline > now:
+                continue
+            if running_file.interrupted:
+                os.kill(running_file.process.pid, signal.SIGKILL)
+            else:
+                os.kill(running_file.process.pid, signal.SIGINT)
+                running_file.interrupted = True
+            running_file.deadline = now + 1
+
+    selector.close()
+
+
+def report_unfinished_test_file(
+    running_file: RunningTestFile, timeout: float, on_event: TestEventHandler
+) -> None:
+    message = (
+        f"{running_file.test_file_name} was killed before it finished "
+        f"(timeout: {timeout} seconds)."
+    )
+    test_ids = running_file.started_test_ids or [
+        os.path.splitext(running_file.test_file_name)[0]
+    ]
+    for test_id in test_ids:
+        on_event(
+            running_file.test_file_name,
+            {"event": TEST_ERRORED, "test_id": test_id, "traceback": message},
+        )
+    on_event(
+        running_file.test_file_name, {"event": TESTS_FINISHED, "interrupted": True}
+    )
+
+
+def collect_test_failures(
+    test_file_names: list[str], events_by_file: dict[str, list[TestEvent]]
+) -> dict[str, str]:
+    test_failures = {}
+    for test_file_name in test_file_names:
+        for event in events_by_file[test_file_name]:
+            if event["event"] in (TEST_FAILED, TEST_ERRORED):
+                test_failures[event["test_id"]] = event["traceback"]
+    test_failures[RAW_ALL_TEST_ID] = "\n".join(
+        format_test_events(events_by_file[test_file_name])
+        for test_file_name in test_file_names
+    )
+    return test_failures
+
+
+def format_test_events(events: list[TestEvent]) -> str:
+    status_lines = []
+    failure_blocks = []
+    tests_run = 0
+    for event in events:
+        if event["event"] in (TEST_STARTED, TESTS_FINISHED):
+            continue
+        tests_run += 1
+        status = {
+            TEST_PASSED: "ok",
+            TEST_FAILED: "FAIL",
+            TEST_ERRORED: "ERROR",
+            TEST_SKIPPED: f"skipped {event.get('reason', '')!r}",
+        }[event["event"]]
+        status_lines.append(f"{event['test_id']} ... {status}")
+        if event["event"] in (TEST_FAILED, TEST_ERRORED):
+            failure_blocks.append(
+                f"{'=' * 70}\n{status}: {event['test_id']}\n{'-' * 70}\n"
+                f"{event['traceback']}"
+            )
+
+    summary = f"Ran {tests_run} tests\n\n{'FAILED' if failure_blocks else 'OK'}"
+    return "\n".join(status_lines + [""] + failure_blocks + ["-" * 70, summary, ""])
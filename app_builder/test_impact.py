@@ -0,0 +1,51 @@
+import json
+import os
+from typing import Optional
+
+from import_graph import build_import_graph, get_transitive_imports
+from util import TEST_COVERAGE_DIR_NAME, get_doc_file_path
+
+
+def select_affected_test_files(
+    test_file_names: list[str],
+    changed_file_names: list[str],
+    src_dir: Optional[str] = None,
+) -> list[str]:
+    import_graph = build_import_graph(src_dir)
+    changed_file_name_set = set(changed_file_names)
+
+    affected_test_file_names = []
+    for test_file_name in test_file_names:
+        covered_file_names = load_test_coverage(test_file_name)
+        if covered_file_names is None:
+            dependencies = get_transitive_imports(import_graph, test_file_name)
+        else:
+            # Coverage drops imported-but-unused modules; direct imports are kept
+            # because tests may depend on their module-level constants.
+            dependencies = covered_file_names | import_graph.get(test_file_name, set())
+        if test_file_name in changed_file_name_set or (
+            dependencies & changed_file_name_set
+        ):
+            affected_test_file_names.append(test_file_name)
+    return affected_test_file_names
+
+
+def get_test_coverage_file_path(test_file_name: str) -> str:
+    return get_doc_file_path(
+        os.path.join(TEST_COVERAGE_DIR_NAME, f"{test_file_name}.json")
+    )
+
+
+def load_test_coverage(test_file_name: str) -> Optional[set[str]]:
+    coverage_file_path = get_test_coverage_file_path(test_file_name)
+    if not os.path.exists(coverage_file_path):
+        return None
+    with open(coverage_file_path) as f:
+        return set(json.load(f))
+
+
+def save_test_coverage(test_file_name: str, covered_file_names: set[str]) -> None:
+    coverage_file_path = get_test_coverage_file_path(test_file_name)
+    os.makedirs(os.path.dirname(coverage_file_path), exist_ok=True)
+    with open(coverage_file_path, "w") as f:
+        json.dump(sorted(covered_file_names), f)
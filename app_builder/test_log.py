@@ -0,0 +1,196 @@
+import contextlib
+import fcntl
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+from collections import deque
+from typing import Iterator, Optional
+
+from util import (
+    TEST_LOG_DIR_NAME,
+    TEST_LOG_MAX_SEGMENT_BYTES,
+    TEST_LOG_MAX_SEGMENTS,
+    TEST_OUTPUT_MAX_CHARS,
+    get_doc_file_path,
+    get_src_dir,
+)
+
+SEGMENT_FILE_NAME_PATTERN = re.compile(r"^segment-(\d+)\.jsonl(\.gz)?$")
+INDEX_FILE_NAME = "index.jsonl"
+LOCK_FILE_NAME = "lock"
+TEST_LOG_TEST_RUN = "test_run"
+TEST_LOG_SOURCE_CODE_FIX = "source_code_fix"
+
+
+class OutputRingBuffer(io.TextIOBase):
+    def __init__(self, max_chars: int = TEST_OUTPUT_MAX_CHARS):
+        self.max_chars = max_chars
+        self.chunks = deque()
+        self.size = 0
+        self.dropped_chars = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.chunks.append(text)
+        self.size += len(text)
+        # Only the tail is kept; a test printing in a loop can't exhaust memory.
+        while self.size > self.max_chars:
+            excess = self.size - self.max_chars
+            chunk = self.chunks.popleft()
+            if len(chunk) > excess:
+                self.chunks.appendleft(chunk[excess:])
+                chunk = chunk[:excess]
+            self.size -= len(chunk)
+            self.dropped_chars += len(chunk)
+        return len(text)
+
+    def getvalue(self) -> str:
+        value = "".join(self.chunks)
+        if self.dropped_chars:
+            value = f"[{self.dropped_chars} characters dropped]\n{value}"
+        return value
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if (offset, whence) != (0, io.SEEK_SET):
+            raise io.UnsupportedOperation("Only rewinding is supported.")
+        return 0
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        if size not in (None, 0):
+            raise io.UnsupportedOperation("Only truncating to empty is supported.")
+        self.chunks.clear()
+        self.size = 0
+        self.dropped_chars = 0
+        return 0
+
+
+class RotatingTestLog:
+    def __init__(
+        self,
+        log_dir: str,
+        max_segment_bytes: int = TEST_LOG_MAX_SEGMENT_BYTES,
+        max_segments: int = TEST_LOG_MAX_SEGMENTS,
+    ):
+        self.log_dir = log_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segments = max_segments
+        os.makedirs(log_dir, exist_ok=True)
+
+    def write_record(self, record: dict, **index_fields) -> None:
+        data = (json.dumps(record) + "\n").encode()
+        # Test processes run in parallel, so appends and rotation are serialized
+        # with a lock file.
+        with self._locked():
+            segment_numbers = self._list_segment_numbers()
+            segment_number = segment_numbers[-1][0] if segment_numbers else 0
+            if segment_numbers and segment_numbers[-1][1]:
+                segment_number += 1
+            segment_file_path = self._get_segment_file_path(segment_number)
+            with open(segment_file_path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+            entry = {
+                **index_fields,
+                "segment": segment_number,
+                "offset": offset,
+                "length": len(data),
+            }
+            with open(self._get_index_file_path(), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            if offset + len(data) >= self.max_segment_bytes:
+                self._rotate(segment_number)
+
+    def read_index(self) -> list[dict]:
+        with self._locked():
+            return self._read_index()
+
+    def find_records(self, **index_fields) -> list[dict]:
+        with self._locked():
+            return [
+                record
+                for entry in self._read_index()
+                if all(entry.get(key) == value for key, value in index_fields.items())
+                and (record := self._read_record(entry)) is not None
+            ]
+
+    def clear(self) -> None:
+        with self._locked():
+            for file_name in os.listdir(self.log_dir):
+                if file_name != LOCK_FILE_NAME:
+                    os.remove(os.path.join(self.log_dir, file_name))
+
+    def _read_index(self) -> list[dict]:
+        if not os.path.exists(self._get_index_file_path()):
+            return []
+        with open(self._get_index_file_path()) as f:
+            return [json.loads(line) for line in f]
+
+    def _read_record(self, entry: dict) -> Optional[dict]:
+        segment_file_path = self._get_segment_file_path(entry["segment"])
+        if os.path.exists(segment_file_path):
+            f = open(segment_file_path, "rb")
+        elif os.path.exists(f"{segment_file_path}.gz"):
+            f = gzip.open(f"{segment_file_path}.gz", "rb")
+        else:
+            return None
+        with f:
+            f.seek(entry["offset"])
+            return json.loads(f.read(entry["length"]))
+
+    def _rotate(self, segment_number: int) -> None:
+        segment_file_path = self._get_segment_file_path(segment_number)
+        with open(segment_file_path, "rb") as f_in:
+            with gzip.open(f"{segment_file_path}.gz", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.remove(segment_file_path)
+
+        expired_segment_numbers = {
+            number for number, _ in self._list_segment_numbers()[: -self.max_segments]
+        }
+        if not expired_segment_numbers:
+            return
+        for number in expired_segment_numbers:
+            os.remove(f"{self._get_segment_file_path(number)}.gz")
+        entries = [
+            entry
+            for entry in self._read_index()
+            if entry["segment"] not in expired_segment_numbers
+        ]
+        index_file_path = self._get_index_file_path()
+        with open(f"{index_file_path}.tmp", "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        os.replace(f"{index_file_path}.tmp", index_file_path)
+
+    def _list_segment_numbers(self) -> list[tuple[int, bool]]:
+        segment_numbers = []
+        for file_name in os.listdir(self.log_dir):
+            match = SEGMENT_FILE_NAME_PATTERN.match(file_name)
+            if match:
+                segment_numbers.append((int(match.group(1)), bool(match.group(2))))
+        return sorted(segment_numbers)
+
+    def _get_segment_file_path(self, segment_number: int) -> str:
+        return os.path.join(self.log_dir, f"segment-{segment_number:06d}.jsonl")
+
+    def _get_index_file_path(self) -> str:
+        return os.path.join(self.log_dir, INDEX_FILE_NAME)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(os.path.join(self.log_dir, LOCK_FILE_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_test_log(src_dir: Optional[str] = None) -> RotatingTestLog:
+    if src_dir is None or src_dir == get_src_dir():
+        return RotatingTestLog(get_doc_file_path(TEST_LOG_DIR_NAME))
+    return RotatingTestLog(os.path.join(src_dir, TEST_LOG_DIR_NAME))
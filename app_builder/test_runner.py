@@ -0,0 +1,172 @@
+import glob
+import json
+import os
+import re
+import sys
+import time
+import traceback
+import unittest
+from typing import Optional, TextIO
+
+from test_events import (
+    TEST_ERRORED,
+    TEST_FAILED,
+    TEST_PASSED,
+    TEST_SKIPPED,
+    TEST_STARTED,
+    TESTS_FINISHED,
+)
+from test_impact import save_test_coverage
+from test_log import TEST_LOG_TEST_RUN, OutputRingBuffer, get_test_log
+from util import RAW_ALL_TEST_ID, TEST_OUTPUT_MAX_CHARS, get_src_dir
+
+
+class StreamingTestResult(unittest.TestResult):
+    def __init__(self, event_stream: TextIO, max_output_chars: int):
+        super().__init__()
+        self.event_stream = event_stream
+        self.test_results = []
+        self.current_test_id: Optional[str] = None
+        self.started_at = 0.0
+        # Each test's output is buffered and added to its traceback on failure.
+        # unittest reuses preset buffers, which keep only the tail of the output.
+        self.buffer = True
+        self._stdout_buffer = OutputRingBuffer(max_output_chars)
+        self._stderr_buffer = OutputRingBuffer(max_output_chars)
+
+    def emit(self, event: str, **fields) -> None:
+        self.event_stream.write(json.dumps({"event": event, **fields}) + "\n")
+        self.event_stream.flush()
+
+    def emit_result(self, event: str, test: unittest.TestCase, **fields) -> None:
+        test_id = get_test_id(test)
+        duration = (
+            time.perf_counter() - self.started_at
+            if test_id == self.current_test_id
+            else 0.0
+        )
+        self.test_results.append(
+            {"test_id": test_id, "event": event, "duration": duration, **fields}
+        )
+        self.emit(event, test_id=test_id, duration=duration, **fields)
+        # Cleared only once reported, so an interrupted test is still known.
+        self.current_test_id = None
+
+    def startTest(self, test: unittest.TestCase) -> None:
+        super().startTest(test)
+        self.current_test_id = get_test_id(test)
+        self.started_at = time.perf_counter()
+        self.emit(TEST_STARTED, test_id=self.current_test_id)
+
+    def addSuccess(self, test: unittest.TestCase) -> None:
+        super().addSuccess(test)
+        self.emit_result(TEST_PASSED, test)
+
+    def addFailure(self, test: unittest.TestCase, err) -> None:
+        super().addFailure(test, err)
+        self.emit_result(TEST_FAILED, test, traceback=self.failures[-1][1])
+
+    def addError(self, test: unittest.TestCase, err) -> None:
+        super().addError(test, err)
+        self.emit_result(TEST_ERRORED, test, traceback=self.errors[-1][1])
+
+    def addSkip(self, test: unittest.TestCase, reason: str) -> None:
+        super().addSkip(test, reason)
+        self.emit_result(TEST_SKIPPED, test, reason=reason)
+
+    def addExpectedFailure(self, test: unittest.TestCase, err) -> None:
+        super().addExpectedFailure(test, err)
+        self.emit_result(TEST_PASSED, test)
+
+    def addUnexpectedSuccess(self, test: unittest.TestCase) -> None:
+        super().addUnexpectedSuccess(test)
+        self.emit_result(
+            TEST_FAILED, test, traceback="Unexpected success of an expected failure."
+        )
+
+
+def get_test_id(test: unittest.TestCase) -> str:
+    # Import errors and class/module fixture errors are reported through
+    # placeholder tests; map them to ids starting with the test module name.
+    if isinstance(test, unittest.loader._FailedTest):
+        return test._testMethodName
+    match = re.search(r"\((.+)\)$", test.id())
+    if not isinstance(test, unittest.TestCase) and match:
+        return match.group(1)
+    return test.id()
+
+
+def run_tests(
+    pattern: str,
+    event_stream: TextIO,
+    collect_coverage: bool = False,
+    src_dir: Optional[str] = None,
+    max_output_chars: int = TEST_OUTPUT_MAX_CHARS,
+    failfast: bool = True,
+) -> None:
+    if src_dir is None:
+        src_dir = get_src_dir()
+    covered_file_names = set()
+
+    def trace_calls(frame, event, arg):
+        file_path = frame.f_code.co_filename
+        if os.path.dirname(file_path) == src_dir:
+            covered_file_names.add(os.path.basename(file_path))
+        return None
+
+    output = OutputRingBuffer(max_output_chars)
+    sys.stdout = output
+    result = StreamingTestResult(event_stream, max_output_chars)
+    result.failfast = failfast
+    started_at = time.time()
+    try:
+        loader = unittest.TestLoader()
+        suite = loader.discover(start_dir=src_dir, pattern=pattern)
+
+        if collect_coverage:
+            sys.settrace(trace_calls)
+        result.startTestRun()
+        try:
+            suite.run(result)
+        finally:
+            sys.settrace(None)
+            result.stopTestRun()
+        result.emit(TESTS_FINISHED, tests_run=result.testsRun)
+    except BaseException:
+        stacktrace = traceback.format_exc()
+        output.write(stacktrace)
+        if result.current_test_id is not None:
+            test_id = result.current_test_id
+        elif not glob.has_magic(pattern):
+            test_id = os.path.splitext(pattern)[0]
+        else:
+            test_id = RAW_ALL_TEST_ID
+        result.test_results.append(
+            {"test_id": test_id, "event": TEST_ERRORED, "traceback": stacktrace}
+        )
+        result.emit(TEST_ERRORED, test_id=test_id, traceback=stacktrace)
+        result.emit(TESTS_FINISHED, tests_run=result.testsRun, interrupted=True)
+    finally:
+        sys.stdout = sys.__stdout__
+        get_test_log(src_dir).write_record(
+            {
+                "kind": TEST_LOG_TEST_RUN,
+                "pattern": pattern,
+                "started_at": started_at,
+                "finished_at": time.time(),
+                "tests_run": result.testsRun,
+                "results": result.test_results,
+                "output": output.getvalue(),
+            },
+            kind=TEST_LOG_TEST_RUN,
+            pattern=pattern,
+            recorded_at=started_at,
+            failed_test_ids=[
+                test_result["test_id"]
+                for test_result in result.test_results
+                if test_result["event"] in (TEST_FAILED, TEST_ERRORED)
+            ],
+        )
+
+    if collect_coverage and not glob.has_magic(pattern):
+        save_test_coverage(pattern, covered_file_names)
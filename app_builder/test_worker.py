@@ -0,0 +1,218 @@
+import contextlib
+import importlib
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from test_events import TestEventHandler, run_test_processes
+from test_runner import run_tests
+from util import (
+    ACCEPTANCE_TEST_PREFIX,
+    SCRIPT_DIR,
+    UNIT_TEST_PREFIX,
+    get_src_dir,
+    get_workspace_dir,
+    set_workspace_dir,
+)
+
+PRELOAD_TIMEOUT_SECONDS = 5
+
+# Workers are forked from a single-threaded fork server rather than from this
+# process, whose scheduler and build threads may hold locks at fork time.
+worker_context = multiprocessing.get_context("forkserver")
+worker_context.set_forkserver_preload(["test_worker"])
+
+
+class TestWorker:
+    def __init__(self):
+        self.src_dir = get_src_dir()
+        self._connection, worker_connection = worker_context.Pipe()
+        self._process = worker_context.Process(
+            target=serve,
+            args=(worker_connection, get_workspace_dir(), self.src_dir),
+            daemon=True,
+        )
+        self._process.start()
+        worker_connection.close()
+        self._lock = threading.Lock()
+
+    def run_test_files(
+        self,
+        test_file_names: list[str],
+        timeout: float,
+        max_workers: int,
+        collect_coverage: bool,
+        max_output_chars: int,
+        failfast: bool,
+        on_event: TestEventHandler,
+    ) -> None:
+        with self._lock:
+            self._connection.send(
+                (
+                    test_file_names,
+                    timeout,
+                    max_workers,
+                    collect_coverage,
+                    max_output_chars,
+                    failfast,
+                )
+            )
+            while (message := self._connection.recv()) is not None:
+                on_event(*message)
+
+    def close(self) -> None:
+        with self._lock:
+            with contextlib.suppress(OSError):
+                self._connection.send(None)
+            self._process.join(timeout=1)
+            if self._process.is_alive():
+                self._process.kill()
+            self._connection.close()
+
+
+class ForkedProcess:
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    def wait(self) -> int:
+        return os.waitpid(self.pid, 0)[1]
+
+
+def serve(connection, workspace_dir: str, src_dir: str) -> None:
+    set_workspace_dir(workspace_dir)
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, src_dir)
+    file_stats = {}
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        (
+            test_file_names,
+            timeout,
+            max_workers,
+            collect_coverage,
+            max_output_chars,
+            failfast,
+        ) = request
+        refresh_workspace_modules(src_dir, file_stats)
+        run_test_processes(
+            test_file_names,
+            lambda test_file_name: fork_test_process(
+                test_file_name, collect_coverage, src_dir, max_output_chars, failfast
+            ),
+            timeout,
+            max_workers,
+            lambda test_file_name, event: connection.send((test_file_name, event)),
+        )
+        connection.send(None)
+
+
+def refresh_workspace_modules(
+    src_dir: str, file_stats: dict[str, tuple[int, int]]
+) -> None:
+    current_file_stats = {}
+    for file_name in os.listdir(src_dir):
+        if file_name.endswith(".py"):
+            stat = os.stat(os.path.join(src_dir, file_name))
+            current_file_stats[file_name] = (stat.st_mtime_ns, stat.st_size)
+
+    changed_module_names = {
+        file_name[:-3]
+        for file_name in file_stats.keys() | current_file_stats.keys()
+        if file_stats.get(file_name) != current_file_stats.get(file_name)
+    }
+    file_stats.clear()
+    file_stats.update(current_file_stats)
+
+    # Modules of this app, such as main when batch.py imports it, would shadow
+    # workspace modules of the same name.
+    for file_name in current_file_stats:
+        module = sys.modules.get(file_name[:-3])
+        if module is not None and get_module_dir(module) == SCRIPT_DIR:
+            del sys.modules[file_name[:-3]]
+
+    workspace_modules = {
+        name: module
+        for name, module in sys.modules.items()
+        if get_module_dir(module) == src_dir
+    }
+    evicted_module_names = changed_module_names & workspace_modules.keys()
+    # Modules holding references into an evicted module must be evicted too.
+    while True:
+        dependent_module_names = {
+            name
+            for name, module in workspace_modules.items()
+            if name not in evicted_module_names
+            and any(
+                getattr(value, "__name__", None) in evicted_module_names
+                or getattr(value, "__module__", None) in evicted_module_names
+                for value in vars(module).values()
+            )
+        }
+        if not dependent_module_names:
+            break
+        evicted_module_names |= dependent_module_names
+    for name in evicted_module_names:
+        del sys.modules[name]
+
+    for file_name in sorted(current_file_stats):
+        module_name = file_name[:-3]
+        if (
+            module_name in sys.modules
+            or file_name.startswith(UNIT_TEST_PREFIX)
+            or file_name.startswith(ACCEPTANCE_TEST_PREFIX)
+        ):
+            continue
+        preload_workspace_module(module_name)
+
+
+def get_module_dir(module) -> str:
+    return os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or ""))
+
+
+def preload_workspace_module(module_name: str) -> None:
+    def raise_timeout(signum, frame):
+        raise TimeoutError(f"Importing {module_name} took too long.")
+
+    previous_handler = signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, PRELOAD_TIMEOUT_SECONDS)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            importlib.import_module(module_name)
+    except BaseException:
+        # The test run reports import errors, so a broken module is just not warmed.
+        sys.modules.pop(module_name, None)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def fork_test_process(
+    test_file_name: str,
+    collect_coverage: bool,
+    src_dir: str,
+    max_output_chars: int,
+    failfast: bool,
+) -> tuple[ForkedProcess, int]:
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            with os.fdopen(write_fd, "w") as event_stream:
+                run_tests(
+                    test_file_name,
+                    event_stream,
+                    collect_coverage,
+                    src_dir,
+                    max_output_chars,
+                    failfast,
+                )
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    return ForkedProcess(pid), read_fd
@@ -0,0 +1,202 @@
+import contextlib
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterator, Optional, TextIO, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+SPAN_COUNTER_NAMES = [
+    "prompt_tokens",
+    "completion_tokens",
+    "cache_hits",
+    "cache_misses",
+    "retries",
+]
+
+current_spans: contextvars.ContextVar[tuple["Span", ...]] = contextvars.ContextVar(
+    "current_spans", default=()
+)
+span_ids = itertools.count(1)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.span_id = next(span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        # The fix-loop iteration is inherited so that every span records it.
+        if parent is not None and "iteration" in parent.attributes:
+            self.attributes.setdefault("iteration", parent.attributes["iteration"])
+        self.counters = dict.fromkeys(SPAN_COUNTER_NAMES, 0)
+        self.started_at = time.time()
+        self.wall_seconds = 0.0
+        self.error: Optional[str] = None
+
+
+class Tracer:
+    def __init__(self, trace_file: TextIO):
+        self.trace_file = trace_file
+        self.stage_metrics = defaultdict(
+            lambda: dict.fromkeys(["calls", "wall_seconds"] + SPAN_COUNTER_NAMES, 0)
+        )
+        # Called with the record of each finished span, e.g. to report progress.
+        self.span_listeners: list[Callable[[dict], None]] = []
+        self._lock = threading.Lock()
+
+    def finish_span(self, span: Span) -> None:
+        record = {
+            "name": span.name,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "started_at": span.started_at,
+            "wall_seconds": span.wall_seconds,
+            **span.attributes,
+            **span.counters,
+        }
+        if span.error is not None:
+            record["error"] = span.error
+        with self._lock:
+            self.trace_file.write(json.dumps(record) + "\n")
+            self.trace_file.flush()
+            metrics = self.stage_metrics[span.name]
+            metrics["calls"] += 1
+            metrics["wall_seconds"] += span.wall_seconds
+            for name in SPAN_COUNTER_NAMES:
+                metrics[name] += span.counters[name]
+        for listener in self.span_listeners:
+            listener(record)
+
+    def add_to_current_spans(self, **counts: int) -> None:
+        # Counts are added to every enclosing span, so each span is inclusive.
+        with self._lock:
+            for span in current_spans.get():
+                for name, count in counts.items():
+                    span.counters[name] += count
+
+    def format_summary(self) -> str:
+        with self._lock:
+            rows = sorted(
+                self.stage_metrics.items(),
+                key=lambda item: item[1]["wall_seconds"],
+                reverse=True,
+            )
+        header = ["stage", "calls", "seconds"] + SPAN_COUNTER_NAMES
+        lines = [header] + [
+            [name, str(metrics["calls"]), f"{metrics['wall_seconds']:.1f}"]
+            + [str(metrics[counter_name]) for counter_name in SPAN_COUNTER_NAMES]
+            for name, metrics in rows
+        ]
+        widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+        return "\n".join(
+            "  ".join(
+                cell.ljust(width) if i == 0 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(line, widths))
+            )
+            for line in lines
+        )
+
+    def format_prometheus_metrics(self) -> str:
+        with self._lock:
+            stage_metrics = {
+                name: dict(metrics) for name, metrics in self.stage_metrics.items()
+            }
+        lines = []
+        for metric_name in ["calls", "wall_seconds"] + SPAN_COUNTER_NAMES:
+            prometheus_name = f"app_builder_stage_{metric_name}_total"
+            lines.append(f"# TYPE {prometheus_name} counter")
+            for stage_name, metrics in stage_metrics.items():
+                lines.append(
+                    f'{prometheus_name}{{stage="{stage_name}"}} {metrics[metric_name]}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+tracer: Optional[Tracer] = None
+
+
+def set_tracer(new_tracer: Optional[Tracer]) -> None:
+    global tracer
+    tracer = new_tracer
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    spans = current_spans.get()
+    new_span = Span(name, spans[-1] if spans else None, attributes)
+    token = current_spans.set(spans + (new_span,))
+    started_at = time.perf_counter()
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.error = type(e).__name__
+        raise
+    finally:
+        new_span.wall_seconds = time.perf_counter() - started_at
+        current_spans.reset(token)
+        if tracer is not None:
+            tracer.finish_span(new_span)
+
+
+def traced(function: F) -> F:
+    if inspect.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            with span(function.__name__):
+                return await function(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def record_model_call(prompt: str, output: str, cache_hit: bool) -> None:
+    if tracer is None:
+        return
+    from prompt_assembly import count_tokens
+
+    tracer.add_to_current_spans(
+        prompt_tokens=count_tokens(prompt),
+        completion_tokens=count_tokens(output),
+        cache_hits=int(cache_hit),
+        cache_misses=int(not cache_hit),
+    )
+
+
+def record_retry() -> None:
+    if tracer is not None:
+        tracer.add_to_current_spans(retries=1)
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics" or tracer is None:
+                self.send_error(404)
+                return
+            body = tracer.format_prometheus_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,36 +1,302 @@
+import contextvars
+import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TypeVar
 
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import HumanMessage
+from cache import ModelCache
+from tracing import record_model_call
 
-SCRIPT_DIR = os.path.dirname(os.path.abspath(str(sys.modules["__main__"].__file__)))
-WORKSPACE_DIR = os.path.join(SCRIPT_DIR, "workspace")
-SRC_DIR = os.path.join(WORKSPACE_DIR, "src")
-DOC_DIR = os.path.join(WORKSPACE_DIR, "docs")
+if TYPE_CHECKING:
+    from langchain.chat_models.base import BaseChatModel
+    from langchain.schema.embeddings import Embeddings
+    from model_scheduler import ModelScheduler
+
+# The fork server of the test worker runs without a main script; the scripts
+# live next to this module.
+SCRIPT_DIR = os.path.dirname(
+    os.path.abspath(getattr(sys.modules["__main__"], "__file__", __file__))
+)
+WORKSPACE_DIR = os.environ.get(
+    "APP_BUILDER_WORKSPACE_DIR", os.path.join(SCRIPT_DIR, "workspace")
+)
 PROMPT_DIR = os.path.join(SCRIPT_DIR, "prompts")
 PUBLIC_INTERFACE_DOCUMENT_NAME = "public_interface_document.json"
 ACCEPTANCE_TEST_SCENARIOS_FILE_NAME = "acceptance_test_scenarios.json"
-TEST_LOG_FILE_NAME = "test_results.log"
+TEST_LOG_DIR_NAME = "test_logs"
+TEST_LOG_MAX_SEGMENT_BYTES = 4 * 1024 * 1024
+TEST_LOG_MAX_SEGMENTS = 8
+TEST_OUTPUT_MAX_CHARS = 64 * 1024
 UNIT_TEST_PREFIX = "__unit_test_"
 ACCEPTANCE_TEST_PREFIX = "__acceptance_test_"
 RAW_ALL_TEST_ID = "__raw_all__"
+TEST_TIMEOUT_SECONDS = 10
+TEST_COVERAGE_DIR_NAME = "test_coverage"
+LLM_CACHE_FILE_NAME = "llm_cache.sqlite3"
+PROMPT_REGISTRY_CACHE_FILE_NAME = "prompt_templates.pickle"
+TRACE_FILE_NAME = "trace.jsonl"
+CHECKPOINT_JOURNAL_FILE_NAME = "checkpoint_journal.jsonl"
+EMBEDDING_CACHE_DIR_NAME = "embeddings"
+SOURCE_CODE_INDEX_DIR_NAME = "source_code_index"
+INDEX_MODE_FILE = "file"
+INDEX_MODE_AST = "ast"
+MAX_LOADED_SOURCE_CODE_INDEXES = 8
+SOURCE_CODE_SEARCH_K = {INDEX_MODE_FILE: 3, INDEX_MODE_AST: 8}
+FIX_CONTEXT_TOKEN_BUDGET = 2000
+RETRIEVER_DENSE = "dense"
+RETRIEVER_BM25 = "bm25"
+RETRIEVER_HYBRID = "hybrid"
+EDIT_FORMAT_WHOLE = "whole"
+EDIT_FORMAT_SEARCH_REPLACE = "search-replace"
+LLM_CACHE_MAX_ENTRIES = 10000
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+LLM_CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+MAX_CONCURRENT_MODEL_CALLS = 4
+PROMPT_TOKEN_BUDGET = 6000
+MODEL_REQUESTS_PER_MINUTE = 200
+MODEL_TOKENS_PER_MINUTE = 40000
+MODEL_MAX_RETRIES = 5
+BENCHMARK_FILE_COUNTS = [5, 20, 50, 100]
+BENCHMARK_BASELINE_FILE_NAME = "benchmark_baseline.json"
+BENCHMARK_REGRESSION_THRESHOLD = 1.25
+BATCH_MAX_CONCURRENT_BUILDS = 4
+BATCH_SUMMARY_FILE_NAME = "batch_summary.json"
+SERVICE_PORT = 8700
+SERVICE_MAX_CONCURRENT_JOBS = 2
+SERVICE_EVENT_POLL_SECONDS = 0.5
+JOB_QUEUE_FILE_NAME = "jobs.sqlite3"
+
+T = TypeVar("T")
+
+model_cache: Optional[ModelCache] = None
+model_scheduler: Optional["ModelScheduler"] = None
+embedding_model: Optional["Embeddings"] = None
+# Batch builds run in threads, each with its own workspace.
+workspace_dir: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "workspace_dir", default=WORKSPACE_DIR
+)
+
+
+class ChatModel:
+    def __init__(
+        self,
+        model_name: str,
+        temperature: float,
+        chat_model: Optional["BaseChatModel"] = None,
+    ):
+        self.model_name = model_name
+        self.temperature = temperature
+        self._chat_model = chat_model
+        # Equal models share one client in the scheduler, which outlives builds.
+        self._key = (model_name, temperature, id(chat_model))
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, ChatModel) and self._key == other._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def create_chat_model(self, **kwargs) -> "BaseChatModel":
+        if self._chat_model is not None:
+            return self._chat_model
+        # langchain.chat_models is slow to import and only needed on cache misses.
+        from langchain.chat_models import ChatOpenAI
+
+        return ChatOpenAI(
+            model_name=self.model_name, temperature=self.temperature, **kwargs
+        )
+
+    def get_chat_model(self) -> "BaseChatModel":
+        if self._chat_model is None:
+            self._chat_model = self.create_chat_model()
+        return self._chat_model
+
+
+class WorkspaceNameFilter(logging.Filter):
+    # Tells apart the log records of builds running at the same time.
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.workspace = os.path.basename(get_workspace_dir())
+        return True
+
+
+def set_workspace_dir(directory: str) -> None:
+    workspace_dir.set(directory)
+
+
+def get_workspace_dir() -> str:
+    return workspace_dir.get()
+
+
+def get_src_dir() -> str:
+    return os.path.join(get_workspace_dir(), "src")
+
+
+def get_doc_dir() -> str:
+    return os.path.join(get_workspace_dir(), "docs")
+
+
+def get_cache_dir() -> str:
+    return os.path.join(get_workspace_dir(), "cache")
+
+
+def get_worktree_dir() -> str:
+    return os.path.join(get_workspace_dir(), "worktrees")
 
 
 def get_src_file_path(file_name: str) -> str:
-    return os.path.join(SRC_DIR, file_name)
+    return os.path.join(get_src_dir(), file_name)
 
 
 def get_doc_file_path(file_name: str) -> str:
-    return os.path.join(DOC_DIR, file_name)
+    return os.path.join(get_doc_dir(), file_name)
 
 
 def get_prompt_file_path(file_name: str) -> str:
     return os.path.join(PROMPT_DIR, file_name)
 
 
-def execute_model(model: ChatOpenAI, prompt: str) -> str:
-    return model([HumanMessage(content=prompt)]).content
+def get_cache_file_path(file_name: str) -> str:
+    return os.path.join(get_cache_dir(), file_name)
+
+
+def set_model_cache(cache: Optional[ModelCache]) -> None:
+    global model_cache
+    model_cache = cache
+
+
+def set_model_scheduler(scheduler: Optional["ModelScheduler"]) -> None:
+    global model_scheduler
+    model_scheduler = scheduler
+
+
+def set_embedding_model(embeddings: Optional["Embeddings"]) -> None:
+    global embedding_model
+    embedding_model = embeddings
+
+
+def get_embedding_model() -> "Embeddings":
+    if embedding_model is not None:
+        return embedding_model
+    from langchain.embeddings.openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings()
+
+
+def call_model(model: ChatModel, prompt: str) -> str:
+    if model_scheduler is not None:
+        return model_scheduler.execute(model, prompt)
+    # langchain is slow to import, and test processes import this module.
+    from langchain.schema import HumanMessage
+
+    return model.get_chat_model()([HumanMessage(content=prompt)]).content
+
+
+async def call_model_async(model: ChatModel, prompt: str) -> str:
+    if model_scheduler is not None:
+        return await model_scheduler.execute_async(model, prompt)
+    from langchain.schema import HumanMessage
+
+    message = await model.get_chat_model().apredict_messages(
+        [HumanMessage(content=prompt)]
+    )
+    return message.content
+
+
+def stream_model(model: ChatModel, prompt: str) -> Iterator[str]:
+    if model_scheduler is not None:
+        return model_scheduler.stream(model, prompt)
+    from langchain.schema import HumanMessage
+
+    return (
+        chunk.content
+        for chunk in model.get_chat_model().stream([HumanMessage(content=prompt)])
+    )
+
+
+def execute_model(model: ChatModel, prompt: str) -> str:
+    cache = model_cache
+    if cache is None:
+        output = call_model(model, prompt)
+        record_model_call(prompt, output, cache_hit=False)
+        return output
+
+    model_name = get_model_name(model)
+    temperature = get_model_temperature(model)
+    output = cache.get(model_name, temperature, prompt)
+    cache_hit = output is not None
+    if not cache_hit:
+        output = call_model(model, prompt)
+        cache.put(model_name, temperature, prompt, output)
+    record_model_call(prompt, output, cache_hit)
+    return output
+
+
+def execute_model_streaming(
+    model: ChatModel, prompt: str, on_chunk: Callable[[str], bool]
+) -> str:
+    # on_chunk returns True once it has seen enough; the rest is not generated.
+    cache = model_cache
+    model_name = get_model_name(model)
+    temperature = get_model_temperature(model)
+    if cache is not None:
+        output = cache.get(model_name, temperature, prompt)
+        if output is not None:
+            on_chunk(output)
+            record_model_call(prompt, output, cache_hit=True)
+            return output
+
+    chunks = []
+    for chunk in stream_model(model, prompt):
+        chunks.append(chunk)
+        if on_chunk(chunk):
+            break
+    output = "".join(chunks)
+    if cache is not None:
+        cache.put(model_name, temperature, prompt, output)
+    record_model_call(prompt, output, cache_hit=False)
+    return output
+
+
+async def execute_model_async(model: ChatModel, prompt: str) -> str:
+    cache = model_cache
+    if cache is None:
+        output = await call_model_async(model, prompt)
+        record_model_call(prompt, output, cache_hit=False)
+        return output
+
+    model_name = get_model_name(model)
+    temperature = get_model_temperature(model)
+    output = cache.get(model_name, temperature, prompt)
+    cache_hit = output is not None
+    if not cache_hit:
+        output = await call_model_async(model, prompt)
+        cache.put(model_name, temperature, prompt, output)
+    record_model_call(prompt, output, cache_hit)
+    return output
+
+
+def map_concurrently(
+    function: Callable[..., T],
+    items: Iterable,
+    max_workers: int = MAX_CONCURRENT_MODEL_CALLS,
+) -> list[T]:
+    # Each call runs in a copy of the caller's context, so it is traced as part
+    # of the caller's span.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, function, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+
+def get_model_name(model: ChatModel) -> str:
+    return model.model_name
+
+
+def get_model_temperature(model: ChatModel) -> float:
+    return float(model.temperature)
 
 
 def get_unit_test_file_name(source_file_name: str) -> str:
@@ -0,0 +1,43 @@
+import fcntl
+import os
+import shutil
+
+from util import get_src_dir, get_worktree_dir
+
+# Linux ioctl that makes a file share the blocks of another file.
+FICLONE = 0x40049409
+
+
+def create_worktree(name: str) -> str:
+    worktree_dir = os.path.join(get_worktree_dir(), name)
+    shutil.rmtree(worktree_dir, ignore_errors=True)
+    shutil.copytree(
+        get_src_dir(),
+        worktree_dir,
+        copy_function=clone_or_copy_file,
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+    return worktree_dir
+
+
+def clone_or_copy_file(src: str, dst: str) -> None:
+    # A cloned file is copied on write; filesystems without reflinks get a
+    # plain copy.
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        shutil.copy2(src, dst)
+        return
+    shutil.copystat(src, dst)
+
+
+def write_worktree_file(worktree_dir: str, file_name: str, content: str) -> None:
+    file_path = os.path.join(worktree_dir, file_name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w") as f:
+        f.write(content)
+
+
+def remove_worktree(worktree_dir: str) -> None:
+    shutil.rmtree(worktree_dir, ignore_errors=True)